@@ -0,0 +1,81 @@
+"""Microbenchmark: NoRepeatNGramLogitsProcessor vs IncrementalNoRepeatNGramLogitsProcessor
+
+Decodes synthetic sequences (random text with repeated spans, so bans fire)
+step by step through both processors. Checks that every step's scores are
+identical and prints the mean per-step cost for several window sizes.
+
+python bench_ngram_norepeat.py [--steps 2000] [--vocab 129280] [--device cpu]
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from process.ngram_norepeat import IncrementalNoRepeatNGramLogitsProcessor, NoRepeatNGramLogitsProcessor
+
+CONFIGS = [(20, 50), (30, 90), (40, 90), (20, 500), (30, 2000)]  # (ngram_size, window_size)
+WHITELIST = {128821, 128822}
+
+
+def synthetic_tokens(steps: int, vocab: int, seed: int = 0):
+    """Random tokens with copied spans (table rows, repeated headers) and whitelisted cells"""
+    rng = random.Random(seed)
+    tokens = []
+    while len(tokens) < steps:
+        if len(tokens) > 60 and rng.random() < 0.3:
+            start = rng.randrange(0, len(tokens) - 40)
+            tokens.extend(tokens[start:start + rng.randint(10, 40)])
+        elif rng.random() < 0.1:
+            tokens.extend([128821, rng.randrange(vocab), 128822])
+        else:
+            tokens.extend(rng.randrange(vocab) for _ in range(rng.randint(1, 8)))
+    return tokens[:steps]
+
+
+def run(processor, tokens, scores, check=None):
+    """Per-step seconds; check(step, result) compares outputs"""
+    elapsed = 0.0
+    for step in range(1, len(tokens) + 1):
+        row = scores.clone()
+        ids = tokens[:step]
+        begin = time.perf_counter()
+        result = processor(ids, row)
+        elapsed += time.perf_counter() - begin
+        if check is not None:
+            check(step, result)
+    return elapsed / len(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--vocab", type=int, default=129280)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    tokens = synthetic_tokens(args.steps, args.vocab)
+    scores = torch.randn(args.vocab, device=args.device)
+    print(f"{args.steps} steps, vocab {args.vocab}, {args.device}")
+    print(f"{'ngram':>6} {'window':>7} {'reference us/step':>18} {'incremental us/step':>20} {'speedup':>8} {'banned steps':>13}")
+    for ngram_size, window_size in CONFIGS:
+        reference = NoRepeatNGramLogitsProcessor(ngram_size, window_size, WHITELIST)
+        incremental = IncrementalNoRepeatNGramLogitsProcessor(ngram_size, window_size, WHITELIST)
+        expected = []
+        run(reference, tokens, scores, lambda step, result: expected.append(result))
+        banned_steps = sum(1 for result in expected if torch.isinf(result).any())
+
+        def check(step, result):
+            if not torch.equal(result, expected[step - 1]):
+                raise AssertionError(f"ngram={ngram_size} window={window_size}: outputs differ at step {step}")
+
+        run(incremental.clone(), tokens, scores, check)
+        reference_s = run(reference, tokens, scores)
+        incremental_s = run(incremental.clone(), tokens, scores)
+        print(f"{ngram_size:>6} {window_size:>7} {reference_s * 1e6:>18.1f} {incremental_s * 1e6:>20.1f} "
+              f"{reference_s / incremental_s:>7.1f}x {banned_steps:>13}")
+    print("outputs identical at every step")
+
+
+if __name__ == "__main__":
+    main()
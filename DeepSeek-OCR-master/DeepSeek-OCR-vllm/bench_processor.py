@@ -0,0 +1,124 @@
+"""Microbenchmark: startup cost and per-image processor overhead
+
+Startup: time to import config (no tokenizer load) and to load the tokenizer
+on first get_tokenizer() call, each in a fresh interpreter.
+Per image: DeepseekOCRProcessor() built per image (the old call sites) vs the
+shared get_processor(), on synthetic pages of several sizes. Checks that both
+produce identical tensors, also when the shared processor is used from
+several threads at once.
+Token layout: building the input ids / image mask for a tile grid (first
+call) vs the cached template lookup every later call makes.
+
+python bench_processor.py [--images 50] [--threads 8] [--model deepseek-ai/DeepSeek-OCR]
+"""
+import argparse
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from PIL import Image
+
+import config
+from config import CROP_MODE
+
+SIZES = [(600, 800), (1240, 1754), (2480, 3508), (1754, 1240), (3000, 1000)]  # (width, height)
+
+
+def fresh_interpreter_seconds(code: str, model: str) -> float:
+    """Seconds reported by code (which prints them) in a new interpreter"""
+    setup = f"import time, config; config.MODEL_PATH = {model!r}; " if "get_tokenizer" in code else "import time; "
+    out = subprocess.run([sys.executable, "-c", setup + code], capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def synthetic_images(count: int):
+    images = []
+    for i in range(count):
+        width, height = SIZES[i % len(SIZES)]
+        shade = 255 - (i * 37) % 64
+        images.append(Image.new("RGB", (width, height), (shade, shade, shade)))
+    return images
+
+
+def same_output(a, b) -> bool:
+    for x, y in zip(a[0], b[0]):
+        if isinstance(x, torch.Tensor):
+            if not torch.equal(x, y):
+                return False
+        elif x != y:
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--model", default=config.MODEL_PATH, help="tokenizer path (defaults to config.MODEL_PATH)")
+    args = parser.parse_args()
+    config.MODEL_PATH = args.model
+
+    import_s = fresh_interpreter_seconds(
+        "t = time.perf_counter(); import config; print(time.perf_counter() - t)", args.model)
+    load_s = fresh_interpreter_seconds(
+        "t = time.perf_counter(); config.get_tokenizer(); print(time.perf_counter() - t)", args.model)
+    print(f"startup: import config {import_s * 1e3:.1f} ms, first get_tokenizer() {load_s * 1e3:.1f} ms")
+
+    from process import image_process
+    from process.image_process import DeepseekOCRProcessor, get_processor
+
+    images = synthetic_images(args.images)
+    shared = get_processor()
+    shared.tokenize_with_images(images=[images[0]], bos=True, eos=True, cropping=CROP_MODE)  # warm up
+
+    begin = time.perf_counter()
+    for _ in images:
+        DeepseekOCRProcessor()
+    construct_s = (time.perf_counter() - begin) / len(images)
+
+    begin = time.perf_counter()
+    expected = [DeepseekOCRProcessor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=CROP_MODE)
+                for image in images]
+    fresh_s = (time.perf_counter() - begin) / len(images)
+
+    begin = time.perf_counter()
+    results = [get_processor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=CROP_MODE)
+               for image in images]
+    shared_s = (time.perf_counter() - begin) / len(images)
+    if not all(same_output(a, b) for a, b in zip(expected, results)):
+        raise AssertionError("shared processor output differs from a fresh processor")
+
+    with ThreadPoolExecutor(args.threads) as pool:
+        threaded = list(pool.map(
+            lambda image: get_processor().tokenize_with_images(images=[image], bos=True, eos=True, cropping=CROP_MODE),
+            images))
+    if not all(same_output(a, b) for a, b in zip(expected, threaded)):
+        raise AssertionError(f"shared processor output differs under {args.threads} threads")
+
+    print(f"{len(images)} images, sizes {SIZES}")
+    print(f"DeepseekOCRProcessor() alone:      {construct_s * 1e3:8.2f} ms/image")
+    print(f"fresh processor + tokenize:        {fresh_s * 1e3:8.2f} ms/image")
+    print(f"shared processor + tokenize:       {shared_s * 1e3:8.2f} ms/image")
+    print(f"outputs identical (also with {args.threads} threads)")
+
+    grids = [((1, 1),), ((2, 2),), ((2, 3),), ((3, 2),)]
+    repeats = 200
+    begin = time.perf_counter()
+    for _ in range(repeats):
+        image_process._TOKEN_TEMPLATES.clear()
+        for grid in grids:
+            shared._token_template(config.PROMPT, grid, True, True)
+    build_s = (time.perf_counter() - begin) / (repeats * len(grids))
+    begin = time.perf_counter()
+    for _ in range(repeats):
+        for grid in grids:
+            shared._token_template(config.PROMPT, grid, True, True)
+    lookup_s = (time.perf_counter() - begin) / (repeats * len(grids))
+    print(f"token layout build:                {build_s * 1e6:8.1f} us/image")
+    print(f"token layout cached lookup:        {lookup_s * 1e6:8.1f} us/image")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,13 @@ MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency co
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
 PRINT_NUM_VIS_TOKENS = False
 SKIP_REPEAT = True
+REPEAT_GUARD = True # stop a sequence as soon as it loops (instead of at max_tokens) and keep the text before the loop
+TOKEN_BUDGET = True # per-page max_tokens predicted from the page image (see token_budget.py); pages that run out are retried with a larger budget
+TEXT_LAYER_POLICY = 'auto' # pdf pages: auto = use a trustworthy embedded text layer instead of OCR; ocr = always OCR; text = never OCR
+BLANK_PAGE_THRESHOLD = 0.0002 # max ink / edge pixel ratio of a page skipped as blank; 0 disables the blank page screen
+COMPILE_ENCODER = False # torch.compile the vision encoder for a 1024 global view and 640 tiles padded to TILE_BUCKETS; other shapes run eager
+COMPILE_MODE = 'reduce-overhead' # torch.compile mode for the encoder ('reduce-overhead' uses CUDA graphs)
+TILE_BUCKETS = (2, 4, 6) # tile-count buckets; keep the largest >= MAX_CROPS
 MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
 
 # TODO: change INPUT_PATH
@@ -37,6 +44,25 @@ PROMPT = '<image>\n<|grounding|>Convert the document to markdown.'
 # .......
 
 
-from transformers import AutoTokenizer
+import threading
 
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+_TOKENIZER = None
+_TOKENIZER_LOCK = threading.Lock()
+
+
+def get_tokenizer():
+    """The tokenizer for MODEL_PATH, loaded once per process on first use (not at import)."""
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        with _TOKENIZER_LOCK:
+            if _TOKENIZER is None:
+                from transformers import AutoTokenizer
+                _TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+    return _TOKENIZER
+
+
+def __getattr__(name):
+    # config.TOKENIZER / `from config import TOKENIZER` still work; the load happens on that access
+    if name == 'TOKENIZER':
+        return get_tokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
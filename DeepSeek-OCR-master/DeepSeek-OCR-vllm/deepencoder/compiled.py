@@ -0,0 +1,83 @@
+"""torch.compile for the vision encoder (SAM -> CLIP -> projector) on bucketed shapes.
+
+Compiling the encoder directly recompiles for every new tile count (2..MAX_CROPS
+tiles per page) and, with CUDA graphs, re-captures on every shape. Here the
+encoder is only ever called with a few fixed shapes:
+
+    global view   [1, 3, BASE_SIZE, BASE_SIZE]
+    tiles         [b, 3, IMAGE_SIZE, IMAGE_SIZE]   for b in TILE_BUCKETS
+
+Tile stacks are zero-padded up to the next bucket (larger stacks are split
+into chunks of the largest bucket) and the padding rows are dropped from the
+output; every view is encoded independently, so padding does not change the
+result. All buckets are compiled in warmup(); any other shape runs eager.
+"""
+from typing import Iterable, Optional, Set, Tuple
+
+import torch
+
+
+class BucketedVisionEncoder:
+    # Plain object (not nn.Module) so the wrapped modules are not registered twice
+    # and weight loading is unaffected.
+
+    def __init__(self, sam_model, vision_model, projector, global_size: int, tile_size: int,
+                 tile_buckets: Iterable[int], mode: str = "reduce-overhead"):
+        self.sam_model = sam_model
+        self.vision_model = vision_model
+        self.projector = projector
+        self.tile_size = tile_size
+        self.tile_buckets = sorted(set(int(b) for b in tile_buckets if int(b) > 0))
+        self.shapes: Set[Tuple[int, int]] = {(1, global_size)} | {(b, tile_size) for b in self.tile_buckets}
+        self.cudagraphs = mode == "reduce-overhead"
+        self.compiled = torch.compile(self.encode_eager, mode=mode, dynamic=False)
+        self.warm = False
+
+    def encode_eager(self, views: torch.Tensor) -> torch.Tensor:
+        sam_features = self.sam_model(views)
+        clip_features = self.vision_model(views, sam_features)
+        features = torch.cat((clip_features[:, 1:], sam_features.flatten(2).permute(0, 2, 1)), dim=-1)
+        return self.projector(features)
+
+    def _run_compiled(self, views: torch.Tensor) -> torch.Tensor:
+        if self.cudagraphs:
+            # Outputs of a CUDA graph replay are overwritten by the next replay
+            torch.compiler.cudagraph_mark_step_begin()
+            return self.compiled(views).clone()
+        return self.compiled(views)
+
+    def _bucket(self, n: int) -> Optional[int]:
+        for b in self.tile_buckets:
+            if b >= n:
+                return b
+        return None
+
+    @torch.no_grad()
+    def warmup(self, device: torch.device, dtype: torch.dtype) -> None:
+        """Compile every bucket up front so no request pays for compilation"""
+        for n, size in sorted(self.shapes):
+            print(f'compiling vision encoder for [{n}, 3, {size}, {size}]')
+            views = torch.zeros(n, 3, size, size, device=device, dtype=dtype)
+            # twice: CUDA graphs are recorded on the second call
+            self._run_compiled(views)
+            self._run_compiled(views)
+        self.warm = True
+
+    @torch.no_grad()
+    def __call__(self, views: torch.Tensor) -> torch.Tensor:
+        n, _, h, w = views.shape
+        if h != w:
+            return self.encode_eager(views)
+        if (n, h) in self.shapes:
+            return self._run_compiled(views)
+        if h != self.tile_size or not self.tile_buckets:
+            return self.encode_eager(views)
+
+        largest = self.tile_buckets[-1]
+        outputs = []
+        for start in range(0, n, largest):
+            chunk = views[start:start + largest]
+            bucket = self._bucket(chunk.shape[0])
+            padded = torch.cat([chunk, chunk.new_zeros(bucket - chunk.shape[0], *chunk.shape[1:])], dim=0)
+            outputs.append(self._run_compiled(padded)[:chunk.shape[0]])
+        return torch.cat(outputs, dim=0)
@@ -1,6 +1,5 @@
 
 """Inference-only Deepseek-OCR model compatible with HuggingFace weights."""
-import math
 from collections.abc import Iterable, Mapping, Sequence
 from typing import List, Literal, Optional, Set, Tuple, TypedDict, Union
 
@@ -28,7 +27,7 @@ from vllm.transformers_utils.configs.deepseek_vl2 import (DeepseekVLV2Config,
                                                           MlpProjectorConfig,
                                                           VisionEncoderConfig)
 from process.image_process import (
-    DeepseekOCRProcessor, count_tiles)
+    DeepseekOCRProcessor, count_tiles, get_processor, image_token_count)
 from vllm.transformers_utils.tokenizer import cached_tokenizer_from_config
 # from vllm.utils import is_list_of
 
@@ -40,9 +39,10 @@ from vllm.model_executor.models.utils import (AutoWeightsLoader, WeightsMapper,
 from deepencoder.sam_vary_sdpa import build_sam_vit_b
 from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
+from deepencoder.compiled import BucketedVisionEncoder
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT, COMPILE_ENCODER, COMPILE_MODE, TILE_BUCKETS
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
@@ -63,8 +63,8 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              image_width: int,
                              image_height: int,
                              cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
+        # called once per image by the prompt replacement; the layout only depends on the tile grid,
+        # so no hf processor is built here and count_tiles / image_token_count are cached
 
         # image_size = hf_processor.image_size
         # patch_size = hf_processor.patch_size
@@ -92,18 +92,7 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
         else:
             num_width_tiles = num_height_tiles = 1
 
-        h = w = math.ceil((base_size // patch_size) / downsample_ratio)
-
-        h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
-
-        global_views_tokens = h * (w + 1)
-        if num_width_tiles >1 or num_height_tiles>1:
-            local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
-        else:
-            local_views_tokens = 0
-
-
-        return global_views_tokens + local_views_tokens + 1
+        return image_token_count(num_width_tiles, num_height_tiles, base_size, image_size, patch_size, downsample_ratio)
 
     def get_image_size_with_most_features(self) -> ImageSize:
 
@@ -135,7 +124,7 @@ class DeepseekOCRDummyInputsBuilder(
         if '<image>' in PROMPT:
             return {
                 "image":
-                DeepseekOCRProcessor().tokenize_with_images(images = self._get_dummy_images(width=max_image_size.width,
+                get_processor().tokenize_with_images(images = self._get_dummy_images(width=max_image_size.width,
                                     height=max_image_size.height,
                                     num_images=num_images), bos=True, eos=True, cropping=CROP_MODE)
             }
@@ -293,9 +282,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         self.tile_tag = config.tile_tag
         self.global_view_pos = config.global_view_pos
     
-        # self.sam_model = torch.compile(self.sam_model, mode="reduce-overhead")
-        # self.vision_model = torch.compile(self.vision_model, mode="reduce-overhead")
-        # self.projector = torch.compile(self.projector, mode="max-autotune")
+        # Compiling the modules directly recompiles on every tile count; compile on
+        # fixed shape buckets instead (deepencoder/compiled.py)
+        self.vision_encoder = None
+        if COMPILE_ENCODER:
+            self.vision_encoder = BucketedVisionEncoder(
+                self.sam_model, self.vision_model, self.projector,
+                global_size=BASE_SIZE if CROP_MODE else IMAGE_SIZE, tile_size=IMAGE_SIZE,
+                tile_buckets=TILE_BUCKETS, mode=COMPILE_MODE)
 
 
 
@@ -361,6 +355,15 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
     
 
 
+    def _encode_views(self, views: torch.Tensor) -> torch.Tensor:
+        # SAM -> CLIP -> projector: [N, 3, H, W] -> [N, h*w, n_embed]
+        if self.vision_encoder is not None:
+            return self.vision_encoder(views)
+        features_1 = self.sam_model(views)
+        features_2 = self.vision_model(views, features_1)
+        features = torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1)
+        return self.projector(features)
+
     def _pixel_values_to_embedding(
         self,
         pixel_values: torch.Tensor,
@@ -391,20 +394,10 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 if torch.sum(patches).item() != 0:  # if all values = 0, no crop
                     # P, C, H, W = patches.shape
                     # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
+                    local_features = self._encode_views(patches)
                     #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
-
-
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
 
-
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                    global_features = self._encode_views(image_ori)
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
@@ -438,10 +431,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                     global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
                 
                 else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                    global_features = self._encode_views(image_ori)
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
@@ -575,6 +565,10 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         loader = AutoWeightsLoader(self)
         autoloaded_weights = loader.load_weights(processed_weights, mapper=self.hf_to_vllm_mapper)
 
+        if self.vision_encoder is not None and not self.vision_encoder.warm:
+            param = next(self.sam_model.parameters())
+            self.vision_encoder.warmup(param.device, torch.bfloat16)
+
 
 
 
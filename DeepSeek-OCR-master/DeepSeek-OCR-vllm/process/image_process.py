@@ -1,4 +1,6 @@
 import math
+import threading
+from functools import lru_cache
 from typing import List, Tuple
 
 import torch
@@ -6,7 +8,25 @@ import torchvision.transforms as T
 from PIL import Image, ImageOps
 from transformers import AutoProcessor, BatchFeature, LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, get_tokenizer
+
+# fast tokenizers are not safe to call from several threads at once; the shared processor encodes under this lock
+_ENCODE_LOCK = threading.Lock()
+
+# (tokenizer, prompt, base_size, image_size, tile grids, bos, eos) -> token template, see DeepseekOCRProcessor._token_template
+_TOKEN_TEMPLATES = {}
+
+
+@lru_cache(maxsize=None)
+def image_token_count(num_width_tiles, num_height_tiles, base_size=BASE_SIZE, image_size=IMAGE_SIZE,
+                      patch_size=16, downsample_ratio=4):
+    """<image> tokens for one image: the global view, its row separators and the view separator, plus local tiles."""
+    num_queries = math.ceil((image_size // patch_size) / downsample_ratio)
+    num_queries_base = math.ceil((base_size // patch_size) / downsample_ratio)
+    count = (num_queries_base + 1) * num_queries_base + 1
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        count += (num_queries * num_width_tiles + 1) * (num_queries * num_height_tiles)
+    return count
 
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
     best_ratio_diff = float('inf')
@@ -25,6 +45,7 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
+@lru_cache(maxsize=4096)
 def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
     aspect_ratio = orig_width / orig_height
 
@@ -114,7 +135,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
     def __init__(
         self,
-        tokenizer: LlamaTokenizerFast = TOKENIZER,
+        tokenizer: LlamaTokenizerFast = None,
         candidate_resolutions: Tuple[Tuple[int, int]] = [[1024, 1024]],
         patch_size: int = 16,
         downsample_ratio: int = 4,
@@ -143,7 +164,8 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         self.image_transform = ImageTransform(mean=image_mean, std=image_std, normalize=normalize)
 
-
+        if tokenizer is None:
+            tokenizer = get_tokenizer()
         self.tokenizer = tokenizer
         # self.tokenizer = add_special_token(tokenizer)
         self.tokenizer.padding_side = 'left'  # must set this，padding side with make a difference in batch inference
@@ -226,7 +248,8 @@ class DeepseekOCRProcessor(ProcessorMixin):
         return self.tokenizer.pad_token_id
 
     def encode(self, text: str, bos: bool = True, eos: bool = False):
-        t = self.tokenizer.encode(text, add_special_tokens=False)
+        with _ENCODE_LOCK:
+            t = self.tokenizer.encode(text, add_special_tokens=False)
 
         if bos:
             t = [self.bos_id] + t
@@ -340,18 +363,10 @@ class DeepseekOCRProcessor(ProcessorMixin):
         # print(conversation)
         conversation = PROMPT
         assert conversation.count(self.image_token) == len(images)
-        text_splits = conversation.split(self.image_token)
-        images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
+        images_list, images_crop_list, images_spatial_crop = [], [], []
         image_shapes = []
-        num_image_tokens = []
-        tokenized_str = []
         # print('image: ', len(images))
-        for text_sep, image in zip(text_splits, images):
-            """encode text_sep"""
-            tokenized_sep = self.encode(text_sep, bos=False, eos=False)
-            tokenized_str += tokenized_sep
-            images_seq_mask += [False] * len(tokenized_sep)
-
+        for image in images:
             """select best resolution for anyres"""
             # if cropping:
             #     best_width, best_height = self.select_best_resolution(image.size)
@@ -389,7 +404,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
             """record height / width crop num"""
             # width_crop_num, height_crop_num = best_width // self.image_size, best_height // self.image_size
-            num_width_tiles, num_height_tiles = crop_ratio
+            num_width_tiles, num_height_tiles = int(crop_ratio[0]), int(crop_ratio[1])
             images_spatial_crop.append([num_width_tiles, num_height_tiles])
 
 
@@ -420,57 +435,10 @@ class DeepseekOCRProcessor(ProcessorMixin):
             #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
 
             # """add image tokens"""
-            """add image tokens"""
-            num_queries = math.ceil((self.image_size // self.patch_size) / self.downsample_ratio)
-            num_queries_base = math.ceil((self.base_size // self.patch_size) / self.downsample_ratio)
-
-
-            tokenized_image = ([self.image_token_id] * num_queries_base + [self.image_token_id]) * num_queries_base
-            tokenized_image += [self.image_token_id]
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                tokenized_image += ([self.image_token_id] * (num_queries * num_width_tiles) + [self.image_token_id]) * (
-                            num_queries * num_height_tiles)
-            tokenized_str += tokenized_image
-            images_seq_mask += [True] * len(tokenized_image)
-            num_image_tokens.append(len(tokenized_image))
-
-        """process the last text split"""
-        tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
-        tokenized_str += tokenized_sep
-        images_seq_mask += [False] * len(tokenized_sep)
-
-        """add the bos and eos tokens"""
-        if bos:
-            tokenized_str = [self.bos_id] + tokenized_str
-            images_seq_mask = [False] + images_seq_mask
-        if eos:
-            tokenized_str = tokenized_str + [self.eos_id]
-            images_seq_mask = images_seq_mask + [False]
-
-        assert len(tokenized_str) == len(
-            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(tokenized_str)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
-        
-
-
-        masked_tokenized_str = []
-        for token_index in tokenized_str:
-            if token_index != self.image_token_id:
-                masked_tokenized_str.append(token_index)
-            else:
-                masked_tokenized_str.append(self.ignore_id)
 
-        assert len(tokenized_str) == len(images_seq_mask) == len(masked_tokenized_str), \
-            (f"tokenized_str's length {len(tokenized_str)}, input_ids' length {len(masked_tokenized_str)}, "
-             f"imags_seq_mask's length {len(images_seq_mask)}, are not equal")
-
-        input_ids = torch.LongTensor(tokenized_str)
-        target_ids = torch.LongTensor(masked_tokenized_str)
-        images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
-
-        # set input_ids < 0 | input_ids == self.image_token_id as ignore_id
-        target_ids[(input_ids < 0) |
-                   (input_ids == self.image_token_id)] = self.ignore_id
-        input_ids[input_ids < 0] = self.pad_id
+        # token ids and image mask depend only on the prompt and the tile grids: cached, see _token_template
+        grids = tuple((width_tiles, height_tiles) for width_tiles, height_tiles in images_spatial_crop)
+        input_ids, images_seq_mask, num_image_tokens = self._token_template(conversation, grids, bos, eos)
 
         inference_mode = True
 
@@ -478,8 +446,11 @@ class DeepseekOCRProcessor(ProcessorMixin):
             # Remove the ending eos token
             assert input_ids[-1] == self.eos_id
             input_ids = input_ids[:-1]
-            target_ids = target_ids[:-1]
             images_seq_mask = images_seq_mask[:-1]
+        # callers own their copies; the cached template stays untouched
+        input_ids = input_ids.clone()
+        images_seq_mask = images_seq_mask.clone()
+        num_image_tokens = list(num_image_tokens)
 
         if len(images_list) == 0:
             pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
@@ -499,4 +470,67 @@ class DeepseekOCRProcessor(ProcessorMixin):
         return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
 
 
+    def _token_template(self, conversation: str, grids: Tuple[Tuple[int, int], ...], bos: bool, eos: bool):
+        """(input_ids, images_seq_mask, num_image_tokens) for a prompt and per-image tile grids, built once per key."""
+        key = (self.tokenizer.name_or_path, conversation, self.base_size, self.image_size, grids, bos, eos)
+        template = _TOKEN_TEMPLATES.get(key)
+        if template is not None:
+            return template
+
+        text_splits = conversation.split(self.image_token)
+        tokenized_str, images_seq_mask, num_image_tokens = [], [], []
+        for text_sep, (num_width_tiles, num_height_tiles) in zip(text_splits, grids):
+            """encode text_sep"""
+            tokenized_sep = self.encode(text_sep, bos=False, eos=False)
+            tokenized_str += tokenized_sep
+            images_seq_mask += [False] * len(tokenized_sep)
+
+            """add image tokens"""
+            count = image_token_count(num_width_tiles, num_height_tiles, self.base_size, self.image_size,
+                                      self.patch_size, self.downsample_ratio)
+            tokenized_str += [self.image_token_id] * count
+            images_seq_mask += [True] * count
+            num_image_tokens.append(count)
+
+        """process the last text split"""
+        tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
+        tokenized_str += tokenized_sep
+        images_seq_mask += [False] * len(tokenized_sep)
+
+        """add the bos and eos tokens"""
+        if bos:
+            tokenized_str = [self.bos_id] + tokenized_str
+            images_seq_mask = [False] + images_seq_mask
+        if eos:
+            tokenized_str = tokenized_str + [self.eos_id]
+            images_seq_mask = images_seq_mask + [False]
+
+        assert len(tokenized_str) == len(
+            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(tokenized_str)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
+
+        template = (torch.LongTensor(tokenized_str), torch.tensor(images_seq_mask, dtype=torch.bool),
+                    tuple(num_image_tokens))
+        _TOKEN_TEMPLATES[key] = template
+        return template
+
+
 AutoProcessor.register("DeepseekVLV2Processor", DeepseekOCRProcessor)
+
+
+_PROCESSOR = None
+_PROCESSOR_LOCK = threading.Lock()
+
+
+def get_processor():
+    """Process-wide DeepseekOCRProcessor.
+
+    Construction sets up the tokenizer and the ProcessorMixin machinery, which is
+    wasted work per image. tokenize_with_images only reads the processor's
+    attributes (and encodes under _ENCODE_LOCK), so one instance serves all threads.
+    """
+    global _PROCESSOR
+    if _PROCESSOR is None:
+        with _PROCESSOR_LOCK:
+            if _PROCESSOR is None:
+                _PROCESSOR = DeepseekOCRProcessor()
+    return _PROCESSOR
@@ -37,4 +37,96 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
             for token in banned_tokens:
                 scores[token] = -float("inf")
         
-        return scores
\ No newline at end of file
+        return scores
+
+_HASH_MOD = (1 << 61) - 1
+_HASH_BASE = 1_000_003  # larger than the vocabulary
+
+
+class IncrementalNoRepeatNGramLogitsProcessor:
+    """Same bans as NoRepeatNGramLogitsProcessor, O(1) work per generated token.
+
+    Keeps, for one sequence, an index from the rolling hash of each (n-1)-token
+    prefix in the window to the counts of the tokens that followed it. Every
+    call adds the n-gram that entered the window and drops the one that left
+    it, then bans with one indexed write into scores (in place, no clone).
+
+    Stateful: one instance per sequence. vLLM clones logits processors that
+    have clone() for every request; a sequence that does not continue the
+    tokens seen so far (e.g. a reused instance) rebuilds the index.
+    """
+
+    def __init__(self, ngram_size: int, window_size: int = 100, whitelist_token_ids: set = None):
+        if not isinstance(ngram_size, int) or ngram_size <= 0:
+            raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
+        if not isinstance(window_size, int) or window_size <= 0:
+            raise ValueError(f"`window_size` has to be a strictly positive integer, but is {window_size}")
+        self.ngram_size = ngram_size
+        self.window_size = window_size
+        self.whitelist_token_ids = whitelist_token_ids or set()
+        self._shift = pow(_HASH_BASE, ngram_size - 1, _HASH_MOD)
+        self._reset()
+
+    def clone(self) -> "IncrementalNoRepeatNGramLogitsProcessor":
+        return IncrementalNoRepeatNGramLogitsProcessor(self.ngram_size, self.window_size, self.whitelist_token_ids)
+
+    def _reset(self):
+        self.tokens: List[int] = []
+        self._prefix_hash = [0]       # hash of tokens[:k]
+        self._index = {}              # prefix hash -> {next token: count}
+        self._start = self._end = 0   # n-gram start positions currently indexed
+
+    def _prefix_key(self, i: int) -> int:
+        """Hash of tokens[i:i + n - 1]"""
+        h = self._prefix_hash
+        return (h[i + self.ngram_size - 1] - h[i] * self._shift) % _HASH_MOD
+
+    def _add(self, i: int):
+        bucket = self._index.setdefault(self._prefix_key(i), {})
+        token = self.tokens[i + self.ngram_size - 1]
+        bucket[token] = bucket.get(token, 0) + 1
+
+    def _remove(self, i: int):
+        key = self._prefix_key(i)
+        bucket = self._index[key]
+        token = self.tokens[i + self.ngram_size - 1]
+        if bucket[token] > 1:
+            bucket[token] -= 1
+        else:
+            del bucket[token]
+            if not bucket:
+                del self._index[key]
+
+    def __call__(self, input_ids: List[int], scores: torch.FloatTensor) -> torch.FloatTensor:
+        known = len(self.tokens)
+        if len(input_ids) < known or (known and input_ids[known - 1] != self.tokens[-1]):
+            self._reset()
+            known = 0
+        for token in input_ids[known:]:
+            self.tokens.append(token)
+            self._prefix_hash.append((self._prefix_hash[-1] * _HASH_BASE + token + 1) % _HASH_MOD)
+
+        n = self.ngram_size
+        length = len(self.tokens)
+        # The reference compares the prefix with the whole sequence when n == 1, so it never bans
+        if length < n or n == 1:
+            return scores
+
+        # Slide the window of n-gram starts [length - window, length - n] one step
+        start = max(0, length - self.window_size)
+        end = length - n + 1
+        for i in range(self._start, min(self._end, start)):
+            self._remove(i)
+        self._start = max(self._start, start)
+        self._end = max(self._end, self._start)
+        for i in range(self._end, end):
+            self._add(i)
+        self._end = max(self._end, end)
+
+        bucket = self._index.get(self._prefix_key(length - n + 1))
+        if not bucket:
+            return scores
+        banned = [token for token in bucket if token not in self.whitelist_token_ids]
+        if banned:
+            scores[torch.tensor(banned, device=scores.device)] = -float("inf")
+        return scores
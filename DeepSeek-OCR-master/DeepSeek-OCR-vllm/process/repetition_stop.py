@@ -0,0 +1,37 @@
+import torch
+from typing import List, Optional, Sequence
+
+from backends.repetition import REPEAT_CHECK_EVERY, REPEAT_MAX_PERIOD, REPEAT_MIN_MATCH, REPEAT_WINDOW, periodic_tail
+
+
+class RepetitionStopLogitsProcessor:
+    """Forces EOS as soon as the generated tokens run into a repetition loop
+    (see backends/repetition.py), instead of looping until max_tokens.
+    Cut the finished output back to the loop's first cycle with repetition_cut()."""
+
+    def __init__(self, eos_token_id: int, window: int = REPEAT_WINDOW, max_period: int = REPEAT_MAX_PERIOD,
+                 min_match: float = REPEAT_MIN_MATCH, check_every: int = REPEAT_CHECK_EVERY):
+        self.eos_token_id = eos_token_id
+        self.window = window
+        self.max_period = max_period
+        self.min_match = min_match
+        self.check_every = check_every
+
+    def __call__(self, input_ids: List[int], scores: torch.FloatTensor) -> torch.FloatTensor:
+        # Stateless (shared by all sequences): check the tail every check_every tokens
+        if len(input_ids) <= self.window or len(input_ids) % self.check_every:
+            return scores
+        if periodic_tail(input_ids, self.window, self.max_period, self.min_match) is None:
+            return scores
+        forced = torch.full_like(scores, -float("inf"))
+        forced[self.eos_token_id] = 0
+        return forced
+
+
+def repetition_cut(token_ids: Sequence[int], eos_token_id: int) -> Optional[int]:
+    """Number of tokens to keep of an output the processor stopped; None if it did not loop"""
+    token_ids = list(token_ids)
+    if token_ids and token_ids[-1] == eos_token_id:
+        token_ids.pop()
+    found = periodic_tail(token_ids)
+    return found[1] if found is not None else None
@@ -17,9 +17,12 @@ from deepseek_ocr import DeepseekOCRForCausalLM
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import numpy as np
 from tqdm import tqdm
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from process.ngram_norepeat import IncrementalNoRepeatNGramLogitsProcessor
+from process.repetition_stop import RepetitionStopLogitsProcessor, repetition_cut
+from process.image_process import get_processor
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE, REPEAT_GUARD, get_tokenizer
 
 
 
@@ -159,7 +162,9 @@ async def stream_generate(image=None, prompt=''):
     )
     engine = AsyncLLMEngine.from_engine_args(engine_args)
     
-    logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td> 
+    logits_processors = [IncrementalNoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td> 
+    if REPEAT_GUARD:
+        logits_processors.append(RepetitionStopLogitsProcessor(get_tokenizer().eos_token_id))
 
     sampling_params = SamplingParams(
         temperature=0.0,
@@ -196,6 +201,14 @@ async def stream_generate(image=None, prompt=''):
             final_output = full_text
     print('\n') 
 
+    if REPEAT_GUARD:
+        token_ids = request_output.outputs[0].token_ids
+        cut = repetition_cut(token_ids, get_tokenizer().eos_token_id)
+        if cut is not None:
+            # stopped in a repetition loop: keep the text before the loop and its first cycle
+            print('repetition loop cut short')
+            final_output = get_tokenizer().decode(token_ids[:cut])
+
     return final_output
 
 
@@ -211,7 +224,7 @@ if __name__ == "__main__":
     
     if '<image>' in PROMPT:
 
-        image_features = DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
+        image_features = get_processor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)
     else:
         image_features = ''
 
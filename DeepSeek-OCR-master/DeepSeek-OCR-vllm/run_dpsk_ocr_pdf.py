@@ -14,7 +14,13 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, REPEAT_GUARD, TOKEN_BUDGET, get_tokenizer, IMAGE_SIZE, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE, TEXT_LAYER_POLICY, BLANK_PAGE_THRESHOLD
+
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from pdf_utils import text_layer_for_page, extract_page_image
+from image_stats import BLANK_SCREEN_PROMPT_TYPES, is_blank_page
+from token_budget import TOKEN_BUDGET_MAX, image_budget, next_budget
 
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
@@ -23,8 +29,9 @@ from deepseek_ocr import DeepseekOCRForCausalLM
 from vllm.model_executor.models.registry import ModelRegistry
 
 from vllm import LLM, SamplingParams
-from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.ngram_norepeat import IncrementalNoRepeatNGramLogitsProcessor
+from process.repetition_stop import RepetitionStopLogitsProcessor, repetition_cut
+from process.image_process import get_processor, count_tiles
 
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
@@ -43,15 +50,18 @@ llm = LLM(
     disable_mm_preprocessor_cache=True
 )
 
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
-
-sampling_params = SamplingParams(
-    temperature=0.0,
-    max_tokens=8192,
-    logits_processors=logits_processors,
-    skip_special_tokens=False,
-    include_stop_str_in_output=True,
-)
+logits_processors = [IncrementalNoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+if REPEAT_GUARD:
+    logits_processors.append(RepetitionStopLogitsProcessor(get_tokenizer().eos_token_id))
+
+def sampling_params_for(max_tokens=8192):
+    return SamplingParams(
+        temperature=0.0,
+        max_tokens=max_tokens,
+        logits_processors=logits_processors,
+        skip_special_tokens=False,
+        include_stop_str_in_output=True,
+    )
 
 
 class Colors:
@@ -74,9 +84,15 @@ def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
     
     for page_num in range(pdf_document.page_count):
         page = pdf_document[page_num]
+        Image.MAX_IMAGE_PIXELS = None
+
+        # scanned page: take the embedded image at native resolution, no rasterization
+        extracted = extract_page_image(pdf_document, page)
+        if extracted is not None:
+            images.append(extracted["image"])
+            continue
 
         pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
 
         if image_format.upper() == "PNG":
             img_data = pixmap.tobytes("png")
@@ -94,6 +110,63 @@ def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
     pdf_document.close()
     return images
 
+def prompt_type_of(prompt):
+    if 'Convert the document to markdown' in prompt:
+        return 'document'
+    if 'OCR this image' in prompt:
+        return 'ocr'
+    if 'Free OCR' in prompt:
+        return 'free'
+    return 'freeform'
+
+
+def page_tiles(image):
+    """local tiles the processor cuts for this page (0: global view only)"""
+    if not CROP_MODE or (image.size[0] <= 640 and image.size[1] <= 640):
+        return 0
+    cols, rows = count_tiles(image.size[0], image.size[1], image_size=IMAGE_SIZE)
+    return cols * rows
+
+
+def generate_with_budgets(batch_inputs, budgets):
+    """
+    llm.generate with a max_tokens per page; pages that stop on their budget
+    before EOS are generated again with a larger one
+    """
+    outputs = [None] * len(batch_inputs)
+    pending = list(range(len(batch_inputs)))
+    while pending:
+        results = llm.generate(
+            [batch_inputs[i] for i in pending],
+            sampling_params=[sampling_params_for(budgets[i]) for i in pending]
+        )
+        retry = []
+        for i, output in zip(pending, results):
+            outputs[i] = output
+            larger = next_budget(budgets[i])
+            if output.outputs[0].finish_reason == 'length' and larger is not None:
+                budgets[i] = larger
+                retry.append(i)
+        if retry:
+            print(f'{Colors.YELLOW}token budget exhausted on {len(retry)} pages, retrying with larger budgets{Colors.RESET}')
+        pending = retry
+    return outputs
+
+
+def pdf_text_layers(pdf_path, prompt, policy=TEXT_LAYER_POLICY):
+    """
+    per page: model-style text extracted from the embedded text layer, or None if the page needs OCR
+    """
+    prompt_type = prompt_type_of(prompt)
+    pdf_document = fitz.open(pdf_path)
+    layers = []
+    for page in pdf_document:
+        layer = text_layer_for_page(page, policy, prompt_type)
+        layers.append(layer['raw_text'] if layer is not None else None)
+    pdf_document.close()
+    return layers
+
+
 def pil_to_pdf_img2pdf(pil_images, output_path):
 
     if not pil_images:
@@ -225,7 +298,7 @@ def process_single_image(image):
     prompt_in = prompt
     cache_item = {
         "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+        "multi_modal_data": {"image": get_processor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
     }
     return cache_item
 
@@ -243,12 +316,27 @@ if __name__ == "__main__":
 
     prompt = PROMPT
 
+    # born-digital pages: take the embedded text layer, only OCR the rest
+    text_layers = pdf_text_layers(INPUT_PATH, prompt)
+    text_layer_count = sum(1 for layer in text_layers if layer is not None)
+
+    # blank separator pages / empty backsides: empty content, no sequence spent on them
+    blank_count = 0
+    if prompt_type_of(prompt) in BLANK_SCREEN_PROMPT_TYPES:
+        for idx, layer in enumerate(text_layers):
+            if layer is None and is_blank_page(images[idx], BLANK_PAGE_THRESHOLD)[0]:
+                text_layers[idx] = ''
+                blank_count += 1
+
+    ocr_indices = [idx for idx, layer in enumerate(text_layers) if layer is None]
+    print(f'{Colors.GREEN}text layer pages: {text_layer_count}, blank pages: {blank_count}, ocr pages: {len(ocr_indices)}{Colors.RESET}')
+
     # batch_inputs = []
 
     with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
         batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
+            executor.map(process_single_image, [images[idx] for idx in ocr_indices]),
+            total=len(ocr_indices),
             desc="Pre-processed images"
         ))
 
@@ -259,16 +347,31 @@ if __name__ == "__main__":
     #     cache_list = [
     #         {
     #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+    #             "multi_modal_data": {"image": get_processor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
     #         }
     #     ]
     #     batch_inputs.extend(cache_list)
 
 
-    outputs_list = llm.generate(
-        batch_inputs,
-        sampling_params=sampling_params
-    )
+    if TOKEN_BUDGET:
+        budgets = [image_budget(images[idx], prompt_type_of(prompt), page_tiles(images[idx])) for idx in ocr_indices]
+    else:
+        budgets = [TOKEN_BUDGET_MAX] * len(ocr_indices)
+    outputs_list = generate_with_budgets(batch_inputs, budgets) if batch_inputs else []
+
+    # (content, from_text_layer, truncated) per page, in page order; blank pages count as an empty text layer
+    page_contents = [(layer, True, False) for layer in text_layers]
+    for idx, output in zip(ocr_indices, outputs_list):
+        completion = output.outputs[0]
+        cut = repetition_cut(completion.token_ids, get_tokenizer().eos_token_id) if REPEAT_GUARD else None
+        if cut is None:
+            page_contents[idx] = (completion.text, False, False)
+        else:
+            # stopped in a repetition loop: keep the text before the loop and its first cycle
+            page_contents[idx] = (get_tokenizer().decode(completion.token_ids[:cut]), False, True)
+    truncated_count = sum(1 for _, _, truncated in page_contents if truncated)
+    if truncated_count:
+        print(f'{Colors.YELLOW}repetition loops cut short: {truncated_count} pages{Colors.RESET}')
 
 
     output_path = OUTPUT_PATH
@@ -283,10 +386,11 @@ if __name__ == "__main__":
     contents = ''
     draw_images = []
     jdx = 0
-    for output, img in zip(outputs_list, images):
-        content = output.outputs[0].text
+    for (content, from_text_layer, truncated), img in zip(page_contents, images):
 
-        if '<｜end▁of▁sentence｜>' in content: # repeat no eos
+        if from_text_layer or truncated:
+            pass
+        elif '<｜end▁of▁sentence｜>' in content: # repeat no eos
             content = content.replace('<｜end▁of▁sentence｜>', '')
         else:
             if SKIP_REPEAT:
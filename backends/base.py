@@ -0,0 +1,150 @@
+"""Backend contract shared by every inference backend.
+
+The web services only talk to backends through this interface: per-request
+GenerationOptions, single / batched / streaming inference, and a
+capabilities() descriptor they use to decide whether to batch PDF pages,
+stream text deltas or allow cancelling a running job.
+"""
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, fields
+from typing import Any, Dict, Generator, List, Optional
+
+MAX_NEW_TOKENS = 8192
+NO_REPEAT_NGRAM_SIZE = 20
+
+
+class GenerationCancelled(Exception):
+    """Raised inside a backend when options.cancel_event is set mid-generation"""
+
+
+class OCRText(str):
+    """A backend's result text, plus how generation ended.
+
+    truncated_repetition: the output ran into a repetition loop, generation
+    was stopped early and the loop was cut back to its first cycle.
+    hit_token_limit: max_new_tokens ran out before EOS (the text is cut off).
+    """
+    truncated_repetition = False
+    hit_token_limit = False
+
+    def __new__(cls, text: str, truncated_repetition: bool = False, hit_token_limit: bool = False):
+        result = super().__new__(cls, text)
+        result.truncated_repetition = truncated_repetition
+        result.hit_token_limit = hit_token_limit
+        return result
+
+
+@dataclass
+class GenerationOptions:
+    """Per-request generation and resolution settings (defaults = Gundam mode)"""
+    base_size: int = 1024
+    image_size: int = 640
+    crop_mode: bool = True
+    max_new_tokens: int = MAX_NEW_TOKENS
+    no_repeat_ngram_size: int = NO_REPEAT_NGRAM_SIZE
+    cancel_event: Optional[threading.Event] = None
+
+    @classmethod
+    def from_kwargs(cls, options: Optional["GenerationOptions"] = None, **kwargs) -> "GenerationOptions":
+        """Options from legacy infer(**kwargs) calls; unknown keys are ignored"""
+        if "max_tokens" in kwargs and "max_new_tokens" not in kwargs:
+            kwargs["max_new_tokens"] = kwargs.pop("max_tokens")
+        names = {f.name for f in fields(cls)}
+        values = {k: v for k, v in kwargs.items() if k in names and v is not None}
+        if options is None:
+            return cls(**values)
+        merged = {f.name: getattr(options, f.name) for f in fields(cls)}
+        merged.update(values)
+        return cls(**merged)
+
+    def engine_kwargs(self) -> Dict[str, Any]:
+        return {
+            "base_size": self.base_size,
+            "image_size": self.image_size,
+            "crop_mode": self.crop_mode,
+            "max_new_tokens": self.max_new_tokens,
+            "no_repeat_ngram_size": self.no_repeat_ngram_size,
+            "cancel_event": self.cancel_event,
+        }
+
+    def check_cancelled(self) -> None:
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise GenerationCancelled()
+
+
+class BaseBackend(ABC):
+    """infer() and load_model() are required; batch, multi-prompt and stream
+    default to sequential calls so every backend satisfies the full contract"""
+
+    model_path: str = ""
+    device: str = "cpu"
+
+    @abstractmethod
+    def load_model(self, *args, **kwargs) -> bool:
+        ...
+
+    @abstractmethod
+    def infer(self, prompt: str, image_path: str, options: Optional[GenerationOptions] = None, **kwargs) -> str:
+        ...
+
+    def infer_batch(self, prompts: List[str], image_paths: List[str],
+                    options: Optional[GenerationOptions] = None, **kwargs) -> List[str]:
+        """One prompt per image"""
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        results = []
+        for prompt, image_path in zip(prompts, image_paths):
+            options.check_cancelled()
+            results.append(self.infer(prompt, image_path, options))
+        return results
+
+    def infer_multi(self, prompts: List[str], image_path: str,
+                    options: Optional[GenerationOptions] = None, **kwargs) -> List[str]:
+        """Several prompts on one image"""
+        return self.infer_batch(prompts, [image_path] * len(prompts), options, **kwargs)
+
+    def infer_stream(self, prompt: str, image_path: str,
+                     options: Optional[GenerationOptions] = None,
+                     **kwargs) -> Generator[str, None, str]:
+        """Text deltas; backends without token streaming yield the whole result once.
+        The generator returns the final result (what infer() would return)."""
+        result = self.infer(prompt, image_path, options, **kwargs)
+        yield result
+        return result
+
+    def capabilities(self) -> Dict[str, Any]:
+        """Feature descriptor the web layer negotiates against"""
+        return {
+            "backend": type(self).__name__,
+            "max_batch": 1,
+            "max_concurrency": 1,  # calls the service may run at the same time
+            "streaming": False,
+            "cancel": False,
+            "multi_prompt": False,
+            "resolution_modes": True,
+            "memory_managed": False,  # the backend budgets its own device memory (no admission control)
+            "dtype": None,
+            "device": self.device,
+            "device_memory": device_memory(self.device),
+        }
+
+    @staticmethod
+    def is_available() -> bool:
+        return True
+
+
+def device_memory(device: str) -> Optional[Dict[str, float]]:
+    """Total / allocated memory of the backend's device in GB (None when unknown)"""
+    try:
+        import torch
+        if str(device).startswith("cuda") and torch.cuda.is_available():
+            index = torch.device(device).index or 0
+            return {
+                "total_gb": round(torch.cuda.get_device_properties(index).total_memory / 1024 ** 3, 2),
+                "allocated_gb": round(torch.cuda.memory_allocated(index) / 1024 ** 3, 2),
+            }
+        if device == "mps" and hasattr(torch, "mps") and hasattr(torch.mps, "current_allocated_memory"):
+            return {"allocated_gb": round(torch.mps.current_allocated_memory() / 1024 ** 3, 2)}
+    except Exception:
+        pass
+    return None
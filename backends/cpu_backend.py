@@ -1,62 +1,161 @@
-"""CPU Backend - Compatible with Linux/Mac without GPU"""
+"""CPU Backend - Compatible with Linux/Mac without GPU
+
+Precision is selected with CPU_PRECISION:
+- fp32: full precision (default)
+- bf16: bf16 weights, inference under CPU autocast (half the memory, uses
+  AVX512-BF16 / AMX on CPUs that have it)
+- int8: dynamic int8 quantization of the language model's linear layers;
+  the vision encoder and lm_head stay fp32
+
+Reduced-precision modes are checked at startup against fp32 output on a
+rendered text fixture and fall back to fp32 if the outputs diverge
+(CPU_PRECISION_CHECK=0 skips the check and the fp32 reference load).
+
+ONNX_VISION=1 runs the vision encoder on ONNX Runtime (backends/onnx_vision.py).
+"""
+import difflib
+import gc
+import os
+import tempfile
+
+from PIL import Image, ImageDraw
 from transformers import AutoProcessor, AutoModel
 import torch
 
-class CPUBackend:
-    def __init__(self, model_path: str = "deepseek-ai/DeepSeek-OCR"):
-        self.model_path = model_path
-        self.revision = "1e3401a3d4603e9e71ea0ec850bfead602191ec4"
-        self.model = None
-        self.processor = None
+from backends.hf_backend import DeepSeekHFBackend
+from backends.onnx_vision import OnnxVisionEncoder
+from backends.prefix_cache import get_prefix_cache
+from backends.vision_cache import get_vision_cache
+
+CPU_PRECISIONS = ("fp32", "bf16", "int8")
+CPU_PRECISION = os.environ.get("CPU_PRECISION", "fp32").lower()
+CPU_PRECISION_CHECK = os.environ.get("CPU_PRECISION_CHECK", "1") != "0"
+# Min similarity (difflib ratio) between fp32 and reduced-precision fixture output
+CPU_PRECISION_MIN_SIMILARITY = float(os.environ.get("CPU_PRECISION_MIN_SIMILARITY", "0.9"))
+PRECISION_CHECK_PROMPT = "<image>\nFree OCR. "
+PRECISION_CHECK_TOKENS = 128
+PRECISION_CHECK_LINES = (
+    "Invoice No. 2024-0117",
+    "Total amount due: 1,284.50 EUR",
+    "The quick brown fox jumps over the lazy dog.",
+)
+
+
+def render_precision_fixture(path: str) -> None:
+    """A small page with a few lines of known text"""
+    img = Image.new("RGB", (640, 640), "white")
+    draw = ImageDraw.Draw(img)
+    for i, line in enumerate(PRECISION_CHECK_LINES):
+        draw.text((40, 60 + i * 60), line, fill="black")
+    img.save(path)
+
+
+class CPUBackend(DeepSeekHFBackend):
+    def __init__(self, model_path: str = "deepseek-ai/DeepSeek-OCR", precision: str = CPU_PRECISION):
+        super().__init__(model_path)
         self.device = "cpu"
-        
+        self.precision = precision
+
+    def _load_weights(self, dtype: torch.dtype):
+        self.model = None
+        self.engine = None
+        gc.collect()
+        self.model = AutoModel.from_pretrained(
+            self.model_path,
+            revision=self.revision,
+            trust_remote_code=True,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True
+        ).to(self.device)
+        self.model.eval()
+
+    def _apply_precision(self, precision: str):
+        """Convert the loaded fp32 model in place"""
+        if precision == "bf16":
+            self.model.to(torch.bfloat16)
+            self.autocast_dtype = torch.bfloat16
+        elif precision == "int8":
+            # Decoder layers only: lm_head and the vision stack keep fp32
+            torch.ao.quantization.quantize_dynamic(
+                self.model.model.layers, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        self.engine = None
+        # Embeddings and KV state computed at the old precision are not reusable
+        get_vision_cache().clear()
+        get_prefix_cache().clear()
+
+    def _fixture_output(self, fixture_path: str) -> str:
+        return self.infer(PRECISION_CHECK_PROMPT, fixture_path, max_new_tokens=PRECISION_CHECK_TOKENS)
+
     def load_model(self):
         """Load model on CPU"""
         try:
-            print(f"📦 Loading DeepSeek-OCR on CPU")
-            
+            precision = self.precision
+            if precision not in CPU_PRECISIONS:
+                print(f"⚠️ Unknown CPU_PRECISION '{precision}', using fp32")
+                precision = "fp32"
+            print(f"📦 Loading DeepSeek-OCR on CPU ({precision})")
+
             self.processor = AutoProcessor.from_pretrained(
                 self.model_path,
                 revision=self.revision,
                 trust_remote_code=True
             )
-            
-            self.model = AutoModel.from_pretrained(
-                self.model_path,
-                revision=self.revision,
-                trust_remote_code=True,
-                torch_dtype=torch.float32,
-                low_cpu_mem_usage=True
-            ).to(self.device)
-            
-            self.model.eval()
-            print(f"✅ Model loaded on {self.device}")
+
+            if precision == "bf16" and not CPU_PRECISION_CHECK:
+                # No fp32 reference needed: load bf16 directly (half the peak memory)
+                self._load_weights(torch.bfloat16)
+                self.autocast_dtype = torch.bfloat16
+                self.vision_encoder = OnnxVisionEncoder.create(self.model, self.model_path, self.revision)
+            else:
+                self._load_weights(torch.float32)
+                # Export (if needed) while the vision weights are still fp32
+                self.vision_encoder = OnnxVisionEncoder.create(self.model, self.model_path, self.revision)
+                if precision != "fp32":
+                    precision = self._switch_precision(precision)
+
+            self.precision = precision
+            print(f"✅ Model loaded on {self.device} ({precision})")
             return True
-            
+
         except Exception as e:
             print(f"❌ Model loading failed: {e}")
             raise
-    
-    def infer(self, prompt: str, image_path: str, **kwargs) -> str:
-        """Run inference on CPU"""
+
+    def _switch_precision(self, precision: str) -> str:
+        """Apply a reduced precision, verified against fp32 on the fixture.
+        Returns the precision actually in use."""
+        if not CPU_PRECISION_CHECK:
+            self._apply_precision(precision)
+            return precision
+
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp:
+            fixture_path = tmp.name
         try:
-            result = self.model.infer(
-                tokenizer=self.processor,
-                prompt=prompt,
-                image_file=image_path,
-                output_path='./output',
-                base_size=1024,
-                image_size=640,
-                crop_mode=True,
-                test_compress=False,
-                save_results=False,
-                eval_mode=True
-            )
-            return result if result else ""
-        except Exception as e:
-            print(f"❌ Inference failed: {e}")
-            raise
-    
+            render_precision_fixture(fixture_path)
+            reference = self._fixture_output(fixture_path)
+            self._apply_precision(precision)
+            output = self._fixture_output(fixture_path)
+        finally:
+            os.remove(fixture_path)
+
+        similarity = difflib.SequenceMatcher(None, reference, output).ratio() if (reference or output) else 1.0
+        if similarity >= CPU_PRECISION_MIN_SIMILARITY:
+            print(f"✅ {precision} sanity check passed (similarity {similarity:.3f})")
+            return precision
+
+        print(f"⚠️ {precision} output diverges from fp32 (similarity {similarity:.3f}), falling back to fp32")
+        self.autocast_dtype = None
+        self._load_weights(torch.float32)
+        get_vision_cache().clear()
+        get_prefix_cache().clear()
+        return "fp32"
+
+    def capabilities(self) -> dict:
+        caps = super().capabilities()
+        caps["precision"] = self.precision
+        return caps
+
     @staticmethod
     def is_available() -> bool:
         """CPU is always available"""
@@ -3,12 +3,12 @@ import os
 from transformers import AutoProcessor, AutoModel
 import torch
 
-class CUDABackend:
+from backends.hf_backend import DeepSeekHFBackend
+
+class CUDABackend(DeepSeekHFBackend):
     def __init__(self, model_path: str = "deepseek-ai/DeepSeek-OCR"):
-        self.model_path = model_path
-        self.revision = "1e3401a3d4603e9e71ea0ec850bfead602191ec4"  # MPS support commit
-        self.model = None
-        self.processor = None
+        super().__init__(model_path)
+        self.device = "cuda"
         
     @staticmethod
     def get_optimal_dtype():
@@ -72,26 +72,6 @@ class CUDABackend:
             print(f"❌ Model loading failed: {e}")
             raise
     
-    def infer(self, prompt: str, image_path: str, **kwargs) -> str:
-        """Run inference on CUDA"""
-        try:
-            result = self.model.infer(
-                tokenizer=self.processor,
-                prompt=prompt,
-                image_file=image_path,
-                output_path='./output',
-                base_size=1024,
-                image_size=640,
-                crop_mode=True,
-                test_compress=False,
-                save_results=False,
-                eval_mode=True
-            )
-            return result if result else ""
-        except Exception as e:
-            print(f"❌ Inference failed: {e}")
-            raise
-    
     @staticmethod
     def is_available() -> bool:
         """Check if CUDA is available"""
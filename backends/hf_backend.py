@@ -0,0 +1,138 @@
+"""Shared inference code for the HF DeepSeek-OCR backends (CPU / CUDA / MPS).
+
+Subclasses only implement load_model(); inference goes through the native
+engine when the loaded model supports it and falls back to model.infer().
+"""
+import contextlib
+import os
+from typing import Any, Dict, Generator, List, Optional
+
+import torch
+
+from backends.base import BaseBackend, GenerationOptions, OCRText
+from backends.ocr_engine import DeepSeekOCREngine
+from backends.repetition import truncate_repetition
+
+# Upper bound for pages / prompts decoded together by the native engine
+MAX_INFER_BATCH = int(os.environ.get("MAX_INFER_BATCH", "4"))
+
+
+class DeepSeekHFBackend(BaseBackend):
+    revision = "1e3401a3d4603e9e71ea0ec850bfead602191ec4"  # MPS support commit
+    # Autocast dtype for reduced-precision weights (None = run in the weights' dtype)
+    autocast_dtype: Optional[torch.dtype] = None
+    # Replacement for the PyTorch vision stack (see backends/onnx_vision.py)
+    vision_encoder = None
+
+    def __init__(self, model_path: str = "deepseek-ai/DeepSeek-OCR"):
+        self.model_path = model_path
+        self.model = None
+        self.processor = None
+        self.engine = None
+
+    @property
+    def cache_key(self) -> str:
+        """First element of this model's vision / prefix cache keys"""
+        return f"{self.model_path}@{self.revision}"
+
+    def get_engine(self):
+        """Native engine for the current model (None -> model.infer)"""
+        if self.engine is None or self.engine.model is not self.model:
+            # Cache keys include the revision: variants of one repo share the vision / prefix caches
+            self.engine = DeepSeekOCREngine.create(self.model, self.processor, self.cache_key)
+        if self.engine is not None:
+            self.engine.autocast_dtype = self.autocast_dtype
+            self.engine.vision_encoder = self.vision_encoder
+        return self.engine
+
+    def autocast(self):
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device, dtype=self.autocast_dtype)
+
+    def _remote_infer(self, prompt: str, image_path: str, options: GenerationOptions) -> OCRText:
+        # Use model's built-in infer method with eval_mode=True to get return value
+        with self.autocast():
+            result = self.model.infer(
+                tokenizer=self.processor,
+                prompt=prompt,
+                image_file=image_path,
+                output_path='./output',
+                base_size=options.base_size,
+                image_size=options.image_size,
+                crop_mode=options.crop_mode,
+                test_compress=False,
+                save_results=False,
+                eval_mode=True
+            )
+        # model.infer's decode loop cannot be stopped early; still cut a looping tail
+        return OCRText(*truncate_repetition(result if result else ""))
+
+    def infer(self, prompt: str, image_path: str, options: Optional[GenerationOptions] = None, **kwargs) -> str:
+        """Run inference"""
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        try:
+            engine = self.get_engine()
+            if engine is not None:
+                return engine.infer(prompt, image_path, **options.engine_kwargs())
+            options.check_cancelled()
+            return self._remote_infer(prompt, image_path, options)
+        except Exception as e:
+            print(f"❌ Inference failed: {e}")
+            raise
+
+    def infer_batch(self, prompts: List[str], image_paths: List[str],
+                    options: Optional[GenerationOptions] = None, **kwargs) -> List[str]:
+        """One prompt per image, decoded together in chunks of MAX_INFER_BATCH"""
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        engine = self.get_engine()
+        if engine is None:
+            return super().infer_batch(prompts, image_paths, options)
+        try:
+            results = []
+            for start in range(0, len(prompts), MAX_INFER_BATCH):
+                results.extend(engine.infer_batch(prompts[start:start + MAX_INFER_BATCH],
+                                                  image_paths[start:start + MAX_INFER_BATCH],
+                                                  **options.engine_kwargs()))
+            return results
+        except Exception as e:
+            print(f"❌ Inference failed: {e}")
+            raise
+
+    def infer_multi(self, prompts: List[str], image_path: str,
+                    options: Optional[GenerationOptions] = None, **kwargs) -> List[str]:
+        """Several prompts on one image; the engine encodes and prefills the image once"""
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        engine = self.get_engine()
+        if engine is None:
+            return super().infer_multi(prompts, image_path, options)
+        try:
+            return engine.infer_multi(prompts, image_path, **options.engine_kwargs())
+        except Exception as e:
+            print(f"❌ Inference failed: {e}")
+            raise
+
+    def infer_stream(self, prompt: str, image_path: str,
+                     options: Optional[GenerationOptions] = None,
+                     **kwargs) -> Generator[str, None, str]:
+        """Text deltas as they are decoded (one chunk on the model.infer fallback)"""
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        engine = self.get_engine()
+        if engine is None:
+            return (yield from super().infer_stream(prompt, image_path, options))
+        return (yield from engine.infer_stream(prompt, image_path, **options.engine_kwargs()))
+
+    def capabilities(self) -> Dict[str, Any]:
+        caps = super().capabilities()
+        engine = self.get_engine() if self.model is not None else None
+        if engine is not None:
+            caps.update({
+                "max_batch": MAX_INFER_BATCH,
+                "streaming": True,
+                "cancel": True,
+                "multi_prompt": True,
+            })
+        if self.model is not None:
+            caps["dtype"] = str(next(self.model.parameters()).dtype).replace("torch.", "")
+        caps["engine"] = "native" if engine is not None else "remote"
+        return caps
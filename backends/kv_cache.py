@@ -0,0 +1,209 @@
+"""Preallocated KV caches for the native engine's decode loop.
+
+DynamicCache.update() concatenates every step, so each generated token copies
+the whole cache of every layer and allocates a new tensor: per-token latency
+grows with the sequence and the allocator churns. PreallocatedCache replaces
+it: buffers sized to the prompt plus the token budget (capped at
+KV_PREALLOC_TOKENS, doubling beyond), written in place; update() returns views
+of the filled part, so it works with any decoder that uses the Cache API
+(including the remote DeepSeek code).
+
+Buffers are returned to a process-wide pool after a request and
+reused by the next one with the same shape, bounded by KV_POOL_MB.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import torch
+from transformers import DynamicCache
+
+KV_POOL_MB = int(os.environ.get("KV_POOL_MB", "1024"))
+# Capacities are rounded up to this many tokens so requests share buffer shapes
+KV_BLOCK_TOKENS = 256
+
+
+def round_capacity(tokens: int) -> int:
+    return -(-tokens // KV_BLOCK_TOKENS) * KV_BLOCK_TOKENS
+
+
+class KVBufferPool:
+    """Free KV buffers by (shape, dtype, device); least recently returned are dropped first"""
+
+    def __init__(self, max_bytes: int = KV_POOL_MB << 20):
+        self.max_bytes = max_bytes
+        self._free: "OrderedDict[int, Tuple[Hashable, Any, int]]" = OrderedDict()
+        self._next_id = 0
+        self._used = 0
+        self._lock = threading.Lock()
+        self.reuses = 0
+        self.allocations = 0
+
+    def _take(self, key: Hashable):
+        with self._lock:
+            for item_id, (item_key, item, nbytes) in self._free.items():
+                if item_key == key:
+                    del self._free[item_id]
+                    self._used -= nbytes
+                    self.reuses += 1
+                    return item
+            self.allocations += 1
+            return None
+
+    def _give(self, key: Hashable, item, nbytes: int) -> None:
+        with self._lock:
+            if nbytes > self.max_bytes:
+                return
+            while self._free and self._used + nbytes > self.max_bytes:
+                _, (_, _, old_bytes) = self._free.popitem(last=False)
+                self._used -= old_bytes
+            self._free[self._next_id] = (key, item, nbytes)
+            self._next_id += 1
+            self._used += nbytes
+
+    def acquire_tensor(self, shape: Tuple[int, ...], dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        """Uninitialized buffer; callers only read what they wrote"""
+        tensor = self._take(("tensor", tuple(shape), dtype, str(device)))
+        return tensor if tensor is not None else torch.empty(shape, dtype=dtype, device=device)
+
+    def release_tensor(self, tensor: torch.Tensor) -> None:
+        self._give(("tensor", tuple(tensor.shape), tensor.dtype, str(tensor.device)), tensor,
+                   tensor.numel() * tensor.element_size())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._free.clear()
+            self._used = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "free_buffers": len(self._free),
+                "mb": round(self._used / (1 << 20), 1),
+                "max_mb": round(self.max_bytes / (1 << 20), 1),
+                "reuses": self.reuses,
+                "allocations": self.allocations,
+            }
+
+
+_kv_pool: Optional[KVBufferPool] = None
+
+
+def get_kv_pool() -> KVBufferPool:
+    global _kv_pool
+    if _kv_pool is None:
+        _kv_pool = KVBufferPool()
+    return _kv_pool
+
+
+class PreallocatedCache(DynamicCache):
+    """DynamicCache with per-layer buffers of a fixed token capacity.
+
+    update() writes new keys / values in place and returns views of the filled
+    part, so shapes seen by the model are the same as with DynamicCache.
+    Exceeding the capacity falls back to growing the buffer (one copy).
+    """
+
+    def __init__(self, capacity: int, pool: Optional[KVBufferPool] = None):
+        super().__init__()
+        self.capacity = round_capacity(capacity)
+        self.pool = pool if pool is not None else get_kv_pool()
+        self._key_buffers: List[torch.Tensor] = []
+        self._value_buffers: List[torch.Tensor] = []
+        self._owned: List[torch.Tensor] = []  # full pooled buffers, returned on release()
+        self._lengths: List[int] = []
+
+    @classmethod
+    def from_prefixes(cls, prefixes: List[DynamicCache], capacity: int,
+                      pool: Optional[KVBufferPool] = None) -> Tuple["PreallocatedCache", List[int]]:
+        """Batch of prefix caches, one per row, left-padded to the longest.
+        Returns (cache, prefix length per row); padding slots are zero."""
+        lengths = [p.get_seq_length() for p in prefixes]
+        width = max(lengths)
+        cache = cls(max(capacity, width), pool)
+        batch = len(prefixes)
+        for layer in range(len(prefixes[0].key_cache)):
+            for which, buffers in ((0, cache._key_buffers), (1, cache._value_buffers)):
+                first = (prefixes[0].key_cache if which == 0 else prefixes[0].value_cache)[layer]
+                _, heads, _, dim = first.shape
+                buffer = cache._allocate((batch, heads, cache.capacity, dim), first.dtype, first.device)
+                buffer[:, :, :width].zero_()
+                for row, prefix in enumerate(prefixes):
+                    source = (prefix.key_cache if which == 0 else prefix.value_cache)[layer]
+                    buffer[row, :, width - lengths[row]:width] = source[0]
+                buffers.append(buffer)
+            cache._lengths.append(width)
+        cache._refresh_views()
+        cache._seen_tokens = width
+        return cache, lengths
+
+    def _allocate(self, shape, dtype, device) -> torch.Tensor:
+        buffer = self.pool.acquire_tensor(shape, dtype, device)
+        self._owned.append(buffer)
+        return buffer
+
+    def _refresh_views(self) -> None:
+        self.key_cache = [b[:, :, :n] for b, n in zip(self._key_buffers, self._lengths)]
+        self.value_cache = [b[:, :, :n] for b, n in zip(self._value_buffers, self._lengths)]
+
+    def _grow(self, layer_idx: int, needed: int) -> None:
+        capacity = round_capacity(max(needed, 2 * self._key_buffers[layer_idx].shape[2]))
+        for buffers in (self._key_buffers, self._value_buffers):
+            old = buffers[layer_idx]
+            new = old.new_empty((old.shape[0], old.shape[1], capacity, old.shape[3]))
+            new[:, :, :self._lengths[layer_idx]] = old[:, :, :self._lengths[layer_idx]]
+            buffers[layer_idx] = new
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int,
+               cache_kwargs: Optional[Dict[str, Any]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        if layer_idx >= len(self._key_buffers):
+            # First write to this layer (cache not built from a prefix)
+            batch, heads, _, dim = key_states.shape
+            self._key_buffers.append(self._allocate((batch, heads, self.capacity, dim), key_states.dtype,
+                                                    key_states.device))
+            self._value_buffers.append(self._allocate((batch, value_states.shape[1], self.capacity,
+                                                       value_states.shape[3]), value_states.dtype,
+                                                      value_states.device))
+            self._lengths.append(0)
+            self.key_cache.append(None)
+            self.value_cache.append(None)
+
+        start = self._lengths[layer_idx]
+        end = start + key_states.shape[-2]
+        if end > self._key_buffers[layer_idx].shape[2]:
+            self._grow(layer_idx, end)
+        self._key_buffers[layer_idx][:, :, start:end] = key_states
+        self._value_buffers[layer_idx][:, :, start:end] = value_states
+        self._lengths[layer_idx] = end
+        self.key_cache[layer_idx] = self._key_buffers[layer_idx][:, :, :end]
+        self.value_cache[layer_idx] = self._value_buffers[layer_idx][:, :, :end]
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        if layer_idx >= len(self._lengths):
+            return 0
+        return self._lengths[layer_idx]
+
+    def select_rows(self, index: torch.Tensor) -> None:
+        """Keep only the given batch rows (finished sequences dropped), compacted in place"""
+        for buffers in (self._key_buffers, self._value_buffers):
+            for i, buffer in enumerate(buffers):
+                n = self._lengths[i]
+                kept = buffer[:, :, :n].index_select(0, index)
+                buffer[:len(index), :, :n] = kept
+                buffers[i] = buffer[:len(index)]
+        self._refresh_views()
+
+    def release(self) -> None:
+        """Return the buffers to the pool; the cache must not be used afterwards"""
+        for buffer in self._owned:
+            self.pool.release_tensor(buffer)
+        self._owned = []
+        self._key_buffers = []
+        self._value_buffers = []
+        self._lengths = []
+        self.key_cache = []
+        self.value_cache = []
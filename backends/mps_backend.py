@@ -4,12 +4,11 @@ from transformers import AutoProcessor, AutoModel
 import torch
 import platform
 
-class MPSBackend:
+from backends.hf_backend import DeepSeekHFBackend
+
+class MPSBackend(DeepSeekHFBackend):
     def __init__(self, model_path: str = "deepseek-ai/DeepSeek-OCR"):
-        self.model_path = model_path
-        self.revision = "1e3401a3d4603e9e71ea0ec850bfead602191ec4"  # MPS support
-        self.model = None
-        self.processor = None
+        super().__init__(model_path)
         self.device = "mps"
         
     def load_model(self):
@@ -40,29 +39,6 @@ class MPSBackend:
             print(f"❌ Model loading failed: {e}")
             raise
     
-    def infer(self, prompt: str, image_path: str, **kwargs) -> str:
-        """Run inference using model's infer method"""
-        try:
-            # Use model's built-in infer method with eval_mode=True to get return value
-            result = self.model.infer(
-                tokenizer=self.processor,
-                prompt=prompt,
-                image_file=image_path,
-                output_path='./output',
-                base_size=1024,
-                image_size=640,
-                crop_mode=True,
-                test_compress=False,
-                save_results=False,
-                eval_mode=True  # Important: enables return value
-            )
-            
-            return result if result else ""
-            
-        except Exception as e:
-            print(f"❌ Inference failed: {e}")
-            raise
-    
     @staticmethod
     def is_available() -> bool:
         """Check if MPS is available"""
@@ -0,0 +1,564 @@
+"""Native inference path for the HF DeepSeek-OCR model.
+
+`model.infer()` from the remote code preprocesses, encodes and decodes in one
+call, so nothing can be reused between calls on the same image. This engine
+reimplements the same steps on top of the loaded model's modules:
+
+    preprocess (global view + dynamic tiles)  ->  vision encoder
+    (SAM -> CLIP -> projector, cached per image)  ->  language-model prefill
+    of [bos] + image tokens (KV cached per image)  ->  prefill of the prompt
+    text  ->  greedy decode with a preallocated KV cache (batched across
+    prompts and pages)
+
+Output matches `model.infer(..., eval_mode=True)`. Backends fall back to
+`model.infer()` when the loaded model does not have the expected layout or
+when OCR_ENGINE=remote.
+"""
+import contextlib
+import hashlib
+import math
+import os
+import threading
+from queue import Queue
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+from backends.base import MAX_NEW_TOKENS, NO_REPEAT_NGRAM_SIZE, GenerationCancelled, OCRText
+from backends.kv_cache import PreallocatedCache, get_kv_pool
+from backends.prefix_cache import PrefixEntry, PrefixKVCache, get_prefix_cache
+from backends.repetition import REPEAT_GUARD, RepetitionDetector
+from backends.vision_cache import VisionEmbeddingCache, get_vision_cache
+
+OCR_ENGINE = os.environ.get("OCR_ENGINE", "native").lower()  # native | remote
+
+IMAGE_TOKEN = "<image>"
+IMAGE_TOKEN_ID = 128815  # fallback when the tokenizer does not know <image>
+STOP_STR = "<｜end▁of▁sentence｜>"
+PATCH_SIZE = 16
+DOWNSAMPLE_RATIO = 4
+IMAGE_MEAN = (0.5, 0.5, 0.5)
+IMAGE_STD = (0.5, 0.5, 0.5)
+MIN_CROPS = 2
+MAX_CROPS = int(os.environ.get("MAX_CROPS", "6"))
+# Generated-token capacity preallocated per request; the cache doubles beyond it
+KV_PREALLOC_TOKENS = int(os.environ.get("KV_PREALLOC_TOKENS", "2048"))
+
+
+def load_image(image_path: str) -> Image.Image:
+    with Image.open(image_path) as img:
+        return ImageOps.exif_transpose(img).convert("RGB")
+
+
+def image_to_tensor(img: Image.Image) -> torch.Tensor:
+    """ToTensor + Normalize(mean, std) -> [3, H, W] float32"""
+    x = torch.from_numpy(np.asarray(img, dtype=np.float32) / 255.0).permute(2, 0, 1)
+    mean = torch.tensor(IMAGE_MEAN).view(3, 1, 1)
+    std = torch.tensor(IMAGE_STD).view(3, 1, 1)
+    return (x - mean) / std
+
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    return best_ratio
+
+
+def crop_grid(width: int, height: int, min_num: int = MIN_CROPS, max_num: int = MAX_CROPS,
+              image_size: int = 640) -> Tuple[int, int]:
+    """(cols, rows) of the tile grid closest to the image's aspect ratio"""
+    target_ratios = sorted(
+        set((i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1)
+            if min_num <= i * j <= max_num),
+        key=lambda x: x[0] * x[1])
+    return find_closest_aspect_ratio(width / height, target_ratios, width, height, image_size)
+
+
+def count_tiles(width: int, height: int, base_size: int = 1024, image_size: int = 640,
+                crop_mode: bool = True) -> int:
+    """Local tiles prepare_image() cuts for an image of this size (0 = global view only)"""
+    if not crop_mode or (width <= 640 and height <= 640):
+        return 0
+    cols, rows = crop_grid(width, height, image_size=image_size)
+    return cols * rows if cols > 1 or rows > 1 else 0
+
+
+def dynamic_preprocess(image: Image.Image, min_num: int = MIN_CROPS, max_num: int = MAX_CROPS,
+                       image_size: int = 640) -> Tuple[List[Image.Image], Tuple[int, int]]:
+    """Split an image into image_size tiles on the grid closest to its aspect ratio"""
+    ratio = crop_grid(image.size[0], image.size[1], min_num, max_num, image_size)
+
+    target_width, target_height = image_size * ratio[0], image_size * ratio[1]
+    resized = image.resize((target_width, target_height))
+    cols = target_width // image_size
+    tiles = []
+    for i in range(ratio[0] * ratio[1]):
+        x, y = (i % cols) * image_size, (i // cols) * image_size
+        tiles.append(resized.crop((x, y, x + image_size, y + image_size)))
+    return tiles, ratio
+
+
+def num_image_tokens(base_size: int, image_size: int, crop_ratio: Tuple[int, int], crop_mode: bool) -> int:
+    """Length of the image token run for one image (rows of queries + newline, + separator)"""
+    if not crop_mode:
+        q = math.ceil((image_size // PATCH_SIZE) / DOWNSAMPLE_RATIO)
+        return (q + 1) * q + 1
+    q_base = math.ceil((base_size // PATCH_SIZE) / DOWNSAMPLE_RATIO)
+    count = (q_base + 1) * q_base + 1
+    w, h = crop_ratio
+    if w > 1 or h > 1:
+        q = math.ceil((image_size // PATCH_SIZE) / DOWNSAMPLE_RATIO)
+        count += (q * w + 1) * (q * h)
+    return count
+
+
+class NoRepeatNGram:
+    """Incremental no_repeat_ngram_size: bans any token that would repeat an n-gram
+    already present in the sequence (same rule as transformers' processor, O(1) per step)"""
+
+    def __init__(self, n: int, tokens: List[int]):
+        self.n = n
+        self.tokens: List[int] = []
+        self.seen: Dict[Tuple[int, ...], set] = {}
+        for token in tokens:
+            self.append(token)
+
+    def append(self, token: int) -> None:
+        self.tokens.append(token)
+        if self.n > 0 and len(self.tokens) >= self.n:
+            gram = tuple(self.tokens[-self.n:])
+            self.seen.setdefault(gram[:-1], set()).add(gram[-1])
+
+    def banned(self) -> List[int]:
+        if self.n <= 0 or len(self.tokens) < self.n - 1:
+            return []
+        prefix = tuple(self.tokens[len(self.tokens) - self.n + 1:]) if self.n > 1 else ()
+        return list(self.seen.get(prefix, ()))
+
+
+class DeepSeekOCREngine:
+    def __init__(self, model, processor, model_key: str = "deepseek-ai/DeepSeek-OCR",
+                 cache: Optional[VisionEmbeddingCache] = None, prefix_cache: Optional[PrefixKVCache] = None):
+        self.model = model
+        self.tokenizer = getattr(processor, "tokenizer", processor)
+        self.model_key = model_key
+        self.cache = cache if cache is not None else get_vision_cache()
+        self.prefix_cache = prefix_cache if prefix_cache is not None else get_prefix_cache()
+
+        token_id = self.tokenizer.convert_tokens_to_ids(IMAGE_TOKEN)
+        unk = getattr(self.tokenizer, "unk_token_id", None)
+        self.image_token_id = token_id if isinstance(token_id, int) and token_id != unk else IMAGE_TOKEN_ID
+        self.bos_id = self.tokenizer.bos_token_id if self.tokenizer.bos_token_id is not None else 0
+        self.eos_id = self.tokenizer.eos_token_id
+        # Set by the backend for reduced-precision weights (e.g. bf16 on CPU)
+        self.autocast_dtype: Optional[torch.dtype] = None
+        # Optional out-of-process vision encoder (ONNX Runtime on CPU); None = PyTorch
+        self.vision_encoder = None
+        self.kv_pool = get_kv_pool()
+
+    @staticmethod
+    def supports(model) -> bool:
+        """True if the loaded model exposes the modules this engine drives"""
+        inner = getattr(model, "model", None)
+        return (
+            inner is not None
+            and hasattr(model, "lm_head")
+            and all(hasattr(inner, name) for name in
+                    ("sam_model", "vision_model", "projector", "image_newline", "view_seperator", "embed_tokens"))
+        )
+
+    @classmethod
+    def create(cls, model, processor, model_key: str = "deepseek-ai/DeepSeek-OCR") -> Optional["DeepSeekOCREngine"]:
+        """Engine for model, or None to use model.infer()"""
+        if OCR_ENGINE == "remote" or model is None or not cls.supports(model):
+            return None
+        return cls(model, processor, model_key)
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.lm_head.weight.device
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.model.lm_head.weight.dtype
+
+    def autocast(self):
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype)
+
+    # ---------- vision ----------
+
+    def prepare_image(self, image: Image.Image, base_size: int, image_size: int, crop_mode: bool) -> Dict[str, Any]:
+        """Global view and local tiles as normalized tensors (the model.infer preprocessing)"""
+        pad_color = tuple(int(x * 255) for x in IMAGE_MEAN)
+        tiles = None
+        crop_ratio = (1, 1)
+        if crop_mode:
+            if image.size[0] > 640 or image.size[1] > 640:
+                tile_images, crop_ratio = dynamic_preprocess(image, image_size=image_size)
+                if crop_ratio[0] > 1 or crop_ratio[1] > 1:
+                    tiles = torch.stack([image_to_tensor(t) for t in tile_images])
+            global_view = ImageOps.pad(image, (base_size, base_size), color=pad_color)
+        else:
+            if image_size <= 640:
+                image = image.resize((image_size, image_size))
+            global_view = ImageOps.pad(image, (image_size, image_size), color=pad_color)
+        return {
+            "global_view": image_to_tensor(global_view).unsqueeze(0),
+            "tiles": tiles,
+            "crop_ratio": crop_ratio,
+            "num_tokens": num_image_tokens(base_size, image_size, crop_ratio, crop_mode),
+        }
+
+    def _view_features(self, views: torch.Tensor) -> torch.Tensor:
+        """SAM -> CLIP -> projector for a stack of views: [N, 3, H, W] -> [N, h*w, D]"""
+        if self.vision_encoder is not None:
+            features = self.vision_encoder.features(views)
+            if features is not None:
+                return features.to(self.device, self.dtype)
+        inner = self.model.model
+        sam_features = inner.sam_model(views)
+        clip_features = inner.vision_model(views, sam_features)
+        features = torch.cat((clip_features[:, 1:], sam_features.flatten(2).permute(0, 2, 1)), dim=-1)
+        return inner.projector(features)
+
+    def _encode_prepared(self, prepared: Dict[str, Any]) -> torch.Tensor:
+        """Image embedding sequence in the layout of the image token run: [T, D]"""
+        inner = self.model.model
+        views = prepared["global_view"].to(self.device, self.dtype)
+        global_features = self._view_features(views)
+        _, hw, dim = global_features.shape
+        h = w = int(hw ** 0.5)
+        global_features = torch.cat(
+            [global_features.view(h, w, dim), inner.image_newline[None, None, :].expand(h, 1, dim)], dim=1
+        ).view(-1, dim)
+
+        if prepared["tiles"] is None:
+            return torch.cat([global_features, inner.view_seperator[None, :]], dim=0)
+
+        local_features = self._view_features(prepared["tiles"].to(self.device, self.dtype))
+        _, hw2, dim2 = local_features.shape
+        h2 = w2 = int(hw2 ** 0.5)
+        width_crop_num, height_crop_num = prepared["crop_ratio"]
+        local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, dim2) \
+            .permute(0, 2, 1, 3, 4).reshape(height_crop_num * h2, width_crop_num * w2, dim2)
+        local_features = torch.cat(
+            [local_features, inner.image_newline[None, None, :].expand(height_crop_num * h2, 1, dim2)], dim=1
+        ).view(-1, dim2)
+        return torch.cat([local_features, global_features, inner.view_seperator[None, :]], dim=0)
+
+    def image_key(self, image: Image.Image, base_size: int, image_size: int, crop_mode: bool) -> tuple:
+        digest = hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+        return (self.model_key, digest, image.size, base_size, image_size, bool(crop_mode), MAX_CROPS)
+
+    @torch.inference_mode()
+    def encode_image(self, image: Image.Image, base_size: int = 1024, image_size: int = 640,
+                     crop_mode: bool = True, key: Optional[tuple] = None) -> torch.Tensor:
+        """Projected visual embeddings for an image, served from the vision cache when possible"""
+        if not self.cache.enabled:
+            key = None
+        elif key is None:
+            key = self.image_key(image, base_size, image_size, crop_mode)
+        if key is not None:
+            cached = self.cache.get(key, self.device)
+            if cached is not None:
+                return cached
+        prepared = self.prepare_image(image, base_size, image_size, crop_mode)
+        embeds = self._encode_prepared(prepared)
+        if embeds.shape[0] != prepared["num_tokens"]:
+            raise RuntimeError(f"vision encoder produced {embeds.shape[0]} embeddings, expected {prepared['num_tokens']}")
+        if key is not None:
+            self.cache.put(key, embeds)
+        return embeds
+
+    # ---------- language model ----------
+
+    def encode_text(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def embed_tokens(self, token_ids: List[int]) -> torch.Tensor:
+        ids = torch.tensor([token_ids], dtype=torch.long, device=self.device)
+        return self.model.model.embed_tokens(ids)
+
+    def split_prompt(self, prompt: str) -> Tuple[List[int], List[int]]:
+        """Token ids before and after the single <image> placeholder ([bos] included)"""
+        if prompt.count(IMAGE_TOKEN) != 1:
+            raise ValueError("prompt must contain exactly one <image> placeholder")
+        before, after = prompt.split(IMAGE_TOKEN)
+        return [self.bos_id] + self.encode_text(before), self.encode_text(after)
+
+    def forward(self, inputs_embeds: torch.Tensor, past_key_values=None,
+                attention_mask: Optional[torch.Tensor] = None, position_ids: Optional[torch.Tensor] = None,
+                last_index: Optional[torch.Tensor] = None):
+        """Run the decoder stack (the base model's forward, skipping the vision merge).
+        Returns (logits [B, V] at the last position, or at last_index per row, cache)."""
+        inner = self.model.model
+        outputs = super(type(inner), inner).forward(
+            input_ids=None,
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        hidden = outputs.last_hidden_state
+        if last_index is None:
+            hidden = hidden[:, -1, :]
+        else:
+            hidden = hidden[torch.arange(hidden.shape[0], device=hidden.device), last_index]
+        logits = self.model.lm_head(hidden).float()
+        return logits, outputs.past_key_values
+
+    def new_cache(self):
+        from transformers import DynamicCache
+        return DynamicCache()
+
+    def prefix_entry(self, image: Image.Image, prefix_ids: List[int], base_size: int, image_size: int,
+                     crop_mode: bool) -> PrefixEntry:
+        """KV state after [bos] + image tokens, from the prefix cache or freshly prefilled"""
+        image_key = self.image_key(image, base_size, image_size, crop_mode)
+        prefix_key = (image_key, self.device.type, tuple(prefix_ids))
+
+        entry = self.prefix_cache.get(prefix_key) if self.prefix_cache.enabled else None
+        if entry is None:
+            image_embeds = self.encode_image(image, base_size, image_size, crop_mode, key=image_key)
+            prefix_embeds = torch.cat([self.embed_tokens(prefix_ids), image_embeds.to(self.dtype).unsqueeze(0)], dim=1)
+            logits, past_key_values = self.forward(prefix_embeds, self.new_cache())
+            entry = PrefixEntry(past_key_values, logits, image_embeds.shape[0])
+            if self.prefix_cache.enabled:
+                self.prefix_cache.put(prefix_key, entry)
+        return entry
+
+    def _select_tokens(self, logits: torch.Tensor, rows: List[int], ngrams: List[NoRepeatNGram],
+                       outputs: List[List[int]], on_token,
+                       loops: Optional[List[RepetitionDetector]], truncated: List[bool]) -> Tuple[List[int], List[int]]:
+        """Greedy pick for each row of logits (row k = sequence rows[k]).
+        Returns (tokens, indices k of rows that are still running). A row caught
+        in a repetition loop is stopped and cut back to the loop's first cycle."""
+        for k, row in enumerate(rows):
+            banned = ngrams[row].banned()
+            if banned:
+                logits[k, banned] = -float("inf")
+        tokens = logits.argmax(-1).tolist()
+        keep = []
+        for k, row in enumerate(rows):
+            if tokens[k] == self.eos_id:
+                continue
+            outputs[row].append(tokens[k])
+            ngrams[row].append(tokens[k])
+            if on_token is not None:
+                on_token(row, tokens[k])
+            if loops is not None and loops[row].append(tokens[k]):
+                del outputs[row][loops[row].cut:]
+                truncated[row] = True
+                continue
+            keep.append(k)
+        return tokens, keep
+
+    def _prefill_suffixes(self, entries: List[PrefixEntry], suffixes: List[List[int]], past_key_values,
+                          attention_mask: torch.Tensor, prefix_lengths: List[int]) -> torch.Tensor:
+        """Prefill right-padded prompt suffixes after the prefixes; next-token logits per row.
+        attention_mask must already cover the suffix slots."""
+        device = self.device
+        lengths = [len(s) for s in suffixes]
+        width = max(lengths)
+        if not width:
+            return torch.cat([e.logits for e in entries], dim=0)
+        padded = [s + [self.eos_id] * (width - len(s)) for s in suffixes]
+        inputs_embeds = self.model.model.embed_tokens(torch.tensor(padded, dtype=torch.long, device=device))
+        position_ids = torch.tensor(prefix_lengths, device=device).unsqueeze(1) + torch.arange(width, device=device)
+        last_index = torch.tensor([max(0, n - 1) for n in lengths], device=device)
+        logits, _ = self.forward(inputs_embeds, past_key_values, attention_mask, position_ids, last_index)
+        for row, length in enumerate(lengths):
+            if length == 0:
+                logits[row] = entries[row].logits[0]
+        return logits
+
+    def generate_batch(self, entries: List[PrefixEntry], prefixes: List[List[int]], suffixes: List[List[int]],
+                       max_new_tokens: int = MAX_NEW_TOKENS,
+                       no_repeat_ngram_size: int = NO_REPEAT_NGRAM_SIZE,
+                       cancel_event=None,
+                       on_token: Optional[Callable[[int, int], None]] = None) -> Tuple[List[List[int]], List[bool]]:
+        """Greedy-decode a batch of prompt suffixes, each against its own image prefix.
+
+        Prefix KV states are left-padded into one preallocated cache, suffixes
+        are right-padded; both paddings are masked, and explicit position ids
+        let every row continue at its own length. Rows that hit EOS or a
+        repetition loop are dropped from the batch. on_token(row, token) is
+        called for every generated token; cancel_event (threading.Event)
+        aborts with GenerationCancelled.
+
+        Returns (generated token ids, truncated_repetition) per row.
+        """
+        batch = len(suffixes)
+        device = self.device
+        lengths = [len(s) for s in suffixes]
+        budget = max(lengths) + min(max_new_tokens, KV_PREALLOC_TOKENS)
+        past_key_values, prefix_lengths = PreallocatedCache.from_prefixes(
+            [e.past_key_values for e in entries],
+            max(e.past_key_values.get_seq_length() for e in entries) + budget, self.kv_pool)
+        try:
+            width = past_key_values.get_seq_length()
+            filled = width + max(lengths)
+            # Allocated once for every slot the loop can reach; each step uses a prefix of it
+            attention_mask = torch.ones(batch, filled + max_new_tokens, dtype=torch.long, device=device)
+            for row, length in enumerate(prefix_lengths):
+                attention_mask[row, :width - length] = 0
+                attention_mask[row, width + lengths[row]:filled] = 0
+            logits = self._prefill_suffixes(entries, suffixes, past_key_values, attention_mask[:, :filled],
+                                            prefix_lengths)
+
+            ngrams = [
+                NoRepeatNGram(no_repeat_ngram_size,
+                              prefixes[row] + [self.image_token_id] * entries[row].num_image_tokens + suffixes[row])
+                for row in range(batch)
+            ]
+            outputs: List[List[int]] = [[] for _ in suffixes]
+            loops = [RepetitionDetector() for _ in suffixes] if REPEAT_GUARD else None
+            truncated = [False] * batch
+            active = list(range(batch))
+            next_position = torch.tensor([p + n for p, n in zip(prefix_lengths, lengths)], device=device)
+
+            for _ in range(max_new_tokens):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise GenerationCancelled()
+                tokens, keep = self._select_tokens(logits, active, ngrams, outputs, on_token, loops, truncated)
+                if not keep:
+                    break
+                if len(keep) < len(active):
+                    index = torch.tensor(keep, device=device)
+                    past_key_values.select_rows(index)
+                    attention_mask = attention_mask.index_select(0, index)
+                    next_position = next_position.index_select(0, index)
+                    active = [active[k] for k in keep]
+                    tokens = [tokens[k] for k in keep]
+                filled += 1
+                inputs_embeds = self.model.model.embed_tokens(torch.tensor(tokens, device=device).unsqueeze(1))
+                logits, _ = self.forward(inputs_embeds, past_key_values, attention_mask[:, :filled],
+                                         next_position.unsqueeze(1))
+                next_position = next_position + 1
+            return outputs, truncated
+        finally:
+            past_key_values.release()
+
+    def decode_text(self, token_ids: List[int], truncated_repetition: bool = False,
+                    max_new_tokens: Optional[int] = None) -> OCRText:
+        text = self.tokenizer.decode(token_ids)
+        if text.endswith(STOP_STR):
+            text = text[:-len(STOP_STR)]
+        # EOS is never kept, so a full-length output stopped on the budget
+        hit_token_limit = not truncated_repetition and max_new_tokens is not None and len(token_ids) >= max_new_tokens
+        return OCRText(text.strip(), truncated_repetition, hit_token_limit)
+
+    # ---------- entry points ----------
+
+    def _generate(self, prompts: List[str], images: List[Image.Image], base_size: int, image_size: int,
+                  crop_mode: bool, max_new_tokens: int, cancel_event=None, on_token=None,
+                  no_repeat_ngram_size: int = NO_REPEAT_NGRAM_SIZE) -> Tuple[List[List[int]], List[bool]]:
+        """Generated token ids and truncated_repetition flags for (prompt, image) pairs,
+        decoded as one batch"""
+        splits = [self.split_prompt(p) for p in prompts]
+        with self.autocast():
+            entries = [
+                self.prefix_entry(image, prefix_ids, base_size, image_size, crop_mode)
+                for image, (prefix_ids, _) in zip(images, splits)
+            ]
+            return self.generate_batch(entries, [p for p, _ in splits], [s for _, s in splits], max_new_tokens,
+                                       no_repeat_ngram_size, cancel_event, on_token)
+
+    @torch.inference_mode()
+    def infer(self, prompt: str, image_path: str, base_size: int = 1024, image_size: int = 640,
+              crop_mode: bool = True, max_new_tokens: int = MAX_NEW_TOKENS, cancel_event=None,
+              no_repeat_ngram_size: int = NO_REPEAT_NGRAM_SIZE, **kwargs) -> str:
+        image = load_image(image_path)
+        outputs, truncated = self._generate([prompt], [image], base_size, image_size, crop_mode, max_new_tokens,
+                                            cancel_event, no_repeat_ngram_size=no_repeat_ngram_size)
+        return self.decode_text(outputs[0], truncated[0], max_new_tokens)
+
+    @torch.inference_mode()
+    def infer_multi(self, prompts: List[str], image_path: str, base_size: int = 1024, image_size: int = 640,
+                    crop_mode: bool = True, max_new_tokens: int = MAX_NEW_TOKENS, cancel_event=None,
+                    no_repeat_ngram_size: int = NO_REPEAT_NGRAM_SIZE, **kwargs) -> List[str]:
+        """Several prompts on one image: one vision encode, one prefix prefill, one batched decode"""
+        image = load_image(image_path)
+        outputs, truncated = self._generate(prompts, [image] * len(prompts), base_size, image_size, crop_mode,
+                                            max_new_tokens, cancel_event, no_repeat_ngram_size=no_repeat_ngram_size)
+        return [self.decode_text(token_ids, cut, max_new_tokens) for token_ids, cut in zip(outputs, truncated)]
+
+    @torch.inference_mode()
+    def infer_batch(self, prompts: List[str], image_paths: List[str], base_size: int = 1024, image_size: int = 640,
+                    crop_mode: bool = True, max_new_tokens: int = MAX_NEW_TOKENS, cancel_event=None,
+                    no_repeat_ngram_size: int = NO_REPEAT_NGRAM_SIZE, **kwargs) -> List[str]:
+        """One prompt per image (e.g. PDF pages), decoded as one batch"""
+        images = [load_image(path) for path in image_paths]
+        outputs, truncated = self._generate(prompts, images, base_size, image_size, crop_mode, max_new_tokens,
+                                            cancel_event, no_repeat_ngram_size=no_repeat_ngram_size)
+        return [self.decode_text(token_ids, cut, max_new_tokens) for token_ids, cut in zip(outputs, truncated)]
+
+    def infer_stream(self, prompt: str, image_path: str, base_size: int = 1024, image_size: int = 640,
+                     crop_mode: bool = True, max_new_tokens: int = MAX_NEW_TOKENS, cancel_event=None,
+                     no_repeat_ngram_size: int = NO_REPEAT_NGRAM_SIZE,
+                     **kwargs) -> Generator[str, None, OCRText]:
+        """Yields text deltas as tokens are generated. The deltas join to the raw
+        decoded text; the generator returns the final cleaned text, i.e. what
+        infer() would return (without a looping tail the deltas already sent)."""
+        queue: "Queue[Optional[int]]" = Queue()
+        error: List[BaseException] = []
+        result: List[Tuple[List[List[int]], List[bool]]] = []
+        closed = threading.Event()
+
+        def on_token(row: int, token: int) -> None:
+            # Consumer went away: stop generating
+            if closed.is_set():
+                raise GenerationCancelled()
+            queue.put(token)
+
+        def run():
+            try:
+                with torch.inference_mode():
+                    image = load_image(image_path)
+                    result.append(self._generate([prompt], [image], base_size, image_size, crop_mode,
+                                                 max_new_tokens, cancel_event, on_token, no_repeat_ngram_size))
+            except BaseException as e:
+                error.append(e)
+            finally:
+                queue.put(None)
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        token_ids: List[int] = []
+        emitted = ""
+        try:
+            while (token := queue.get()) is not None:
+                token_ids.append(token)
+                text = self.tokenizer.decode(token_ids)
+                # Hold back incomplete multi-byte characters
+                if text.endswith("\ufffd") or len(text) <= len(emitted):
+                    continue
+                yield text[len(emitted):]
+                emitted = text
+            if token_ids:
+                text = self.tokenizer.decode(token_ids)
+                if len(text) > len(emitted):
+                    yield text[len(emitted):]
+        finally:
+            closed.set()
+            worker.join()
+        if error:
+            raise error[0]
+        outputs, truncated = result[0]
+        return self.decode_text(outputs[0], truncated[0], max_new_tokens)
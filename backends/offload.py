@@ -0,0 +1,197 @@
+"""Pinned-memory, layer-granular weight offload for GPUResourceManager.
+
+model.cpu() / model.to("cuda") copy every tensor synchronously through
+pageable memory (the driver stages each copy) and always move the whole
+model, so an offload / reload round trip takes seconds. WeightOffloader:
+
+- keeps one pinned host buffer per offloaded tensor, allocated on the first
+  offload and reused afterwards; copies in both directions are issued
+  non-blocking on a side CUDA stream
+- splits the model into units: the resident part (vision encoder,
+  embeddings, final norm, lm_head) and one unit per decoder layer
+- full mode evicts every unit; partial mode keeps the resident part and the
+  first / last OFFLOAD_KEEP_LAYERS decoder layers, and evicts middle layers
+  (last first) only until OFFLOAD_FREE_MB of device memory is free
+- reload() queues all copies and returns at once: the compute stream waits
+  for the resident part, and each decoder layer waits for its own copy in a
+  forward pre-hook, so later layers arrive while the vision encoder and the
+  first layers' prefill are already running
+"""
+import functools
+import os
+from typing import Any, Dict, List, Optional
+
+import torch
+
+OFFLOAD_MODE = os.environ.get("GPU_OFFLOAD_MODE", "full").lower()
+# Partial mode: device memory that must be free after an offload
+OFFLOAD_FREE_MB = int(os.environ.get("GPU_OFFLOAD_FREE_MB", "8192"))
+# Partial mode: decoder layers kept resident at each end of the stack
+OFFLOAD_KEEP_LAYERS = int(os.environ.get("GPU_OFFLOAD_KEEP_LAYERS", "1"))
+OFFLOAD_MODES = ("full", "partial")
+
+
+def _tensors(module: torch.nn.Module) -> List[torch.Tensor]:
+    """Parameters and buffers of a module, shared ones once"""
+    seen = set()
+    tensors = []
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if id(tensor) not in seen:
+            seen.add(id(tensor))
+            tensors.append(tensor)
+    return tensors
+
+
+def decoder_layers(model: torch.nn.Module) -> List[torch.nn.Module]:
+    layers = getattr(getattr(model, "model", None), "layers", None)
+    return list(layers) if layers is not None else []
+
+
+class _Unit:
+    """Tensors offloaded and reloaded together"""
+
+    def __init__(self, module: Optional[torch.nn.Module], tensors: List[torch.Tensor]):
+        self.module = module        # decoder layer hooked on reload (None: the resident part)
+        self.tensors = tensors
+        self.moved: List[torch.Tensor] = []  # tensors currently in pinned host memory
+        self.event: Optional[torch.cuda.Event] = None
+        self.hook = None
+
+    @property
+    def offloaded(self) -> bool:
+        return bool(self.moved)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.tensors if t.is_cuda)
+
+
+class WeightOffloader:
+    """Moves a CUDA model's weights to pinned host buffers and back (in place:
+    parameter .data is swapped, the module objects stay the same)"""
+
+    def __init__(self, model: torch.nn.Module, device: str = "cuda", mode: str = OFFLOAD_MODE,
+                 free_mb: int = OFFLOAD_FREE_MB, keep_layers: int = OFFLOAD_KEEP_LAYERS):
+        self.device = torch.device(device)
+        self.mode = mode if mode in OFFLOAD_MODES else "full"
+        self.free_bytes = free_mb << 20
+        self.keep_layers = max(0, keep_layers)
+        self.stream = torch.cuda.Stream(self.device)
+        layers = decoder_layers(model)
+        in_layers = {id(t) for layer in layers for t in _tensors(layer)}
+        self.resident = _Unit(None, [t for t in _tensors(model) if id(t) not in in_layers])
+        self.layers = [_Unit(layer, _tensors(layer)) for layer in layers]
+        self._pinned: Dict[int, torch.Tensor] = {}
+        self._reload_events = None
+
+    @staticmethod
+    def supported(device: str) -> bool:
+        return torch.cuda.is_available() and str(device).startswith("cuda")
+
+    def _evictable(self, mode: str) -> List[_Unit]:
+        if mode == "full":
+            return [self.resident] + self.layers
+        keep = self.keep_layers
+        middle = self.layers[keep:len(self.layers) - keep]
+        # Later layers are needed last, so their reload has the longest head start
+        return middle[::-1]
+
+    def _wait_pending(self) -> None:
+        """Finish a reload whose layers were not all run yet"""
+        self.stream.synchronize()
+        for unit in [self.resident] + self.layers:
+            unit.event = None
+            if unit.hook is not None:
+                unit.hook.remove()
+                unit.hook = None
+
+    def offload(self, mode: Optional[str] = None) -> int:
+        """Copy units to pinned host memory and drop their device tensors;
+        returns the number of bytes moved. mode overrides self.mode for this
+        call (the manager evicts whole models to make room for another one)"""
+        mode = mode if mode in OFFLOAD_MODES else self.mode
+        self._wait_pending()
+        units = [u for u in self._evictable(mode) if not u.offloaded]
+        if mode == "partial":
+            free, _ = torch.cuda.mem_get_info(self.device)
+            needed = self.free_bytes - free
+            chosen = []
+            for unit in units:
+                if needed <= 0:
+                    break
+                chosen.append(unit)
+                needed -= unit.nbytes
+            units = chosen
+
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            for unit in units:
+                unit.moved = [t for t in unit.tensors if t.is_cuda]
+                for tensor in unit.moved:
+                    host = self._pinned.get(id(tensor))
+                    if host is None:
+                        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+                        self._pinned[id(tensor)] = host
+                    host.copy_(tensor.data, non_blocking=True)
+        # Device tensors may only be dropped once the copies have read them
+        self.stream.synchronize()
+        moved = 0
+        for unit in units:
+            for tensor in unit.moved:
+                moved += tensor.numel() * tensor.element_size()
+                tensor.data = self._pinned[id(tensor)]
+        return moved
+
+    def reload(self) -> None:
+        """Queue the copies of every offloaded unit back to the device and return"""
+        compute = torch.cuda.current_stream(self.device)
+        # Blocks allocated below may have been freed by still-running compute work
+        self.stream.wait_stream(compute)
+        start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        start.record(self.stream)
+        for unit in [self.resident] + self.layers:
+            if not unit.offloaded:
+                continue
+            targets = [torch.empty(t.shape, dtype=t.dtype, device=self.device) for t in unit.moved]
+            with torch.cuda.stream(self.stream):
+                for target, tensor in zip(targets, unit.moved):
+                    target.copy_(tensor.data, non_blocking=True)
+                unit.event = torch.cuda.Event()
+                unit.event.record(self.stream)
+            for target, tensor in zip(targets, unit.moved):
+                tensor.data = target
+            unit.moved = []
+            if unit.module is None:
+                compute.wait_event(unit.event)
+                unit.event = None
+            else:
+                unit.hook = unit.module.register_forward_pre_hook(functools.partial(self._wait_unit, unit))
+        end.record(self.stream)
+        self._reload_events = (start, end)
+
+    def _wait_unit(self, unit: _Unit, module, args) -> None:
+        # Runs before the layer's kernels are queued; the host does not block
+        if unit.event is not None:
+            torch.cuda.current_stream(self.device).wait_event(unit.event)
+            unit.event = None
+        if unit.hook is not None:
+            unit.hook.remove()
+            unit.hook = None
+
+    def last_reload_s(self) -> Optional[float]:
+        """Device time of the last reload's copies, None while they are still running"""
+        if self._reload_events is None or not self._reload_events[1].query():
+            return None
+        start, end = self._reload_events
+        return start.elapsed_time(end) / 1000
+
+    def stats(self) -> Dict[str, Any]:
+        last = self.last_reload_s()
+        return {
+            "mode": self.mode,
+            "offloaded_layers": sum(1 for u in self.layers if u.offloaded),
+            "total_layers": len(self.layers),
+            "resident_offloaded": self.resident.offloaded,
+            "pinned_mb": round(sum(t.numel() * t.element_size() for t in self._pinned.values()) / (1 << 20), 1),
+            "last_prefetch_s": round(last, 3) if last is not None else None,
+        }
@@ -0,0 +1,134 @@
+"""ONNX Runtime execution of the vision stack (SAM -> CLIP -> projector) on CPU.
+
+Eager PyTorch runs SAM ViT-B, CLIP-L and the projector over the global view
+and up to 6 tiles per page; ORT with full graph optimization and all cores is
+considerably faster on CPU hosts. Two fixed-resolution graphs are exported:
+
+    global  [1, 3, 1024, 1024]   the 1024 global view (base / gundam modes)
+    tiles   [N, 3, 640, 640]     640 tiles, batched (also the small-mode view)
+
+Other view sizes (tiny mode) fall back to eager PyTorch. Exports are cached
+on disk under ONNX_CACHE_DIR, keyed by model, revision, config, torch version
+and opset, so they are built once per model version. Enabled with
+ONNX_VISION=1; needs the optional onnx and onnxruntime packages.
+"""
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+ONNX_VISION = os.environ.get("ONNX_VISION", "0") == "1"
+ONNX_CACHE_DIR = os.path.expanduser(os.environ.get("ONNX_CACHE_DIR", "~/.cache/deepseek-ocr/onnx"))
+# ORT intra-op threads; 0 lets ORT use all physical cores
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", "0"))
+ONNX_OPSET = 17
+# Bump when the exported graph layout changes
+EXPORT_VERSION = 1
+
+GLOBAL_VIEW_SIZE = 1024
+TILE_SIZE = 640
+
+
+class VisionStack(torch.nn.Module):
+    """views [N, 3, H, W] -> projected features [N, h*w, D] (the engine's _view_features)"""
+
+    def __init__(self, inner):
+        super().__init__()
+        self.sam_model = inner.sam_model
+        self.vision_model = inner.vision_model
+        self.projector = inner.projector
+
+    def forward(self, views: torch.Tensor) -> torch.Tensor:
+        sam_features = self.sam_model(views)
+        clip_features = self.vision_model(views, sam_features)
+        features = torch.cat((clip_features[:, 1:], sam_features.flatten(2).permute(0, 2, 1)), dim=-1)
+        return self.projector(features)
+
+
+def version_key(model, model_key: str, revision: Optional[str]) -> str:
+    """Cache key for the exported graphs of one model version"""
+    config = getattr(model, "config", None)
+    config_json = config.to_json_string() if hasattr(config, "to_json_string") else ""
+    payload = json.dumps([model_key, revision, config_json, torch.__version__, ONNX_OPSET, EXPORT_VERSION])
+    return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+
+def export_vision_graph(model, path: str, size: int, batched: bool) -> None:
+    """Export the vision stack at one view size; written atomically"""
+    stack = VisionStack(model.model).float().eval()
+    dummy = torch.zeros(2 if batched else 1, 3, size, size)
+    dynamic_axes = {"views": {0: "n"}, "features": {0: "n"}} if batched else None
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # TorchScript exporter: handles the remote model code as-is
+    fd, tmp_path = tempfile.mkstemp(suffix=".onnx", dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                stack, (dummy,), tmp_path,
+                input_names=["views"], output_names=["features"],
+                dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET,
+                **kwargs
+            )
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class OnnxVisionEncoder:
+    def __init__(self, sessions: Dict[int, Tuple[Any, bool]]):
+        # view size -> (ort.InferenceSession, accepts a batch of views)
+        self.sessions = sessions
+
+    @classmethod
+    def create(cls, model, model_key: str, revision: Optional[str] = None) -> Optional["OnnxVisionEncoder"]:
+        """Encoder for model, exporting the graphs if they are not cached.
+        None when disabled, unavailable or the export fails (eager fallback)."""
+        if not ONNX_VISION or model is None:
+            return None
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            print("⚠️ ONNX_VISION=1 but onnxruntime is not installed, using PyTorch vision encoder")
+            return None
+        cache_dir = os.path.join(ONNX_CACHE_DIR, version_key(model, model_key, revision))
+        os.makedirs(cache_dir, exist_ok=True)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = ONNX_THREADS
+
+        fp32 = next(model.parameters()).dtype == torch.float32
+        sessions = {}
+        for name, size, batched in (("global", GLOBAL_VIEW_SIZE, False), ("tiles", TILE_SIZE, True)):
+            path = os.path.join(cache_dir, f"vision-{name}{size}.onnx")
+            try:
+                if not os.path.exists(path):
+                    if not fp32:
+                        raise RuntimeError("not exported yet and export needs fp32 weights")
+                    print(f"📦 Exporting vision encoder to ONNX ({name}, {size}px)...")
+                    export_vision_graph(model, path, size, batched)
+                sessions[size] = (ort.InferenceSession(path, options, providers=["CPUExecutionProvider"]), batched)
+            except Exception as e:
+                print(f"⚠️ ONNX vision graph '{name}' unavailable ({e}), using PyTorch for {size}px views")
+        if not sessions:
+            return None
+        print(f"✅ ONNX Runtime vision encoder ready ({cache_dir})")
+        return cls(sessions)
+
+    def features(self, views: torch.Tensor) -> Optional[torch.Tensor]:
+        """Projected features for a stack of views, or None if no graph has this view size"""
+        size = views.shape[-1]
+        if size not in self.sessions or views.shape[-2] != size:
+            return None
+        session, batched = self.sessions[size]
+        inputs = views.detach().float().cpu().numpy()
+        if batched:
+            return torch.from_numpy(session.run(None, {"views": inputs})[0])
+        # Fixed-shape graph: one view per run
+        return torch.cat([torch.from_numpy(session.run(None, {"views": view[None]})[0]) for view in inputs], dim=0)
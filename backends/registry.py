@@ -0,0 +1,129 @@
+"""Process-wide registry of loaded backends.
+
+Loading DeepSeek-OCR takes seconds to minutes and several GB of weights, so
+a backend (model + processor) is loaded once per (model path, revision,
+device, dtype) and shared by every request and endpoint. Loads are
+serialized per key: concurrent first requests wait for one load instead of
+each starting their own.
+"""
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from backends.base import BaseBackend
+
+# (model path, revision, device, dtype / precision)
+ModelKey = Tuple[str, str, str, str]
+
+
+def model_key(backend: BaseBackend, dtype: Any) -> ModelKey:
+    """Registry key for a (not yet loaded) backend instance"""
+    return (backend.model_path, str(getattr(backend, "revision", "") or ""), str(backend.device),
+            str(dtype).replace("torch.", ""))
+
+
+def model_bytes(model) -> Dict[str, int]:
+    """Bytes of parameters and buffers per device type ("cpu", "cuda", ...)"""
+    if model is None or not hasattr(model, "parameters"):
+        return {}
+    seen = set()
+    sizes: Dict[str, int] = {}
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if id(tensor) in seen:
+            continue
+        seen.add(id(tensor))
+        device = tensor.device.type
+        sizes[device] = sizes.get(device, 0) + tensor.numel() * tensor.element_size()
+    return sizes
+
+
+@dataclass
+class RegistryEntry:
+    backend: BaseBackend
+    load_seconds: float
+    loaded_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+    uses: int = 0
+
+
+class ModelRegistry:
+    """Loaded backends by ModelKey"""
+
+    def __init__(self):
+        self._entries: Dict[ModelKey, RegistryEntry] = {}
+        self._load_locks: Dict[ModelKey, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: ModelKey, load: Callable[[], BaseBackend]) -> BaseBackend:
+        """The backend for key; load() builds and loads it on first use"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                load_lock = self._load_locks.setdefault(key, threading.Lock())
+        if entry is None:
+            with load_lock:
+                # Another request may have finished the load while we waited
+                with self._lock:
+                    entry = self._entries.get(key)
+                if entry is None:
+                    print(f"📥 Registry: loading {key[0]} on {key[2]} ({key[3]})")
+                    start = time.time()
+                    backend = load()
+                    entry = RegistryEntry(backend=backend, load_seconds=time.time() - start)
+                    with self._lock:
+                        self._entries[key] = entry
+        with self._lock:
+            entry.last_used = time.time()
+            entry.uses += 1
+        return entry.backend
+
+    def peek(self, key: ModelKey) -> Optional[BaseBackend]:
+        """The backend for key if it is loaded, without loading or counting a use"""
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry.backend if entry is not None else None
+
+    def remove(self, key: ModelKey) -> bool:
+        """Drop a backend; its memory is freed once no request still uses it"""
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = list(self._entries.items())
+        models = []
+        totals: Dict[str, int] = {}
+        for key, entry in entries:
+            sizes = model_bytes(getattr(entry.backend, "model", None))
+            for device, nbytes in sizes.items():
+                totals[device] = totals.get(device, 0) + nbytes
+            models.append({
+                "model_path": key[0],
+                "revision": key[1],
+                "device": key[2],
+                "dtype": key[3],
+                "backend": type(entry.backend).__name__,
+                "mb": {device: round(nbytes / (1 << 20), 1) for device, nbytes in sizes.items()},
+                "load_seconds": round(entry.load_seconds, 1),
+                "idle_seconds": round(time.time() - entry.last_used, 1),
+                "uses": entry.uses,
+            })
+        return {
+            "models": models,
+            "total_mb": {device: round(nbytes / (1 << 20), 1) for device, nbytes in totals.items()},
+        }
+
+
+_registry: Optional[ModelRegistry] = None
+
+
+def get_model_registry() -> ModelRegistry:
+    global _registry
+    if _registry is None:
+        _registry = ModelRegistry()
+    return _registry
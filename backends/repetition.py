@@ -0,0 +1,98 @@
+"""Repetition-loop guard for generated OCR output.
+
+Degenerate pages make the model loop on the same block of text until
+max_new_tokens (8192) runs out. no_repeat_ngram only bans exact n-grams, so
+what comes out is a near-periodic tail (the same line with a counter or one
+changed character). The check here looks at the last REPEAT_WINDOW items of a
+sequence and reports a loop when, for some period p <= REPEAT_MAX_PERIOD, at
+least REPEAT_MIN_MATCH of them equal the item p positions earlier. The
+sequence is then cut back to the first cycle of the loop.
+
+- RepetitionDetector: online, fed one generated token at a time by the
+  native engine's decode loop, which stops the row as soon as it fires
+- truncate_repetition: the same check on finished text, for paths whose
+  decode loop cannot be hooked (remote model.infer)
+"""
+import os
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+REPEAT_GUARD = os.environ.get("REPEAT_GUARD", "1") != "0"
+REPEAT_WINDOW = int(os.environ.get("REPEAT_WINDOW", "512"))           # tokens
+REPEAT_MAX_PERIOD = int(os.environ.get("REPEAT_MAX_PERIOD", "128"))   # tokens
+REPEAT_MIN_MATCH = float(os.environ.get("REPEAT_MIN_MATCH", "0.95"))
+REPEAT_MIN_CYCLES = 4       # the window must hold at least this many periods
+REPEAT_CHECK_EVERY = 16     # tokens between online checks
+TEXT_SCALE = 4              # ~characters per token, for the text-level check
+
+
+def _as_array(items: Union[str, Sequence[int]]) -> np.ndarray:
+    if isinstance(items, str):
+        return np.frombuffer(items.encode("utf-32-le"), dtype=np.uint32)
+    return np.asarray(items)
+
+
+def periodic_tail(seq: Union[str, Sequence[int]], window: int = REPEAT_WINDOW,
+                  max_period: int = REPEAT_MAX_PERIOD,
+                  min_match: float = REPEAT_MIN_MATCH) -> Optional[Tuple[int, int]]:
+    """(period, cut) if the last `window` items of seq (token ids or text) loop
+    with a period <= max_period; seq[:cut] keeps everything before the loop and
+    its first cycle. None if the tail is not periodic."""
+    n = len(seq)
+    max_period = min(max_period, window // REPEAT_MIN_CYCLES)
+    if max_period < 1 or n < window + 1:
+        return None
+    span = min(n, window + max_period)
+    arr = _as_array(seq[n - span:])
+    tail = arr[span - window:]
+    needed = min_match * window
+    # Smallest period first: multiples of the true period match as well
+    for period in range(1, min(max_period, span - window) + 1):
+        if np.count_nonzero(tail == arr[span - window - period:span - period]) >= needed:
+            return period, _loop_start(_as_array(seq), n - window, period, min_match) + period
+    return None
+
+
+def _loop_start(items: np.ndarray, start: int, period: int, min_match: float) -> int:
+    """Walk back from start over whole cycles that still match, then item by item"""
+    while start >= period and np.count_nonzero(
+            items[start - period:start] == items[start:start + period]) >= min_match * period:
+        start -= period
+    while start > 0 and items[start - 1] == items[start - 1 + period]:
+        start -= 1
+    return start
+
+
+class RepetitionDetector:
+    """Online loop check for one generated sequence"""
+
+    def __init__(self, window: int = REPEAT_WINDOW, max_period: int = REPEAT_MAX_PERIOD,
+                 min_match: float = REPEAT_MIN_MATCH, check_every: int = REPEAT_CHECK_EVERY):
+        self.window = window
+        self.max_period = max_period
+        self.min_match = min_match
+        self.check_every = check_every
+        self.tokens = []
+        self.cut: Optional[int] = None  # tokens to keep once the loop was found
+
+    def append(self, token: int) -> bool:
+        """Add a generated token; True once the sequence is looping"""
+        self.tokens.append(token)
+        if len(self.tokens) % self.check_every:
+            return False
+        found = periodic_tail(self.tokens, self.window, self.max_period, self.min_match)
+        if found is None:
+            return False
+        self.cut = found[1]
+        return True
+
+
+def truncate_repetition(text: str) -> Tuple[str, bool]:
+    """(text cut to the first cycle of a trailing loop, whether it was cut)"""
+    if not REPEAT_GUARD:
+        return text, False
+    found = periodic_tail(text, REPEAT_WINDOW * TEXT_SCALE, REPEAT_MAX_PERIOD * TEXT_SCALE, REPEAT_MIN_MATCH)
+    if found is None:
+        return text, False
+    return text[:found[1]].rstrip(), True
@@ -0,0 +1,106 @@
+"""Stub Backend - deterministic fake model for tests and frontend development
+
+Selected with FORCE_BACKEND=stub. Loads nothing and needs no GPU or model
+download. Output depends only on the prompt and the image (size and content
+hash), uses the real grounding format so boxes render in the UI, and honours
+the full backend contract: batching, multi-prompt, streaming, cancel and
+max_new_tokens (one "token" per word).
+STUB_LATENCY adds a per-chunk delay in seconds to exercise progress and
+cancel paths.
+"""
+import hashlib
+import os
+import re
+import time
+from typing import Any, Dict, Generator, List, Optional
+
+from PIL import Image
+
+from backends.base import BaseBackend, GenerationOptions, OCRText
+
+STUB_LATENCY = float(os.environ.get("STUB_LATENCY", "0"))
+STUB_MAX_BATCH = 8
+
+
+class StubBackend(BaseBackend):
+    def __init__(self, model_path: str = "stub"):
+        self.model_path = model_path
+        self.model = None
+        self.processor = None
+        self.device = "cpu"
+        self.calls = 0
+
+    def load_model(self, *args, **kwargs) -> bool:
+        print("📦 Loading stub backend (no model)")
+        self.model = "stub"
+        return True
+
+    def _result(self, prompt: str, image_path: str, options: GenerationOptions) -> OCRText:
+        words = self._text(prompt, image_path, options).split(" ")
+        if len(words) > options.max_new_tokens:
+            return OCRText(" ".join(words[:options.max_new_tokens]), hit_token_limit=True)
+        return OCRText(" ".join(words))
+
+    def _text(self, prompt: str, image, options: GenerationOptions) -> str:
+        """image: a path, or an already opened PIL image (StubAsyncEngine)"""
+        with (image.copy() if isinstance(image, Image.Image) else Image.open(image)) as img:
+            width, height = img.size
+            digest = hashlib.blake2b(img.convert("L").resize((32, 32)).tobytes(), digest_size=4).hexdigest()
+        mode = f"{options.base_size}/{options.image_size}/{'crop' if options.crop_mode else 'nocrop'}"
+
+        find = re.search(r"Locate <\|ref\|>(.*?)<\|/ref\|>", prompt)
+        if find:
+            return f"<|ref|>{find.group(1)}<|/ref|><|det|>[[100, 100, 400, 200]]<|/det|>"
+        if "<|grounding|>" in prompt:
+            return (
+                f"<|ref|>title<|/ref|><|det|>[[50, 40, 950, 120]]<|/det|>\n# Stub page {digest}\n\n"
+                f"<|ref|>text<|/ref|><|det|>[[50, 160, 950, 600]]<|/det|>\n"
+                f"Image {width}x{height}, mode {mode}."
+            )
+        instruction = prompt.replace("<image>", "").strip()
+        return f"Stub result {digest} for a {width}x{height} image ({mode}): {instruction}"
+
+    def infer(self, prompt: str, image_path: str, options: Optional[GenerationOptions] = None, **kwargs) -> str:
+        stream = self.infer_stream(prompt, image_path, options, **kwargs)
+        while True:
+            try:
+                next(stream)
+            except StopIteration as done:
+                return done.value
+
+    def infer_batch(self, prompts: List[str], image_paths: List[str],
+                    options: Optional[GenerationOptions] = None, **kwargs) -> List[str]:
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        self.calls += 1
+        results = [self._result(p, path, options) for p, path in zip(prompts, image_paths)]
+        # One delay per decode step of the longest row, like a real batch
+        for _ in range(max((len(r.split(" ")) for r in results), default=0)):
+            options.check_cancelled()
+            if STUB_LATENCY:
+                time.sleep(STUB_LATENCY)
+        return results
+
+    def infer_stream(self, prompt: str, image_path: str,
+                     options: Optional[GenerationOptions] = None,
+                     **kwargs) -> Generator[str, None, str]:
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        self.calls += 1
+        text = self._result(prompt, image_path, options)
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            options.check_cancelled()
+            if STUB_LATENCY:
+                time.sleep(STUB_LATENCY)
+            yield word if i == 0 else " " + word
+        return text
+
+    def capabilities(self) -> Dict[str, Any]:
+        caps = super().capabilities()
+        caps.update({
+            "max_batch": STUB_MAX_BATCH,
+            "streaming": True,
+            "cancel": True,
+            "multi_prompt": True,
+            "dtype": "none",
+        })
+        return caps
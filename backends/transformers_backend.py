@@ -1,10 +1,25 @@
 """Transformers Backend for CPU/MPS"""
 from typing import Optional
 from PIL import Image
-from transformers import AutoProcessor, AutoModelForVision2Seq
+from transformers import AutoProcessor, AutoModelForVision2Seq, StoppingCriteria, StoppingCriteriaList
 import torch
 
-class TransformersBackend:
+from backends.base import BaseBackend, GenerationOptions, OCRText
+from backends.repetition import REPEAT_GUARD, RepetitionDetector
+
+
+class RepetitionStop(StoppingCriteria):
+    """Stops generate() once the generated tokens loop (backends/repetition.py)"""
+
+    def __init__(self):
+        self.detector = RepetitionDetector()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        looping = self.detector.append(int(input_ids[0, -1]))
+        return torch.full((input_ids.shape[0],), looping, dtype=torch.bool, device=input_ids.device)
+
+
+class TransformersBackend(BaseBackend):
     def __init__(self, model_path: str = "deepseek-ai/DeepSeek-OCR"):
         self.model_path = model_path
         self.model = None
@@ -30,8 +45,12 @@ class TransformersBackend:
             print(f"❌ Model loading failed: {e}")
             raise
     
-    def infer(self, prompt: str, image_path: str, **kwargs) -> str:
+    def infer(self, prompt: str, image_path: str, options: Optional[GenerationOptions] = None, **kwargs) -> str:
         """Run inference"""
+        if options is not None:
+            max_new_tokens = kwargs.get('max_new_tokens', options.max_new_tokens)
+        else:
+            max_new_tokens = kwargs.get('max_new_tokens', kwargs.get('max_tokens', 2048))
         try:
             image = Image.open(image_path).convert('RGB')
             
@@ -41,21 +60,39 @@ class TransformersBackend:
                 return_tensors="pt"
             ).to(self.device)
             
+            repetition_stop = RepetitionStop()
             outputs = self.model.generate(
                 **inputs,
-                max_new_tokens=kwargs.get('max_tokens', 2048),
+                max_new_tokens=max_new_tokens,
                 temperature=kwargs.get('temperature', 0.0),
                 do_sample=False,
-                pad_token_id=self.processor.tokenizer.eos_token_id
+                pad_token_id=self.processor.tokenizer.eos_token_id,
+                stopping_criteria=StoppingCriteriaList([repetition_stop] if REPEAT_GUARD else [])
             )
             
-            result = self.processor.decode(outputs[0], skip_special_tokens=False)
-            return result
+            sequence = outputs[0]
+            prompt_length = inputs["input_ids"].shape[1]
+            cut = repetition_stop.detector.cut
+            hit_token_limit = (cut is None and sequence.shape[0] - prompt_length >= max_new_tokens
+                               and int(sequence[-1]) != self.processor.tokenizer.eos_token_id)
+            if cut is not None:
+                # Drop the loop, keep its first cycle
+                sequence = sequence[:prompt_length + cut]
+            result = self.processor.decode(sequence, skip_special_tokens=False)
+            return OCRText(result, cut is not None, hit_token_limit)
             
         except Exception as e:
             print(f"❌ Inference failed: {e}")
             raise
     
+    def capabilities(self) -> dict:
+        caps = super().capabilities()
+        # processor-driven generate(): no resolution modes, no token streaming
+        caps["resolution_modes"] = False
+        if self.model is not None:
+            caps["dtype"] = str(self.model.dtype).replace("torch.", "")
+        return caps
+    
     @staticmethod
     def is_available() -> bool:
         """Always available if torch is installed"""
@@ -0,0 +1,150 @@
+"""Two-tier LRU cache of projected vision embeddings.
+
+Running document mode on a page and then several find queries re-runs SAM,
+CLIP and the projector over the same views every time. Entries are keyed by
+(model, image content hash, resolution settings) and hold the final image
+embedding sequence that is spliced into the language-model input. The device
+tier keeps hot entries on the GPU; entries evicted from it are demoted to a
+host (CPU RAM) tier and promoted back on the next hit. Both tiers are bounded
+by bytes.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+import torch
+
+VISION_CACHE_DEVICE_MB = int(os.environ.get("VISION_CACHE_DEVICE_MB", "256"))
+VISION_CACHE_HOST_MB = int(os.environ.get("VISION_CACHE_HOST_MB", "1024"))
+
+
+def tensor_bytes(tensor: torch.Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+def same_device(a: torch.device, b: torch.device) -> bool:
+    """torch.device("cuda") and cuda:0 are the same device for our purposes"""
+    return a.type == b.type and (a.index or 0) == (b.index or 0)
+
+
+class VisionEmbeddingCache:
+    def __init__(self, device_bytes: int = VISION_CACHE_DEVICE_MB << 20,
+                 host_bytes: int = VISION_CACHE_HOST_MB << 20):
+        self.device_bytes = device_bytes
+        self.host_bytes = host_bytes
+        self._device: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+        self._host: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+        self._device_used = 0
+        self._host_used = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.host_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.device_bytes > 0 or self.host_bytes > 0
+
+    def get(self, key: Hashable, device: torch.device) -> Optional[torch.Tensor]:
+        """Embedding for key on device, or None. Host-tier hits are promoted."""
+        with self._lock:
+            tensor = self._device.get(key)
+            if tensor is not None and same_device(tensor.device, device):
+                self._device.move_to_end(key)
+                self.hits += 1
+                return tensor
+            if tensor is not None:
+                # Stored for another device (e.g. after an offload to CPU)
+                self._pop_device(key)
+                self._put_host(key, tensor.cpu())
+            tensor = self._host.pop(key, None)
+            if tensor is None:
+                self.misses += 1
+                return None
+            self._host_used -= tensor_bytes(tensor)
+            self.hits += 1
+            self.host_hits += 1
+            tensor = tensor.to(device, non_blocking=True)
+            self._put_device(key, tensor)
+            return tensor
+
+    def put(self, key: Hashable, tensor: torch.Tensor) -> None:
+        with self._lock:
+            if key in self._device or key in self._host:
+                return
+            self._put_device(key, tensor.detach())
+
+    def release_device(self, model_key: Optional[str] = None) -> None:
+        """Demote device-tier entries to host RAM (called when a model is offloaded);
+        model_key limits this to one model's entries (keys start with the engine's model_key)"""
+        with self._lock:
+            for key in [k for k in self._device if model_key is None or k[0] == model_key]:
+                self._put_host(key, self._pop_device(key).cpu())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._device.clear()
+            self._host.clear()
+            self._device_used = 0
+            self._host_used = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._device) + len(self._host),
+                "device_entries": len(self._device),
+                "host_entries": len(self._host),
+                "device_mb": round(self._device_used / (1 << 20), 1),
+                "host_mb": round(self._host_used / (1 << 20), 1),
+                "hits": self.hits,
+                "host_hits": self.host_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    # --- internals (caller holds the lock) ---
+
+    def _pop_device(self, key: Hashable) -> torch.Tensor:
+        tensor = self._device.pop(key)
+        self._device_used -= tensor_bytes(tensor)
+        return tensor
+
+    def _put_device(self, key: Hashable, tensor: torch.Tensor) -> None:
+        # CPU backends have no separate device tier
+        if tensor.device.type == "cpu":
+            self._put_host(key, tensor)
+            return
+        size = tensor_bytes(tensor)
+        if size > self.device_bytes:
+            self._put_host(key, tensor.cpu())
+            return
+        while self._device and self._device_used + size > self.device_bytes:
+            old_key, old = self._device.popitem(last=False)
+            self._device_used -= tensor_bytes(old)
+            self._put_host(old_key, old.cpu())
+        self._device[key] = tensor
+        self._device_used += size
+
+    def _put_host(self, key: Hashable, tensor: torch.Tensor) -> None:
+        size = tensor_bytes(tensor)
+        if size > self.host_bytes:
+            return
+        while self._host and self._host_used + size > self.host_bytes:
+            _, old = self._host.popitem(last=False)
+            self._host_used -= tensor_bytes(old)
+        self._host[key] = tensor
+        self._host_used += size
+
+
+_vision_cache: Optional[VisionEmbeddingCache] = None
+
+
+def get_vision_cache() -> VisionEmbeddingCache:
+    """Process-wide cache, shared by every backend instance (the GPU service
+    builds a backend object per request)"""
+    global _vision_cache
+    if _vision_cache is None:
+        _vision_cache = VisionEmbeddingCache()
+    return _vision_cache
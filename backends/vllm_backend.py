@@ -0,0 +1,363 @@
+"""vLLM Backend - one AsyncLLMEngine shared by all requests (NVIDIA GPUs)
+
+Selected with FORCE_BACKEND=vllm. The engine and the DeepSeek-OCR vLLM image
+processor are created once in load_model() and live on a dedicated event-loop
+thread. The synchronous backend methods submit to that loop, so requests from
+several service threads are in the engine at the same time and vLLM batches
+them continuously (capabilities()["max_concurrency"] tells the service how
+many to let through).
+
+- request ids are uuid4-based, so concurrent requests never collide
+- cancel_event -> engine.abort(request_id), also for requests still queued
+- infer_stream yields text deltas as the engine produces them
+- the repetition guard (backends/repetition.py) watches the generated token
+  ids, aborts a looping request and cuts it back to the first cycle
+- the no-repeat n-gram logits processor is the incremental one (O(1) per
+  token); a template per n-gram size is cloned for every request
+
+Resolution mode is fixed per process by the vLLM model code
+(DeepSeek-OCR-master/DeepSeek-OCR-vllm/config.py: BASE_SIZE / IMAGE_SIZE /
+CROP_MODE), so per-request resolution kwargs are ignored, and vLLM manages
+its own KV cache blocks (the service's memory admission is off).
+
+OCR_VLLM_ENGINE=stub swaps in StubAsyncEngine, which implements the same
+engine interface (generate / abort / get_tokenizer) without vLLM or a GPU,
+for tests on CPU.
+"""
+import asyncio
+import os
+import queue
+import sys
+import threading
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Generator, List, Optional
+
+from PIL import Image, ImageOps
+
+from backends.base import BaseBackend, GenerationCancelled, GenerationOptions, OCRText
+from backends.repetition import REPEAT_GUARD, RepetitionDetector
+
+# Not VLLM_*: vLLM reads (and warns about) its own environment variables with that prefix
+OCR_VLLM_ENGINE = os.environ.get("OCR_VLLM_ENGINE", "vllm").lower()
+OCR_VLLM_GPU_UTIL = float(os.environ.get("OCR_VLLM_GPU_UTIL", "0.75"))
+OCR_VLLM_MAX_SEQS = int(os.environ.get("OCR_VLLM_MAX_SEQS", "16"))
+OCR_VLLM_MAX_MODEL_LEN = int(os.environ.get("OCR_VLLM_MAX_MODEL_LEN", "8192"))
+VLLM_CODE_DIR = Path(__file__).resolve().parent.parent / "DeepSeek-OCR-master" / "DeepSeek-OCR-vllm"
+NGRAM_WINDOW = 90
+NGRAM_WHITELIST = {128821, 128822}  # <td>, </td>
+CANCEL_POLL_S = 0.05
+
+
+def _use_vllm_code() -> None:
+    """Make the DeepSeek-OCR vLLM model code (config, process/, deepencoder/) importable"""
+    if str(VLLM_CODE_DIR) not in sys.path:
+        sys.path.insert(0, str(VLLM_CODE_DIR))
+
+
+def _build_vllm_engine(model_path: str):
+    """(engine, image processor, SamplingParams class) for the real vLLM engine"""
+    os.environ.setdefault("VLLM_USE_V1", "0")
+    _use_vllm_code()
+    from vllm import AsyncLLMEngine, SamplingParams
+    from vllm.engine.arg_utils import AsyncEngineArgs
+    from vllm.model_executor.models.registry import ModelRegistry
+    from deepseek_ocr import DeepseekOCRForCausalLM
+    from process.image_process import get_processor
+
+    ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+    engine = AsyncLLMEngine.from_engine_args(AsyncEngineArgs(
+        model=model_path,
+        hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+        block_size=256,
+        max_model_len=OCR_VLLM_MAX_MODEL_LEN,
+        max_num_seqs=OCR_VLLM_MAX_SEQS,
+        enforce_eager=False,
+        trust_remote_code=True,
+        tensor_parallel_size=1,
+        gpu_memory_utilization=OCR_VLLM_GPU_UTIL,
+    ))
+    return engine, get_processor(), SamplingParams
+
+
+def _ngram_processor(ngram_size: int):
+    _use_vllm_code()
+    from process.ngram_norepeat import IncrementalNoRepeatNGramLogitsProcessor
+    return IncrementalNoRepeatNGramLogitsProcessor(ngram_size=ngram_size, window_size=NGRAM_WINDOW,
+                                                   whitelist_token_ids=NGRAM_WHITELIST)
+
+
+class StubSamplingParams(SimpleNamespace):
+    """The SamplingParams fields StubAsyncEngine reads"""
+
+
+class _StubTokenizer:
+    """One token per word, like StubBackend"""
+
+    def decode(self, token_ids: List[Any], **kwargs) -> str:
+        return " ".join(str(t) for t in token_ids)
+
+
+class StubAsyncEngine:
+    """AsyncLLMEngine interface without vLLM: deterministic StubBackend text,
+    one word per step, cumulative outputs, STUB_LATENCY per step"""
+
+    def __init__(self):
+        from backends.stub_backend import StubBackend
+        self._stub = StubBackend()
+        self._aborted = set()
+        self.running = set()  # request ids currently generating
+        self.peak_running = 0
+
+    async def get_tokenizer(self):
+        return _StubTokenizer()
+
+    async def abort(self, request_id: str) -> None:
+        self._aborted.add(request_id)
+
+    async def generate(self, request: Dict[str, Any], sampling_params, request_id: str):
+        from backends.stub_backend import STUB_LATENCY
+        image = request.get("multi_modal_data", {}).get("image")
+        words = self._stub._text(request["prompt"], image, GenerationOptions()).split(" ")
+        self.running.add(request_id)
+        self.peak_running = max(self.peak_running, len(self.running))
+        try:
+            for step in range(1, len(words) + 1):
+                await asyncio.sleep(STUB_LATENCY)
+                if request_id in self._aborted:
+                    return
+                length_cut = step == sampling_params.max_tokens and step < len(words)
+                finished = step == len(words) or length_cut
+                yield SimpleNamespace(request_id=request_id, finished=finished, outputs=[SimpleNamespace(
+                    text=" ".join(words[:step]),
+                    token_ids=words[:step],
+                    finish_reason=("length" if length_cut else "stop") if finished else None,
+                )])
+                if finished:
+                    return
+        finally:
+            self.running.discard(request_id)
+            self._aborted.discard(request_id)
+
+
+def _build_stub_engine(model_path: str):
+    return StubAsyncEngine(), None, StubSamplingParams
+
+
+class VLLMBackend(BaseBackend):
+    def __init__(self, model_path: str = "deepseek-ai/DeepSeek-OCR",
+                 engine_factory: Optional[Callable[[str], tuple]] = None):
+        self.model_path = model_path
+        self.stub = engine_factory is None and OCR_VLLM_ENGINE == "stub"
+        self.engine_factory = engine_factory or (_build_stub_engine if self.stub else _build_vllm_engine)
+        self.device = "cpu" if self.stub else "cuda"
+        self.model = None  # the engine, once loaded (the service checks backend.model)
+        self.processor = None
+        self.engine = None
+        self.tokenizer = None
+        self.sampling_params_cls = None
+        self._ngram_processors: Dict[int, Any] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.active = 0
+        self.submitted = 0
+        self.aborted = 0
+        self.repetition_stops = 0
+
+    # ---- event loop thread ----
+
+    def _start_loop(self) -> None:
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="vllm-engine", daemon=True)
+        self._thread.start()
+
+    def _run(self, coro):
+        """Run a coroutine on the engine loop and wait for it from this thread"""
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def load_model(self, *args, **kwargs) -> bool:
+        print(f"📦 Loading DeepSeek-OCR on vLLM ({'stub engine' if self.stub else 'AsyncLLMEngine'})")
+        self._start_loop()
+
+        async def create():
+            # AsyncLLMEngine binds its background loop to the loop it is first used on
+            engine, processor, sampling_params_cls = self.engine_factory(self.model_path)
+            return engine, processor, sampling_params_cls, await engine.get_tokenizer()
+
+        self.engine, self.processor, self.sampling_params_cls, self.tokenizer = self._run(create())
+        self.model = self.engine
+        print(f"✅ vLLM engine ready (max {OCR_VLLM_MAX_SEQS} concurrent sequences)")
+        return True
+
+    def close(self) -> None:
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
+
+    # ---- request building ----
+
+    def _request(self, prompt: str, image_path: str) -> Dict[str, Any]:
+        """Engine input; image preprocessing runs in the calling thread, not on the loop"""
+        if "<image>" not in prompt:
+            return {"prompt": prompt}
+        with Image.open(image_path) as img:
+            image = ImageOps.exif_transpose(img).convert("RGB")
+        if self.processor is not None:
+            from config import CROP_MODE
+            image = self.processor.tokenize_with_images(images=[image], bos=True, eos=True, cropping=CROP_MODE)
+        return {"prompt": prompt, "multi_modal_data": {"image": image}}
+
+    def _sampling_params(self, options: GenerationOptions):
+        logits_processors = []
+        if options.no_repeat_ngram_size and not self.stub:
+            size = options.no_repeat_ngram_size
+            if size not in self._ngram_processors:
+                self._ngram_processors[size] = _ngram_processor(size)
+            # Stateful per sequence (vLLM clones it again per request, which is harmless)
+            logits_processors.append(self._ngram_processors[size].clone())
+        return self.sampling_params_cls(
+            temperature=0.0,
+            max_tokens=options.max_new_tokens,
+            logits_processors=logits_processors,
+            skip_special_tokens=False,
+        )
+
+    # ---- generation on the engine loop ----
+
+    async def _watch_cancel(self, event: threading.Event, task: asyncio.Task) -> None:
+        while not event.is_set():
+            await asyncio.sleep(CANCEL_POLL_S)
+        task.cancel()
+
+    async def _generate(self, request: Dict[str, Any], options: GenerationOptions,
+                        on_delta: Optional[Callable[[str], None]] = None) -> OCRText:
+        request_id = f"ocr-{uuid.uuid4().hex}"
+        detector = RepetitionDetector() if REPEAT_GUARD else None
+        watcher = None
+        if options.cancel_event is not None:
+            watcher = asyncio.ensure_future(self._watch_cancel(options.cancel_event, asyncio.current_task()))
+        with self._lock:
+            self.active += 1
+            self.submitted += 1
+        stream = self.engine.generate(request, self._sampling_params(options), request_id)
+        text, token_ids, finish_reason, fed = "", [], None, 0
+        try:
+            async for output in stream:
+                if not output.outputs:
+                    continue
+                completion = output.outputs[0]
+                if on_delta is not None and len(completion.text) > len(text):
+                    on_delta(completion.text[len(text):])
+                text, token_ids, finish_reason = completion.text, list(completion.token_ids), completion.finish_reason
+                if detector is None:
+                    continue
+                looping = False
+                for token in token_ids[fed:]:
+                    looping = detector.append(token) or looping
+                fed = len(token_ids)
+                if looping:
+                    await self.engine.abort(request_id)
+                    with self._lock:
+                        self.repetition_stops += 1
+                    kept = self.tokenizer.decode(token_ids[:detector.cut], skip_special_tokens=False)
+                    return OCRText(kept.rstrip(), truncated_repetition=True)
+        except asyncio.CancelledError:
+            # Cancel event, or the caller went away (closed stream / cancelled future)
+            await self.engine.abort(request_id)
+            with self._lock:
+                self.aborted += 1
+            if options.cancel_event is not None and options.cancel_event.is_set():
+                raise GenerationCancelled()
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            await stream.aclose()
+            with self._lock:
+                self.active -= 1
+        return OCRText(text, hit_token_limit=finish_reason == "length")
+
+    async def _generate_all(self, requests: List[Dict[str, Any]], options: GenerationOptions) -> List[OCRText]:
+        # Submitted together: the engine schedules them as one continuous batch
+        return list(await asyncio.gather(*(self._generate(request, options) for request in requests)))
+
+    # ---- backend contract ----
+
+    def infer(self, prompt: str, image_path: str, options: Optional[GenerationOptions] = None, **kwargs) -> str:
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        options.check_cancelled()
+        return self._run(self._generate(self._request(prompt, image_path), options))
+
+    def infer_batch(self, prompts: List[str], image_paths: List[str],
+                    options: Optional[GenerationOptions] = None, **kwargs) -> List[str]:
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        options.check_cancelled()
+        requests = [self._request(prompt, path) for prompt, path in zip(prompts, image_paths)]
+        return self._run(self._generate_all(requests, options))
+
+    def infer_stream(self, prompt: str, image_path: str,
+                     options: Optional[GenerationOptions] = None,
+                     **kwargs) -> Generator[str, None, str]:
+        options = GenerationOptions.from_kwargs(options, **kwargs)
+        options.check_cancelled()
+        deltas: "queue.Queue" = queue.Queue()
+        done = object()
+        future = asyncio.run_coroutine_threadsafe(
+            self._generate(self._request(prompt, image_path), options, deltas.put), self._loop)
+        future.add_done_callback(lambda _: deltas.put(done))
+        try:
+            while True:
+                delta = deltas.get()
+                if delta is done:
+                    break
+                yield delta
+        finally:
+            # Consumer stopped early: abort the request instead of generating to the end
+            if not future.done():
+                future.cancel()
+        return future.result()
+
+    def capabilities(self) -> Dict[str, Any]:
+        caps = super().capabilities()
+        caps.update({
+            "max_batch": OCR_VLLM_MAX_SEQS,
+            "max_concurrency": OCR_VLLM_MAX_SEQS,
+            "streaming": True,
+            "cancel": True,
+            "multi_prompt": True,
+            "resolution_modes": False,
+            "memory_managed": True,
+            "dtype": "auto",
+        })
+        return caps
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "engine": "stub" if self.stub else "vllm",
+                "active_requests": self.active,
+                "submitted": self.submitted,
+                "aborted": self.aborted,
+                "repetition_stops": self.repetition_stops,
+                "max_num_seqs": OCR_VLLM_MAX_SEQS,
+            }
+
+    @staticmethod
+    def is_available() -> bool:
+        try:
+            import vllm  # noqa: F401
+            import torch
+            return torch.cuda.is_available()
+        except ImportError:
+            return False
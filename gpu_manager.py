@@ -1,104 +1,363 @@
 #!/usr/bin/env python3
 """
-GPU Resource Manager - Lazy Load + Instant Offload
-懒加载 + 即用即卸的 GPU 显存管理
+GPU Resource Manager - Lazy Load + Leased Idle Offload
+懒加载 + 租约计数 + 空闲超时卸载的 GPU 显存管理
+
+推理前通过 lease() 借用模型，持有租约期间模型不会被卸载；
+最后一个租约归还后空闲超过 idle_timeout 秒才转移到 CPU（idle_timeout <= 0 时立即卸载）。
+CUDA 上卸载到锁页内存并异步拷贝（见 backends/offload.py），GPU_OFFLOAD_MODE=partial
+时只驱逐中间的解码层，直到空闲显存达到 GPU_OFFLOAD_FREE_MB。
+
+可按名称管理多个模型（不同 revision / 微调版本）：显存预算 GPU_MEMORY_BUDGET_MB 内尽量常驻，
+超出时把最久未用、无租约的模型整体卸载到锁页内存；内存缓存超过 GPU_CPU_CACHE_MB 时
+再把最久未用的已卸载模型丢回磁盘（下次请求重新加载）。
 """
+import os
 import time
 import threading
 import logging
 import torch
 import gc
-from typing import Optional, Callable
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional, Callable, Dict
+
+from backends.offload import WeightOffloader
+from backends.registry import model_bytes
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEFAULT_MODEL = "default"
+# 所有模型常驻显存的总预算（0 = 不限制，只靠空闲超时卸载）
+GPU_MEMORY_BUDGET_MB = int(os.environ.get("GPU_MEMORY_BUDGET_MB", "0"))
+# 已卸载模型在内存中缓存的总量上限（0 = 不限制）
+GPU_CPU_CACHE_MB = int(os.environ.get("GPU_CPU_CACHE_MB", "0"))
+
+
+@dataclass
+class ManagedModel:
+    """一个具名模型的状态"""
+    name: str
+    load_func: Callable
+    release_func: Optional[Callable] = None  # 丢回磁盘时调用（如从模型注册表移除）
+    cache_key: Optional[str] = None  # 视觉特征 / 图像前缀缓存键的模型部分（路径@revision），None 表示未知
+    model: object = None  # GPU 上的模型
+    model_on_cpu: object = None  # CPU 缓存（partial 模式下部分层仍在显存）
+    processor: object = None
+    offloader: Optional[WeightOffloader] = None  # 锁页内存卸载器，首次卸载时创建
+    nbytes: int = 0  # 权重总大小，首次加载后记录
+    active_leases: int = 0  # 正在使用该模型的请求数
+    last_use_time: float = 0
+    # 权重搬运耗时统计（秒）
+    transfers: dict = field(default_factory=lambda: {
+        "to_gpu": {"count": 0, "last": 0.0, "total": 0.0},
+        "to_cpu": {"count": 0, "last": 0.0, "total": 0.0},
+    })
+
+
 class GPUResourceManager:
     """GPU 资源管理器"""
     
-    def __init__(self, idle_timeout: int = 60):
+    def __init__(self, idle_timeout: int = 60, memory_budget_mb: int = GPU_MEMORY_BUDGET_MB,
+                 cpu_cache_mb: int = GPU_CPU_CACHE_MB):
         """
         Args:
             idle_timeout: 空闲超时时间（秒）
+            memory_budget_mb: 所有模型常驻显存的总预算（MB，0 = 不限制）
+            cpu_cache_mb: 已卸载模型的内存缓存上限（MB，0 = 不限制）
         """
         self.idle_timeout = idle_timeout
-        self.model = None  # GPU 上的模型
-        self.model_on_cpu = None  # CPU 缓存
-        self.processor = None
+        self.memory_budget = memory_budget_mb << 20
+        self.cpu_cache = cpu_cache_mb << 20
+        self.models: Dict[str, ManagedModel] = {}
         self.lock = threading.Lock()
-        self.last_use_time = 0
+        self.evictions = {"to_cpu": 0, "to_disk": 0}  # 因预算被驱逐的次数
         self.running = False
         self.monitor_thread = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         
-        logger.info(f"🎯 GPU Manager initialized (device={self.device}, timeout={idle_timeout}s)")
+        logger.info(f"🎯 GPU Manager initialized (device={self.device}, timeout={idle_timeout}s, "
+                    f"budget={memory_budget_mb or 'unlimited'}MB)")
+    
+    @property
+    def active_leases(self) -> int:
+        """所有模型上的租约总数"""
+        return sum(entry.active_leases for entry in self.models.values())
+    
+    def register(self, name: str, load_func: Callable, release_func: Optional[Callable] = None,
+                 cache_key: Optional[str] = None):
+        """登记一个具名模型（不加载），已登记时保持原状"""
+        with self.lock:
+            return self._register_locked(name, load_func, release_func, cache_key)
+    
+    def _register_locked(self, name: str, load_func: Callable, release_func: Optional[Callable] = None,
+                         cache_key: Optional[str] = None):
+        entry = self.models.get(name)
+        if entry is None:
+            entry = ManagedModel(name=name, load_func=load_func, release_func=release_func, cache_key=cache_key)
+            self.models[name] = entry
+        return entry
+    
+    def _entry(self, name: str, load_func: Optional[Callable]) -> ManagedModel:
+        """内部方法（需持有锁）：按名称取模型，未登记时用 load_func 登记"""
+        entry = self.models.get(name)
+        if entry is None:
+            if load_func is None:
+                raise KeyError(f"Unknown model: {name}")
+            entry = self._register_locked(name, load_func)
+        return entry
     
-    def get_model(self, load_func: Callable):
+    def get_model(self, load_func: Optional[Callable] = None, name: str = DEFAULT_MODEL):
         """
         懒加载逻辑：
         1. 如果在 GPU 上 → 直接返回
         2. 如果在 CPU 上 → 快速转移到 GPU（2-5秒）
         3. 如果未加载 → 从磁盘加载（首次 20-30秒）
+        
+        注意：不持有租约，返回的模型随时可能被卸载，推理请使用 lease()
         """
         with self.lock:
-            self.last_use_time = time.time()
-            
-            # 情况1: 已在 GPU 上
-            if self.model is not None:
-                logger.info("✅ Model already on GPU")
-                return self.model, self.processor
-            
-            # 情况2: 在 CPU 缓存中，快速转移
-            if self.model_on_cpu is not None:
-                logger.info("🔄 Moving model from CPU to GPU...")
-                start = time.time()
-                self.model = self.model_on_cpu.to(self.device)
-                self.model_on_cpu = None
-                logger.info(f"✅ Model moved to GPU in {time.time()-start:.1f}s")
-                return self.model, self.processor
-            
-            # 情况3: 首次加载
-            logger.info("📥 Loading model from disk (first time)...")
+            return self._ensure_on_gpu(self._entry(name, load_func))
+    
+    @contextmanager
+    def lease(self, load_func: Optional[Callable] = None, name: str = DEFAULT_MODEL):
+        """
+        借用模型：with gpu_manager.lease(load_model_func, name="default") as (model, processor): ...
+        持有期间模型保持在 GPU 上，手动卸载、空闲监控和预算驱逐都会跳过
+        """
+        with self.lock:
+            entry = self._entry(name, load_func)
+            loaded = self._ensure_on_gpu(entry)
+            entry.active_leases += 1
+        try:
+            yield loaded
+        finally:
+            with self.lock:
+                entry.active_leases -= 1
+                entry.last_use_time = time.time()
+                # 超时为 0：最后一个租约归还后立即卸载（旧的即用即卸行为）
+                if entry.active_leases == 0 and self.idle_timeout <= 0:
+                    self._offload_locked(entry, "lease released")
+    
+    def _ensure_on_gpu(self, entry: ManagedModel):
+        """内部方法（需持有锁）：确保模型在 GPU 上，必要时先按 LRU 腾出显存预算"""
+        entry.last_use_time = time.time()
+        
+        # 情况1: 已在 GPU 上
+        if entry.model is not None:
+            logger.info(f"✅ Model '{entry.name}' already on GPU")
+            return entry.model, entry.processor
+        
+        self._make_room(entry)
+        
+        # 情况2: 在 CPU 缓存中，快速转移
+        if entry.model_on_cpu is not None:
             start = time.time()
-            self.model, self.processor = load_func()
-            logger.info(f"✅ Model loaded in {time.time()-start:.1f}s")
-            return self.model, self.processor
+            if entry.offloader is not None:
+                # 只排队异步拷贝即返回，各解码层在前向前等待自己的权重（与预填充重叠）
+                logger.info(f"🔄 Prefetching model '{entry.name}' layers from pinned memory...")
+                entry.offloader.reload()
+                entry.model = entry.model_on_cpu
+            else:
+                logger.info(f"🔄 Moving model '{entry.name}' from CPU to GPU...")
+                entry.model = entry.model_on_cpu.to(self.device)
+            entry.model_on_cpu = None
+            self._trim_host_cache()
+            elapsed = self._record_transfer(entry, "to_gpu", start)
+            logger.info(f"✅ Model '{entry.name}' on GPU in {elapsed:.1f}s")
+            return entry.model, entry.processor
+        
+        # 情况3: 首次加载（或已被丢回磁盘）
+        logger.info(f"📥 Loading model '{entry.name}' from disk...")
+        start = time.time()
+        entry.model, entry.processor = entry.load_func()
+        entry.nbytes = sum(model_bytes(entry.model).values())
+        self._trim_host_cache()
+        logger.info(f"✅ Model '{entry.name}' loaded in {time.time()-start:.1f}s "
+                    f"({entry.nbytes / 1024**2:.0f} MB)")
+        return entry.model, entry.processor
+    
+    def _device_bytes(self, entry: ManagedModel) -> int:
+        """内部方法：模型当前占用的显存（partial 卸载后仍常驻的层也计入）"""
+        model = entry.model if entry.model is not None else entry.model_on_cpu
+        return model_bytes(model).get(torch.device(self.device).type, 0)
+    
+    def _partially_offloaded(self, entry: ManagedModel) -> bool:
+        """内部方法：partial 模式卸载后仍有层留在显存"""
+        return entry.model is None and entry.offloader is not None and self._device_bytes(entry) > 0
+    
+    def _make_room(self, entry: ManagedModel):
+        """内部方法（需持有锁）：按最久未用顺序卸载其他空闲模型，直到 entry 能放进显存预算"""
+        if self.memory_budget <= 0:
+            return
+        # 未加载过的模型按已知最大的模型估算
+        needed = entry.nbytes or max((e.nbytes for e in self.models.values()), default=0)
+        needed -= self._device_bytes(entry)
+        others = [e for e in self.models.values() if e is not entry]
+        resident = sum(self._device_bytes(e) for e in others)
+        for victim in sorted(others, key=lambda e: e.last_use_time):
+            if resident + needed <= self.memory_budget:
+                break
+            if victim.active_leases > 0:
+                continue
+            size = self._device_bytes(victim)
+            if size == 0:
+                continue
+            # 腾显存时整体卸载，不按 partial 模式保留层
+            self._offload_locked(victim, f"LRU eviction for '{entry.name}'", mode="full")
+            resident -= size - self._device_bytes(victim)
+            self.evictions["to_cpu"] += 1
+        if resident + needed > self.memory_budget:
+            logger.warning(f"⚠️ Model '{entry.name}' exceeds the memory budget "
+                           f"({(resident + needed) / 1024**2:.0f} MB > {self.memory_budget / 1024**2:.0f} MB), "
+                           f"other models are in use")
+    
+    def _host_bytes(self, entry: ManagedModel) -> int:
+        """内部方法：模型占用的内存缓存（锁页缓冲区在重新加载后也一直保留）"""
+        if entry.offloader is not None:
+            return int(entry.offloader.stats()["pinned_mb"] * (1 << 20))
+        return model_bytes(entry.model_on_cpu).get("cpu", 0)
+    
+    def _trim_host_cache(self):
+        """内部方法（需持有锁）：内存缓存超出上限时，把最久未用的已卸载模型丢回磁盘"""
+        if self.cpu_cache <= 0:
+            return
+        cached = sum(self._host_bytes(e) for e in self.models.values())
+        for victim in sorted(self.models.values(), key=lambda e: e.last_use_time):
+            if cached <= self.cpu_cache:
+                break
+            if victim.active_leases > 0 or victim.model is not None or victim.model_on_cpu is None:
+                continue
+            cached -= self._host_bytes(victim)
+            logger.info(f"🗑️ Dropping model '{victim.name}' from host memory (CPU cache limit)")
+            self._drop_locked(victim)
+            self.evictions["to_disk"] += 1
+    
+    def _drop_locked(self, entry: ManagedModel):
+        """内部方法（需持有锁）：丢弃模型的所有副本，下次使用时从磁盘重新加载"""
+        entry.model = None
+        entry.model_on_cpu = None
+        entry.processor = None
+        entry.offloader = None  # 同时释放锁页内存
+        if entry.release_func is not None:
+            entry.release_func()
+        gc.collect()
+    
+    def _record_transfer(self, entry: ManagedModel, direction: str, start: float) -> float:
+        """内部方法：记录一次权重搬运耗时"""
+        elapsed = time.time() - start
+        stats = entry.transfers[direction]
+        stats["count"] += 1
+        stats["last"] = elapsed
+        stats["total"] += elapsed
+        return elapsed
+    
+    def _offload_locked(self, entry: ManagedModel, reason: str, mode: Optional[str] = None) -> bool:
+        """内部方法（需持有锁）：无租约时卸载到 CPU"""
+        if entry.model is None and not (mode == "full" and self._partially_offloaded(entry)):
+            return False
+        if entry.active_leases > 0:
+            logger.info(f"⏳ Offload of '{entry.name}' skipped ({reason}): "
+                        f"{entry.active_leases} request(s) using the model")
+            return False
+        logger.info(f"💾 Offloading model '{entry.name}' to CPU ({reason})...")
+        start = time.time()
+        self._move_to_cpu(entry, mode)
+        elapsed = self._record_transfer(entry, "to_cpu", start)
+        logger.info(f"✅ Model '{entry.name}' offloaded in {elapsed:.1f}s")
+        return True
     
-    def force_offload(self):
+    def _selected(self, name: Optional[str]):
+        """内部方法：name 为 None 时选中所有模型"""
+        if name is None:
+            return list(self.models.values())
+        if name not in self.models:
+            raise KeyError(f"Unknown model: {name}")
+        return [self.models[name]]
+    
+    def force_offload(self, name: Optional[str] = None) -> bool:
         """
-        即用即卸：任务完成后立即调用
-        将模型从 GPU 转移到 CPU，释放显存
+        手动卸载：将模型（默认全部）从 GPU 转移到 CPU，释放显存
+        有请求持有租约的模型跳过，返回是否有模型被卸载
         """
         with self.lock:
-            if self.model is not None:
-                logger.info("💾 Offloading model to CPU...")
-                start = time.time()
-                self._move_to_cpu()
-                logger.info(f"✅ Model offloaded in {time.time()-start:.1f}s")
+            offloaded = False
+            for entry in self._selected(name):
+                offloaded = self._offload_locked(entry, "manual") or offloaded
+            return offloaded
     
-    def force_release(self):
+    def force_release(self, name: Optional[str] = None) -> bool:
         """
         完全释放：长期不用时调用
-        清空 GPU 和 CPU 缓存
+        清空模型（默认全部）的 GPU 和 CPU 缓存；有请求持有租约时跳过
         """
         with self.lock:
+            entries = self._selected(name)
+            busy = sum(entry.active_leases for entry in entries)
+            if busy > 0:
+                logger.info(f"⏳ Release skipped: {busy} request(s) using the model")
+                return False
             logger.info("🗑️ Releasing all resources...")
-            self.model = None
-            self.model_on_cpu = None
-            self.processor = None
+            for entry in entries:
+                self._drop_locked(entry)
+            from backends.vision_cache import get_vision_cache
+            from backends.prefix_cache import get_prefix_cache
+            from backends.kv_cache import get_kv_pool
+            if name is None:
+                get_vision_cache().clear()
+                get_prefix_cache().clear()
+            else:
+                # 只释放一个变体时保留其他变体的缓存
+                for entry in entries:
+                    self._clear_model_caches(entry)
+            if not self._others_resident(entries):
+                get_kv_pool().clear()
             gc.collect()
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
             logger.info("✅ All resources released")
+            return True
     
-    def _move_to_cpu(self):
-        """内部方法：将模型移到 CPU"""
-        if self.model is not None:
-            self.model_on_cpu = self.model.cpu()
-            self.model = None
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
+    def _clear_model_caches(self, entry: ManagedModel):
+        """内部方法：丢弃一个模型的图像前缀 KV 缓存，并把它的视觉特征转到内存"""
+        from backends.vision_cache import get_vision_cache
+        from backends.prefix_cache import get_prefix_cache
+        if entry.cache_key is None:
+            return
+        get_vision_cache().release_device(entry.cache_key)
+        get_prefix_cache().clear(entry.cache_key)
+    
+    def _others_resident(self, entries) -> bool:
+        """内部方法（需持有锁）：entries 以外是否还有模型在显存中（KV 缓冲池与模型无关，它们还会复用）"""
+        return any(all(e is not x for x in entries) and self._device_bytes(e) > 0 for e in self.models.values())
+    
+    def _move_to_cpu(self, entry: ManagedModel, mode: Optional[str] = None):
+        """内部方法：将模型移到 CPU（mode 覆盖 GPU_OFFLOAD_MODE）"""
+        # 只处理这个模型的缓存：视觉特征转到内存，图像前缀 KV 缓存丢弃；其他变体可能正在运行，缓存不动。
+        # 空闲的 KV 缓冲池只在没有其他模型留在显存时清空
+        # （先于权重释放，partial 模式按释放缓存后的空闲显存计算要驱逐的层数）
+        from backends.kv_cache import get_kv_pool
+        self._clear_model_caches(entry)
+        if not self._others_resident([entry]):
+            get_kv_pool().clear()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        
+        model = entry.model if entry.model is not None else entry.model_on_cpu
+        if WeightOffloader.supported(self.device):
+            if entry.offloader is None:
+                entry.offloader = WeightOffloader(model, self.device)
+            moved = entry.offloader.offload(mode)
+            logger.info(f"📌 {moved / 1024**2:.0f} MB moved to pinned memory ({mode or entry.offloader.mode})")
+            entry.model_on_cpu = model
+        else:
+            entry.model_on_cpu = model.cpu()
+        entry.model = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
     
     def start_monitor(self):
         """启动监控线程"""
@@ -119,27 +378,74 @@ class GPUResourceManager:
     
     def _monitor_loop(self):
         """监控循环：自动卸载空闲模型"""
+        # 检查间隔不超过超时的一半，最长 30 秒
+        interval = min(30, max(1, self.idle_timeout / 2))
         while self.running:
-            time.sleep(30)  # 每30秒检查
+            time.sleep(interval)
             
-            # 暂时禁用自动卸载，避免推理过程中被卸载
-            # with self.lock:
-            #     if self.model is not None:
-            #         idle_time = time.time() - self.last_use_time
-            #         
-            #         if idle_time > self.idle_timeout:
-            #             logger.info(f"⏰ Idle for {idle_time:.0f}s, auto-offloading...")
-            #             self._move_to_cpu()
+            # 持有租约的请求计入使用中，只卸载真正空闲的模型
+            with self.lock:
+                if self.idle_timeout <= 0:
+                    continue
+                for entry in self.models.values():
+                    if entry.model is not None and entry.active_leases == 0:
+                        idle_time = time.time() - entry.last_use_time
+                        
+                        if idle_time > self.idle_timeout:
+                            self._offload_locked(entry, f"idle for {idle_time:.0f}s")
+    
+    def _location(self, entry: ManagedModel) -> str:
+        """内部方法（需持有锁）：模型所在位置"""
+        if entry.model is not None:
+            return "gpu"
+        if entry.model_on_cpu is None:
+            return "unloaded"
+        # partial 模式：视觉编码器和首尾解码层仍在显存
+        if self._partially_offloaded(entry):
+            return "partial"
+        return "cpu"
+    
+    def _model_status(self, entry: ManagedModel) -> dict:
+        """内部方法（需持有锁）：单个模型的状态"""
+        status = {
+            "model_location": self._location(entry),
+            "idle_time": time.time() - entry.last_use_time if entry.last_use_time > 0 and entry.active_leases == 0 else 0,
+            "active_leases": entry.active_leases,
+            "size_mb": round(entry.nbytes / 1024**2, 1),
+            "device_mb": round(self._device_bytes(entry) / 1024**2, 1),
+            "transfers": {
+                direction: {
+                    "count": stats["count"],
+                    "last_s": round(stats["last"], 3),
+                    "total_s": round(stats["total"], 3),
+                }
+                for direction, stats in entry.transfers.items()
+            }
+        }
+        if entry.offloader is not None:
+            status["offload"] = entry.offloader.stats()
+        return status
     
     def get_status(self) -> dict:
-        """获取当前状态"""
+        """获取当前状态（顶层字段为默认模型，models 中为全部模型）"""
         with self.lock:
+            models = {name: self._model_status(entry) for name, entry in self.models.items()}
+            default = models.get(DEFAULT_MODEL) or {"model_location": "unloaded", "idle_time": 0}
             status = {
-                "model_location": "gpu" if self.model is not None else ("cpu" if self.model_on_cpu is not None else "unloaded"),
-                "idle_time": time.time() - self.last_use_time if self.last_use_time > 0 else 0,
+                "model_location": default["model_location"],
+                "idle_time": default["idle_time"],
                 "device": self.device,
-                "timeout": self.idle_timeout
+                "timeout": self.idle_timeout,
+                "active_leases": self.active_leases,
+                "memory_budget_mb": self.memory_budget >> 20,
+                "cpu_cache_mb": self.cpu_cache >> 20,
+                "evictions": dict(self.evictions),
+                "models": models,
             }
+            if "transfers" in default:
+                status["transfers"] = default["transfers"]
+            if "offload" in default:
+                status["offload"] = default["offload"]
             
             if torch.cuda.is_available():
                 status["gpu_memory_allocated"] = torch.cuda.memory_allocated() / 1024**2  # MB
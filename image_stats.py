@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Cheap image statistics computed on a small grayscale copy of a page.
+
+Blank-page screen: separator sheets and empty backsides are detected before
+inference (ink ratio, gray-level spread and edge density on a ~256 px
+thumbnail) so they can be answered with an empty result without touching the
+model. A page that passes those thresholds is only blank if a ~1024 px copy
+has no text line either: one short line is too little ink to show in the
+ratios, and dropping it would lose content silently.
+"""
+import os
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Max fraction of "ink" / edge pixels for a page to count as blank; 0 disables the screen.
+# Kept low on purpose: a single short line of text is ~0.05% of a page, and a
+# missed blank page only costs one inference while a false blank loses content.
+BLANK_PAGE_THRESHOLD = float(os.environ.get("BLANK_PAGE_THRESHOLD", "0.0002"))
+
+# Prompt types for which a blank page has a known (empty) answer
+BLANK_SCREEN_PROMPT_TYPES = ("document", "ocr", "free", "find")
+
+SCREEN_SIZE = 256       # longest side of the analysed thumbnail
+INK_DELTA = 16          # min gray levels below the paper level that count as ink
+NOISE_SIGMAS = 6        # ...raised to this many noise sigmas on grainy scans
+EDGE_DELTA = 24         # neighbour difference that counts as an edge
+
+LINE_SIZE = 1024        # longest side of the thumbnail for text line checks
+LINE_MIN_INK = 2        # inked pixels for a row to count as part of a line
+LINE_MIN_HEIGHT = 2     # thinner runs of inked rows are rules / noise
+
+
+def gray_thumbnail(img: Image.Image, size: int = SCREEN_SIZE) -> np.ndarray:
+    """Grayscale, box-filtered copy with the longest side <= size, as float32"""
+    if img.mode != "L":
+        img = img.convert("L")
+    factor = max(1, max(img.size) // size)
+    if factor > 1:
+        img = img.reduce(factor)
+    return np.asarray(img, dtype=np.float32)
+
+
+def ink_mask(gray: np.ndarray) -> np.ndarray:
+    """Pixels clearly darker than the paper level"""
+    paper = np.percentile(gray, 95)
+    # Robust noise estimate (MAD) so paper grain is not mistaken for ink
+    sigma = 1.4826 * float(np.median(np.abs(gray - np.median(gray))))
+    return gray < paper - max(INK_DELTA, NOISE_SIGMAS * sigma)
+
+
+def inked_row_runs(mask: np.ndarray, min_ink: int = LINE_MIN_INK) -> List[Tuple[int, int]]:
+    """(start, end) rows of each run of rows with at least min_ink inked pixels"""
+    rows = mask.sum(axis=1) >= min_ink
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], rows.astype(np.int8), [0]))))
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def has_text_line(gray: np.ndarray) -> bool:
+    """Any run of inked rows at least LINE_MIN_HEIGHT tall"""
+    return any(end - start >= LINE_MIN_HEIGHT for start, end in inked_row_runs(ink_mask(gray)))
+
+
+def ink_stats(gray: np.ndarray) -> Dict[str, float]:
+    """Ink ratio, gray-level std and edge density of a grayscale thumbnail"""
+    ink_ratio = float(np.mean(ink_mask(gray)))
+
+    gx = np.abs(np.diff(gray, axis=1)) > EDGE_DELTA
+    gy = np.abs(np.diff(gray, axis=0)) > EDGE_DELTA
+    edge_density = float((gx.sum() + gy.sum()) / max(1, gx.size + gy.size))
+
+    return {
+        "ink_ratio": round(ink_ratio, 5),
+        "std": round(float(gray.std()), 3),
+        "edge_density": round(edge_density, 5),
+    }
+
+
+def is_blank_page(img: Image.Image, threshold: float = BLANK_PAGE_THRESHOLD) -> Tuple[bool, Dict[str, Any]]:
+    """Returns (blank, stats). threshold <= 0 disables the screen."""
+    if threshold <= 0:
+        return False, {}
+    stats = ink_stats(gray_thumbnail(img))
+    blank = stats["ink_ratio"] <= threshold and stats["edge_density"] <= threshold
+    if blank:
+        stats["text_line"] = has_text_line(gray_thumbnail(img, LINE_SIZE))
+        blank = not stats["text_line"]
+    return blank, stats
+
+
+def is_blank_image_file(path: str, threshold: float = BLANK_PAGE_THRESHOLD) -> Tuple[bool, Dict[str, Any]]:
+    """is_blank_page for an image on disk; JPEGs are decoded at reduced size"""
+    if threshold <= 0:
+        return False, {}
+    with Image.open(path) as img:
+        img.draft("L", (LINE_SIZE, LINE_SIZE))
+        return is_blank_page(img, threshold)
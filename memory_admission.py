@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Memory-aware admission control for inference requests.
+
+Nothing used to relate an image's tile count or token budget to device
+memory, so a large page or a wide PDF batch on a 16-24 GB card could OOM
+the worker. MemoryEstimator predicts the peak memory of a request above the
+loaded weights:
+
+    peak(resolution mode, tiles) + KV bytes per token * max_new_tokens
+
+Both terms are measured at startup on CUDA (calibrate()): one prefill per
+resolution mode and Gundam tile count with max_new_tokens=1, and the KV
+cost per token from the same request with a larger budget. Unmeasured tile
+counts are interpolated; without calibration rough bf16 priors are used.
+
+MemoryAdmission compares estimates with what is available: free device
+memory plus the allocator's unused cache (CUDA), or MEMORY_CPU_BUDGET_MB
+(CPU backends, also capped by MemAvailable). A request that does not fit
+first reclaims pooled KV buffers and prefix caches, then waits up to
+ADMISSION_WAIT_S (only when the service runs several requests at once: with
+a single inference slot nothing in-process can free memory during the wait),
+then is downgraded to the largest smaller resolution mode
+that fits; only if even that fails is it rejected (InsufficientMemory).
+Batches are only grown while the whole batch fits.
+"""
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from regions import RESOLUTION_MODES, resolution_kwargs
+from backends.ocr_engine import MAX_CROPS, MIN_CROPS, count_tiles
+
+MEMORY_ADMISSION = os.environ.get("MEMORY_ADMISSION", "1") != "0"
+MEMORY_CALIBRATE = os.environ.get("MEMORY_CALIBRATE", "1") != "0"
+# Device memory never handed to requests (fragmentation, CUDA context, other tensors)
+MEMORY_RESERVE_MB = int(os.environ.get("MEMORY_RESERVE_MB", "1024"))
+# CPU backends: RAM for activations and KV cache (0 = no admission control on CPU)
+MEMORY_CPU_BUDGET_MB = int(os.environ.get("MEMORY_CPU_BUDGET_MB", "0"))
+ADMISSION_WAIT_S = float(os.environ.get("ADMISSION_WAIT_S", "10"))
+ADMISSION_POLL_S = 0.5
+CALIBRATION_TOKENS = 512    # extra budget of the KV-per-token measurement
+CALIBRATION_PROMPT = "<image>\nFree OCR. Only output the raw text."
+
+MB = 1 << 20
+# Rough bf16 priors (per request, above the weights), replaced by calibration
+PRIOR_VIEW_BYTES = {512: 96 * MB, 640: 160 * MB, 1024: 640 * MB}  # vision encoder + prefill per view
+PRIOR_KV_BYTES_PER_TOKEN = 64 * 1024
+
+# Largest first: the order requests are downgraded in
+DOWNGRADE_ORDER = ("gundam", "base", "small", "tiny")
+
+
+class InsufficientMemory(RuntimeError):
+    """A request does not fit in memory even at the smallest resolution mode"""
+
+
+ShapeKey = Tuple[int, int, bool, int]  # (base_size, image_size, crop_mode, tiles)
+
+
+def shape_key(width: int, height: int, infer_kwargs: Optional[Dict[str, Any]] = None) -> ShapeKey:
+    """What a request's memory depends on besides its token budget"""
+    kwargs = {**resolution_kwargs("gundam"), **(infer_kwargs or {})}
+    base_size, image_size, crop_mode = kwargs["base_size"], kwargs["image_size"], bool(kwargs["crop_mode"])
+    return base_size, image_size, crop_mode, count_tiles(width, height, base_size, image_size, crop_mode)
+
+
+def mode_of(infer_kwargs: Optional[Dict[str, Any]]) -> str:
+    """Resolution mode name of infer kwargs (gundam when unset)"""
+    kwargs = {**resolution_kwargs("gundam"), **(infer_kwargs or {})}
+    for mode, (base_size, image_size, crop_mode) in RESOLUTION_MODES.items():
+        if (kwargs["base_size"], kwargs["image_size"], bool(kwargs["crop_mode"])) == (base_size, image_size, crop_mode):
+            return mode
+    return "gundam"
+
+
+def _config_kv_bytes(model, dtype_bytes: int = 2) -> Optional[int]:
+    """KV cache bytes per token from a transformers config, None if it lacks the fields"""
+    config = getattr(model, "config", None)
+    for cfg in (getattr(config, "language_config", None), config):
+        if cfg is None or isinstance(cfg, dict):
+            continue
+        layers = getattr(cfg, "num_hidden_layers", None)
+        heads = getattr(cfg, "num_attention_heads", None)
+        hidden = getattr(cfg, "hidden_size", None)
+        if not (layers and heads and hidden):
+            continue
+        kv_heads = getattr(cfg, "num_key_value_heads", None) or heads
+        head_dim = getattr(cfg, "head_dim", None) or hidden // heads
+        v_head_dim = getattr(cfg, "v_head_dim", None) or head_dim
+        return layers * kv_heads * (head_dim + v_head_dim) * dtype_bytes
+    return None
+
+
+class MemoryEstimator:
+    """Peak memory of a request above the weights, by shape and token budget"""
+
+    def __init__(self, kv_bytes_per_token: int = PRIOR_KV_BYTES_PER_TOKEN):
+        self.peaks: Dict[ShapeKey, int] = {}
+        self.kv_bytes_per_token = kv_bytes_per_token
+        self.calibrated = False
+
+    def _prior(self, key: ShapeKey) -> int:
+        base_size, image_size, _, tiles = key
+        return PRIOR_VIEW_BYTES.get(base_size, PRIOR_VIEW_BYTES[1024]) + \
+            tiles * PRIOR_VIEW_BYTES.get(image_size, PRIOR_VIEW_BYTES[640])
+
+    def peak(self, key: ShapeKey) -> int:
+        if key in self.peaks:
+            return self.peaks[key]
+        # Interpolate / extrapolate linearly over the measured tile counts of this mode
+        points = sorted((k[3], v) for k, v in self.peaks.items() if k[:3] == key[:3])
+        if len(points) < 2:
+            return self._prior(key)
+        tiles = key[3]
+        lower = [p for p in points if p[0] < tiles]
+        upper = [p for p in points if p[0] > tiles]
+        if lower and upper:
+            (t0, p0), (t1, p1) = lower[-1], upper[0]
+        elif lower:
+            (t0, p0), (t1, p1) = lower[-2:]
+        else:
+            (t0, p0), (t1, p1) = upper[:2]
+        return max(0, int(p0 + (p1 - p0) * (tiles - t0) / (t1 - t0)))
+
+    def estimate(self, key: ShapeKey, max_new_tokens: int) -> int:
+        return self.peak(key) + self.kv_bytes_per_token * max_new_tokens
+
+    def estimate_batch(self, keys: List[ShapeKey], max_new_tokens: int) -> int:
+        """Rows of a batch each hold their own activations and KV cache"""
+        return sum(self.estimate(key, max_new_tokens) for key in keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calibrated": self.calibrated,
+            "kv_kb_per_token": round(self.kv_bytes_per_token / 1024, 1),
+            "peak_mb": {
+                f"{mode_of(dict(zip(('base_size', 'image_size', 'crop_mode'), key[:3])))}/{key[3]}":
+                    round(value / MB, 1)
+                for key, value in sorted(self.peaks.items())
+            },
+        }
+
+
+def _calibration_shapes() -> List[Tuple[Dict[str, Any], int, int]]:
+    """(infer kwargs, width, height): every resolution mode, and Gundam at each tile count"""
+    shapes = [(resolution_kwargs(mode), size, size)
+              for mode, (size, _, crop) in RESOLUTION_MODES.items() if not crop]
+    gundam = resolution_kwargs("gundam")
+    # Small images run Gundam without tiles
+    shapes.append((gundam, gundam["image_size"], gundam["image_size"]))
+    seen = set()
+    for cols in range(1, MAX_CROPS + 1):
+        for rows in range(1, MAX_CROPS + 1):
+            tiles = cols * rows
+            if MIN_CROPS <= tiles <= MAX_CROPS and tiles not in seen:
+                seen.add(tiles)
+                size = gundam["image_size"]
+                shapes.append((gundam, cols * size, rows * size))
+    return shapes
+
+
+def _reclaim_caches() -> None:
+    """Drop pooled KV buffers and image-prefix KV caches (both are rebuilt on demand)"""
+    from backends.kv_cache import get_kv_pool
+    from backends.prefix_cache import get_prefix_cache
+    get_kv_pool().clear()
+    get_prefix_cache().clear()
+
+
+def calibrate(infer: Callable[..., Any], model, device: str) -> MemoryEstimator:
+    """Measure peak CUDA allocation of infer(prompt, path, max_new_tokens=..., **kwargs)
+    for every calibration shape, and the KV cost per generated token.
+    infer must honour max_new_tokens (the native engine): on model.infer every
+    measurement could decode the full 8192 tokens."""
+    import torch
+    from backends.vision_cache import get_vision_cache
+
+    config_kv = _config_kv_bytes(model)
+    estimator = MemoryEstimator(config_kv or PRIOR_KV_BYTES_PER_TOKEN)
+
+    def measure(path: str, max_new_tokens: int, **infer_kwargs) -> int:
+        # Cached vision features / prefixes would skip the work being measured
+        get_vision_cache().clear()
+        _reclaim_caches()
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+        infer(CALIBRATION_PROMPT, path, max_new_tokens=max_new_tokens, **infer_kwargs)
+        torch.cuda.synchronize(device)
+        return max(0, torch.cuda.max_memory_allocated(device) - baseline)
+
+    start = time.time()
+    paths: Dict[ShapeKey, str] = {}
+    try:
+        for infer_kwargs, width, height in _calibration_shapes():
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
+                Image.new("RGB", (width, height), "white").save(tmp, format="PNG")
+            key = shape_key(width, height, infer_kwargs)
+            paths[key] = tmp.name
+            estimator.peaks[key] = measure(tmp.name, 1, **infer_kwargs)
+
+        # KV per token: the same request with a larger budget. The native engine
+        # preallocates KV for the budget, so this holds even if EOS comes early;
+        # the config-derived size is the floor for engines that grow the cache.
+        base = resolution_kwargs("base")
+        base_key = shape_key(base["base_size"], base["base_size"], base)
+        larger = measure(paths[base_key], 1 + CALIBRATION_TOKENS, **base)
+        measured_kv = (larger - estimator.peaks[base_key]) // CALIBRATION_TOKENS
+        estimator.kv_bytes_per_token = max(config_kv or 0, measured_kv) or PRIOR_KV_BYTES_PER_TOKEN
+    finally:
+        for path in paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+        _reclaim_caches()
+        torch.cuda.empty_cache()
+
+    estimator.calibrated = True
+    print(f"📏 Memory estimator calibrated in {time.time() - start:.1f}s "
+          f"({len(estimator.peaks)} shapes, {estimator.kv_bytes_per_token / 1024:.0f} KB/token)")
+    return estimator
+
+
+def _host_available() -> Optional[int]:
+    """MemAvailable from /proc/meminfo (Linux), None elsewhere"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemoryAdmission:
+    """Decides whether a request or batch may run now, at which resolution mode"""
+
+    def __init__(self, estimator: MemoryEstimator, device: str, active: bool = True,
+                 wait_s: float = ADMISSION_WAIT_S):
+        self.estimator = estimator
+        self.device = str(device)
+        self.active = active  # False for backends that manage their own memory (vLLM)
+        # Admission runs while the request holds an inference slot: with only one
+        # slot there is no other request to finish, so waiting only stalls the queue
+        self.wait_s = wait_s
+        self.reserve = MEMORY_RESERVE_MB * MB
+        self.waits = 0
+        self.downgrades = 0
+        self.rejections = 0
+        self.split_batches = 0
+
+    @property
+    def enabled(self) -> bool:
+        if not MEMORY_ADMISSION or not self.active:
+            return False
+        return self.device.startswith("cuda") or (self.device == "cpu" and MEMORY_CPU_BUDGET_MB > 0)
+
+    def available(self) -> Optional[int]:
+        """Bytes a new request may use now, None when unknown"""
+        if not self.enabled:
+            return None
+        if self.device.startswith("cuda"):
+            import torch
+            free, _ = torch.cuda.mem_get_info(self.device)
+            cached = torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+            return free + cached - self.reserve
+        # Requests run one at a time, so the whole budget is available to each
+        budget = MEMORY_CPU_BUDGET_MB * MB
+        host = _host_available()
+        return min(budget, host - self.reserve) if host is not None else budget
+
+    def fits(self, need: int) -> bool:
+        available = self.available()
+        return available is None or need <= available
+
+    def _wait_for(self, need: int) -> bool:
+        """Reclaim caches, then poll until need fits or wait_s passes"""
+        if self.fits(need):
+            return True
+        _reclaim_caches()
+        if self.device.startswith("cuda"):
+            import torch
+            torch.cuda.empty_cache()
+        deadline = time.time() + self.wait_s
+        waited = False
+        while not self.fits(need):
+            if time.time() >= deadline:
+                return False
+            if not waited:
+                waited = True
+                self.waits += 1
+                print(f"⏳ Waiting for {need / MB:.0f} MB (available {self.available() / MB:.0f} MB)")
+            time.sleep(ADMISSION_POLL_S)
+        return True
+
+    def admit(self, width: int, height: int, max_new_tokens: int,
+              infer_kwargs: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], Optional[str]]:
+        """(infer kwargs to run with, downgraded mode or None) for one image.
+        Raises InsufficientMemory when not even the smallest mode fits."""
+        infer_kwargs = dict(infer_kwargs or {})
+        if not self.enabled:
+            return infer_kwargs, None
+        need = self.estimator.estimate(shape_key(width, height, infer_kwargs), max_new_tokens)
+        if self._wait_for(need):
+            return infer_kwargs, None
+        # Largest smaller mode that fits now
+        for mode in DOWNGRADE_ORDER:
+            kwargs = {**infer_kwargs, **resolution_kwargs(mode)}
+            smaller = self.estimator.estimate(shape_key(width, height, kwargs), max_new_tokens)
+            if smaller < need and self.fits(smaller):
+                self.downgrades += 1
+                print(f"📉 Not enough memory for {need / MB:.0f} MB, running at {mode} ({smaller / MB:.0f} MB)")
+                return kwargs, mode
+        self.rejections += 1
+        raise InsufficientMemory(
+            f"Not enough memory: request needs {need / MB:.0f} MB, {max(0, self.available() or 0) / MB:.0f} MB available"
+        )
+
+    def batch_size(self, keys: List[ShapeKey], max_new_tokens: int) -> int:
+        """How many of the leading requests may run as one batch (at least 1:
+        a single request goes through admit())"""
+        if not self.enabled or len(keys) <= 1:
+            return len(keys)
+        if self._wait_for(self.estimator.estimate_batch(keys, max_new_tokens)):
+            return len(keys)
+        n = len(keys) - 1
+        while n > 1 and not self.fits(self.estimator.estimate_batch(keys[:n], max_new_tokens)):
+            n -= 1
+        self.split_batches += 1
+        return n
+
+    def stats(self) -> Dict[str, Any]:
+        available = self.available()
+        return {
+            "enabled": self.enabled,
+            "available_mb": round(available / MB, 1) if available is not None else None,
+            "reserve_mb": MEMORY_RESERVE_MB,
+            "wait_s": self.wait_s,
+            "waits": self.waits,
+            "downgrades": self.downgrades,
+            "rejections": self.rejections,
+            "split_batches": self.split_batches,
+            **self.estimator.stats(),
+        }
+
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+PDF helpers shared by the web services and the vLLM PDF script.
+
+Text-layer fast path: born-digital pages already carry their text, so we can
+build the same grounding-format output the model produces
+(<|ref|>label<|/ref|><|det|>[[x1, y1, x2, y2]]<|/det|> + content, coordinates
+normalized to 0-999) straight from the PDF and skip inference.
+
+Embedded-image fast path: scanned pages are usually one JPEG/JBIG2 image
+covering the page, so we pull that image out at native resolution instead of
+rasterizing the page and round-tripping it through PNG.
+"""
+import html
+import io
+import os
+import statistics
+from typing import Optional, List, Dict, Any
+
+import fitz
+from PIL import Image
+
+# Per-page policy: auto = use a trustworthy text layer, otherwise OCR
+#                  ocr  = always run the model
+#                  text = never run the model (extraction only, may be empty)
+TEXT_LAYER_POLICIES = ("auto", "ocr", "text")
+DEFAULT_TEXT_LAYER_POLICY = os.environ.get("PDF_TEXT_LAYER", "auto").lower()
+
+# Prompt types whose output a text layer can stand in for
+TEXT_LAYER_PROMPT_TYPES = ("document", "ocr", "free")
+
+# Trust thresholds for "auto"
+TEXT_LAYER_MIN_CHARS = 30           # fewer visible characters -> treat as image-only
+TEXT_LAYER_MAX_BAD_RATIO = 0.05     # replacement / private-use glyphs (broken ToUnicode maps)
+TEXT_LAYER_MAX_INVISIBLE_RATIO = 0.5  # invisible text = OCR layer of a scan, re-OCR instead
+TEXT_LAYER_MAX_IMAGE_COVERAGE = 0.9   # a page-sized image means a scan
+
+TITLE_SIZE_RATIO = 1.3  # span size vs body size to be labelled as a title
+
+# A page is a plain scan if one image covers at least this much of it
+FULL_PAGE_IMAGE_COVERAGE = 0.95
+# Encodings that can be passed on as-is (PIL and browsers decode them)
+PASSTHROUGH_IMAGE_TYPES = {"jpeg": "image/jpeg", "jpg": "image/jpeg", "png": "image/png"}
+
+
+def _is_bad_char(ch: str) -> bool:
+    code = ord(ch)
+    return ch == "\ufffd" or 0xE000 <= code <= 0xF8FF or (code < 32 and ch not in "\t\n\r")
+
+
+def _norm_box(bbox, page_rect) -> List[int]:
+    """PDF points -> model-style 0-999 coordinates"""
+    w, h = page_rect.width or 1, page_rect.height or 1
+    x0, y0, x1, y1 = bbox
+    return [
+        max(0, min(999, int((x0 - page_rect.x0) / w * 999))),
+        max(0, min(999, int((y0 - page_rect.y0) / h * 999))),
+        max(0, min(999, int((x1 - page_rect.x0) / w * 999))),
+        max(0, min(999, int((y1 - page_rect.y0) / h * 999))),
+    ]
+
+
+def _inside(inner, outer, tolerance: float = 2.0) -> bool:
+    return (inner[0] >= outer[0] - tolerance and inner[1] >= outer[1] - tolerance and
+            inner[2] <= outer[2] + tolerance and inner[3] <= outer[3] + tolerance)
+
+
+def _block_text(block: dict) -> tuple[str, float]:
+    """Join the lines of a text block into one paragraph. Returns (text, max span size)"""
+    parts = []
+    max_size = 0.0
+    for line in block.get("lines", []):
+        line_text = "".join(span["text"] for span in line.get("spans", [])).strip()
+        for span in line.get("spans", []):
+            if span["text"].strip():
+                max_size = max(max_size, span["size"])
+        if not line_text:
+            continue
+        if parts and parts[-1].endswith("-"):
+            parts[-1] = parts[-1][:-1] + line_text  # de-hyphenate
+        else:
+            parts.append(line_text)
+    return " ".join(parts), max_size
+
+
+def _table_html(rows: List[List[Optional[str]]]) -> str:
+    cells = "".join(
+        "<tr>" + "".join(f"<td>{html.escape((cell or '').strip())}</td>" for cell in row) + "</tr>"
+        for row in rows
+    )
+    return f"<table>{cells}</table>"
+
+
+def analyze_text_layer(page) -> Dict[str, Any]:
+    """Inspect a page's embedded text layer.
+
+    Returns a dict with the layer statistics and the trust verdict for "auto":
+        chars, bad_ratio, invisible_ratio, image_coverage, trusted, reason
+    """
+    text = page.get_text("text")
+    visible = [ch for ch in text if not ch.isspace()]
+    chars = len(visible)
+    bad_ratio = sum(1 for ch in visible if _is_bad_char(ch)) / chars if chars else 0.0
+
+    # Invisible text (render mode 3) is what OCR tools put over scans
+    invisible_ratio = 0.0
+    try:
+        traces = page.get_texttrace()
+        total = sum(len(t["chars"]) for t in traces)
+        if total:
+            invisible_ratio = sum(len(t["chars"]) for t in traces if t.get("type") == 3 or t.get("opacity", 1) == 0) / total
+    except (AttributeError, RuntimeError):
+        pass
+
+    page_area = abs(page.rect) or 1
+    image_coverage = 0.0
+    for info in page.get_image_info():
+        rect = fitz.Rect(info["bbox"]) & page.rect
+        image_coverage = max(image_coverage, abs(rect) / page_area)
+
+    if chars < TEXT_LAYER_MIN_CHARS:
+        trusted, reason = False, "no_text"
+    elif bad_ratio > TEXT_LAYER_MAX_BAD_RATIO:
+        trusted, reason = False, "garbled_text"
+    elif invisible_ratio > TEXT_LAYER_MAX_INVISIBLE_RATIO:
+        trusted, reason = False, "invisible_text"
+    elif image_coverage > TEXT_LAYER_MAX_IMAGE_COVERAGE:
+        trusted, reason = False, "full_page_image"
+    else:
+        trusted, reason = True, "text_layer"
+
+    return {
+        "chars": chars,
+        "bad_ratio": round(bad_ratio, 4),
+        "invisible_ratio": round(invisible_ratio, 4),
+        "image_coverage": round(image_coverage, 4),
+        "trusted": trusted,
+        "reason": reason,
+    }
+
+
+def extract_text_layer(page, grounding: bool = True) -> str:
+    """Build model-style output from the page's text layer.
+
+    grounding=True produces <|ref|>/<|det|> blocks (title / text / table / image)
+    like "Convert the document to markdown."; grounding=False returns plain text
+    like "Free OCR.".
+    """
+    page_rect = page.rect
+    data = page.get_text("dict", sort=True)
+    blocks = data.get("blocks", [])
+
+    # Body font size = size most characters are set in
+    sizes = []
+    for block in blocks:
+        for line in block.get("lines", []):
+            for span in line.get("spans", []):
+                sizes.extend([round(span["size"], 1)] * len(span["text"].strip()))
+    body_size = statistics.median(sizes) if sizes else 0.0
+
+    tables = []
+    if grounding:
+        try:
+            tables = [(tuple(t.bbox), t.extract()) for t in page.find_tables().tables]
+        except Exception:
+            tables = []  # find_tables needs PyMuPDF >= 1.23
+
+    items = []  # (y0, x0, rendered text)
+    for bbox, rows in tables:
+        items.append((bbox[1], bbox[0], f"<|ref|>table<|/ref|><|det|>[{_norm_box(bbox, page_rect)}]<|/det|>\n{_table_html(rows)}"))
+
+    for block in blocks:
+        bbox = block["bbox"]
+        if any(_inside(bbox, t_bbox) for t_bbox, _ in tables):
+            continue
+        if block.get("type") == 1:
+            if grounding:
+                items.append((bbox[1], bbox[0], f"<|ref|>image<|/ref|><|det|>[{_norm_box(bbox, page_rect)}]<|/det|>"))
+            continue
+        content, size = _block_text(block)
+        if not content:
+            continue
+        if not grounding:
+            items.append((bbox[1], bbox[0], content))
+            continue
+        if body_size and size >= body_size * TITLE_SIZE_RATIO:
+            label, content = "title", f"## {content}"
+        else:
+            label = "text"
+        items.append((bbox[1], bbox[0], f"<|ref|>{label}<|/ref|><|det|>[{_norm_box(bbox, page_rect)}]<|/det|>\n{content}"))
+
+    items.sort(key=lambda item: (round(item[0]), item[1]))
+    return "\n\n".join(text for _, _, text in items)
+
+
+def text_layer_for_page(page, policy: str = DEFAULT_TEXT_LAYER_POLICY,
+                        prompt_type: str = "document") -> Optional[Dict[str, Any]]:
+    """Decide whether a page can skip the model.
+
+    Returns None when the page must go to the model, otherwise
+    {"raw_text": ..., "analysis": ...} with model-style output.
+    """
+    policy = policy if policy in TEXT_LAYER_POLICIES else "auto"
+    if policy == "ocr" or prompt_type not in TEXT_LAYER_PROMPT_TYPES:
+        return None
+
+    analysis = analyze_text_layer(page)
+    if policy == "auto" and not analysis["trusted"]:
+        return None
+
+    raw_text = extract_text_layer(page, grounding=prompt_type != "free")
+    return {"raw_text": raw_text, "analysis": analysis}
+
+
+def page_pixel_size(page, dpi: int = 144) -> tuple[int, int]:
+    """Pixel size a page renders to at the given DPI (matches get_pixmap)"""
+    zoom = dpi / 72.0
+    rect = page.rect * fitz.Matrix(zoom, zoom)
+    return int(round(rect.width)), int(round(rect.height))
+
+
+def find_page_image(page) -> Optional[int]:
+    """Return the xref of the single image a scanned page consists of.
+
+    Returns None for composite pages (several images, visible text, vector
+    drawings, soft masks, rotated or flipped placement), which must be rasterized.
+    """
+    if page.rotation:
+        return None
+    images = page.get_images(full=True)
+    if len(images) != 1 or images[0][1]:  # (xref, smask, ...)
+        return None
+
+    infos = page.get_image_info(xrefs=True)
+    if len(infos) != 1:  # same image drawn more than once
+        return None
+    a, b, c, d, _, _ = infos[0]["transform"]
+    if abs(b) > 1e-6 or abs(c) > 1e-6 or a <= 0 or d <= 0:
+        return None
+    # The whole image must be visible: an image bleeding past the page / CropBox
+    # would be extracted with its off-page area and boxes mapped to the wrong frame
+    rect = fitz.Rect(infos[0]["bbox"])
+    if not _inside(tuple(rect), tuple(page.rect)):
+        return None
+    if abs(rect & page.rect) < FULL_PAGE_IMAGE_COVERAGE * abs(page.rect):
+        return None
+
+    # Invisible OCR text over the scan is fine, anything visible is not
+    try:
+        if any(t.get("type") != 3 and t.get("opacity", 1) > 0 for t in page.get_texttrace()):
+            return None
+    except (AttributeError, RuntimeError):
+        if page.get_text("text").strip():
+            return None
+    if page.get_drawings():
+        return None
+
+    return images[0][0]
+
+
+def extract_page_image(pdf_doc, page) -> Optional[Dict[str, Any]]:
+    """Pull a scanned page's embedded image at native resolution.
+
+    Returns None when the page must be rasterized, otherwise
+        {"image": RGB PIL image,
+         "data": original encoded bytes or None, "mime": their MIME type or None}
+    "data" is only set for JPEG/PNG streams that decode correctly without the
+    PDF's colour handling (RGB/gray, no /Decode array), so it can be forwarded
+    without re-encoding.
+    """
+    xref = find_page_image(page)
+    if xref is None:
+        return None
+
+    info = pdf_doc.extract_image(xref)
+    mime = PASSTHROUGH_IMAGE_TYPES.get(info.get("ext", ""))
+    plain_colors = info.get("colorspace") in (1, 3) and pdf_doc.xref_get_key(xref, "Decode")[0] == "null"
+    if mime and plain_colors:
+        data = info["image"]
+        return {"image": Image.open(io.BytesIO(data)).convert("RGB"), "data": data, "mime": mime}
+
+    # JBIG2, CCITT, CMYK, JPX...: let MuPDF decode the image itself (no page render)
+    pix = fitz.Pixmap(pdf_doc, xref)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.n == 1:
+        img = Image.frombytes("L", (pix.width, pix.height), pix.samples).convert("RGB")
+    else:
+        if pix.colorspace is None or pix.colorspace.n != 3:
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    return {"image": img, "data": None, "mime": None}
+
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Region-of-interest helpers for /ocr.
+
+Regions are parsed from the request, padded and clamped to the image, cropped,
+and each crop is sent to the model at the smallest resolution mode that covers
+it (a field or a table does not need the 6-tile Gundam mode). Coordinates the
+model emits for a crop are rewritten into the original image frame, so both
+raw_text consumers and boxes keep working unchanged.
+"""
+import ast
+import json
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+# Resolution modes of DeepSeek-OCR: (base_size, image_size, crop_mode)
+RESOLUTION_MODES = {
+    "tiny": (512, 512, False),      # 64 vision tokens
+    "small": (640, 640, False),     # 100 vision tokens
+    "base": (1024, 1024, False),    # 256 vision tokens
+    "gundam": (1024, 640, True),    # 256 + up to 6 x 100 tile tokens
+}
+
+# Extra context kept around each region, in pixels of the original image
+REGION_PADDING = int(os.environ.get("REGION_PADDING", "16"))
+MAX_REGIONS = 16
+# Regions smaller than this (after padding) are rejected
+MIN_REGION_SIZE = 8
+
+
+def _as_box(item: Any) -> Tuple[List[float], str]:
+    """One region spec -> ([x1, y1, x2, y2], units); units is "", "px" or "norm" """
+    units = ""
+    if isinstance(item, dict):
+        units = str(item.get("units", "")).lower()
+        if "box" in item:
+            item = item["box"]
+        elif all(k in item for k in ("x", "y", "w", "h")):
+            item = [item["x"], item["y"], item["x"] + item["w"], item["y"] + item["h"]]
+        else:
+            item = [item.get("x1"), item.get("y1"), item.get("x2"), item.get("y2")]
+    if not isinstance(item, (list, tuple)) or len(item) != 4:
+        raise ValueError("each region must be [x1, y1, x2, y2] or an object with box / x,y,w,h / x1,y1,x2,y2")
+    try:
+        box = [float(v) for v in item]
+    except (TypeError, ValueError):
+        raise ValueError(f"region coordinates must be numbers: {item}")
+    if units not in ("", "px", "norm"):
+        raise ValueError(f"region units must be px or norm, got {units}")
+    return box, units
+
+
+def parse_regions(spec: str, width: int, height: int, padding: int = REGION_PADDING) -> List[Tuple[int, int, int, int]]:
+    """Parse a JSON region list into padded pixel boxes clamped to the image.
+
+    Accepts a single region or a list of regions. Coordinates are normalized
+    (0-1) when units="norm" or when units are omitted and all values are <= 1,
+    pixels otherwise. Raises ValueError on malformed input.
+    """
+    try:
+        parsed = json.loads(spec)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"regions must be JSON: {e}")
+
+    # A single region: [x1, y1, x2, y2] or {...}
+    if isinstance(parsed, dict) or (isinstance(parsed, list) and len(parsed) == 4
+                                    and all(isinstance(v, (int, float)) for v in parsed)):
+        parsed = [parsed]
+    if not isinstance(parsed, list) or not parsed:
+        raise ValueError("regions must be a non-empty list")
+    if len(parsed) > MAX_REGIONS:
+        raise ValueError(f"at most {MAX_REGIONS} regions per request")
+
+    regions = []
+    for item in parsed:
+        box, units = _as_box(item)
+        if units == "norm" or (units == "" and all(0 <= v <= 1 for v in box)):
+            box = [box[0] * width, box[1] * height, box[2] * width, box[3] * height]
+        x1, x2 = sorted((box[0], box[2]))
+        y1, y2 = sorted((box[1], box[3]))
+        x1 = max(0, int(x1) - padding)
+        y1 = max(0, int(y1) - padding)
+        x2 = min(width, int(round(x2)) + padding)
+        y2 = min(height, int(round(y2)) + padding)
+        if x2 - x1 < MIN_REGION_SIZE or y2 - y1 < MIN_REGION_SIZE:
+            raise ValueError(f"region {item} is empty or outside the {width}x{height} image")
+        regions.append((x1, y1, x2, y2))
+    return regions
+
+
+def resolution_mode_for(width: int, height: int) -> str:
+    """Smallest resolution mode whose input size covers the crop without downscaling"""
+    longest = max(width, height)
+    for mode in ("tiny", "small", "base"):
+        if longest <= RESOLUTION_MODES[mode][0]:
+            return mode
+    return "gundam"
+
+
+def resolution_kwargs(mode: str) -> Dict[str, Any]:
+    """Backend infer() kwargs for a resolution mode"""
+    base_size, image_size, crop_mode = RESOLUTION_MODES[mode]
+    return {"base_size": base_size, "image_size": image_size, "crop_mode": crop_mode}
+
+
+_DET_PATTERN = re.compile(r"(<\|det\|>\s*)(\[.*?\])(\s*<\|/det\|>)", re.DOTALL)
+
+
+def remap_grounding(text: str, region: Tuple[int, int, int, int], width: int, height: int) -> str:
+    """Rewrite <|det|> coordinates (0-999, relative to the crop) into the
+    0-999 frame of the full width x height image"""
+    x0, y0, x1, y1 = region
+    crop_w, crop_h = x1 - x0, y1 - y0
+
+    def to_full(v: float, crop_size: int, offset: int, size: int) -> int:
+        return max(0, min(999, int(round((v / 999 * crop_size + offset) / size * 999))))
+
+    def remap(m: re.Match) -> str:
+        try:
+            parsed = ast.literal_eval(m.group(2))
+            single = isinstance(parsed, list) and len(parsed) == 4 and all(isinstance(v, (int, float)) for v in parsed)
+            mapped = [
+                [to_full(box[0], crop_w, x0, width), to_full(box[1], crop_h, y0, height),
+                 to_full(box[2], crop_w, x0, width), to_full(box[3], crop_h, y0, height)]
+                for box in ([parsed] if single else parsed)
+            ]
+        except (ValueError, SyntaxError, TypeError, IndexError):
+            # Leave anything we cannot parse untouched
+            return m.group(0)
+        return m.group(1) + str(mapped[0] if single else mapped).replace(" ", "") + m.group(3)
+
+    return _DET_PATTERN.sub(remap, text)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Per-request max_new_tokens budget predicted from the image.
+
+Every request used to allow the full 8192 generated tokens, so batch
+schedulers had to reserve worst-case KV memory and a runaway sequence had no
+cap. The budget here is estimated from the prompt type and cheap statistics
+of a grayscale thumbnail:
+
+- text lines: runs of inked rows in the horizontal projection profile, each
+  weighted by its inked width (a half-width line is half a full line)
+- ink density: a floor for pages whose lines merge in the profile
+- tile count: the views the model reads (large pages carry more text)
+
+The estimate gets a safety margin and is rounded up to a KV block. When a
+generation still hits its budget before EOS, it is retried with a budget
+TOKEN_BUDGET_RETRY_FACTOR times larger, up to the 8192 cap.
+"""
+import functools
+import math
+import os
+from typing import Any, Callable, Dict, List, Optional, Union
+
+import numpy as np
+from PIL import Image
+
+from image_stats import LINE_MIN_HEIGHT, gray_thumbnail, ink_mask, inked_row_runs
+
+TOKEN_BUDGET = os.environ.get("TOKEN_BUDGET", "1") != "0"
+# Predicted tokens are multiplied by this before rounding
+TOKEN_BUDGET_MARGIN = float(os.environ.get("TOKEN_BUDGET_MARGIN", "1.5"))
+TOKEN_BUDGET_MIN = int(os.environ.get("TOKEN_BUDGET_MIN", "512"))
+TOKEN_BUDGET_MAX = 8192
+TOKEN_BUDGET_RETRY_FACTOR = 4
+BUDGET_BLOCK = 256          # budgets are multiples of this (the KV cache block)
+
+PROFILE_SIZE = 1024         # longest side of the thumbnail for the line profile
+TOKENS_PER_LINE = 28        # a full-width line of body text (~90 characters)
+INK_TOKENS = 30000          # tokens for a page fully covered in ink (text ~5-10%)
+TOKENS_PER_TILE = 32        # layout / markup overhead per local tile
+TOKENS_PER_BOX = 24         # <|ref|>..<|/ref|><|det|>[[x1, y1, x2, y2]]<|/det|>
+LINES_PER_BLOCK = 4         # document mode boxes paragraphs, not lines
+
+# Prompts whose answer length does not depend on the amount of text
+FIXED_BUDGETS = {"find": 512, "describe": 1024}
+# Prompt types the line model applies to; anything else (freeform) keeps the cap
+TEXT_PROMPT_TYPES = ("document", "ocr", "free", "figure")
+
+
+def line_profile(gray: np.ndarray) -> Dict[str, float]:
+    """Text lines in a grayscale thumbnail and their total inked width in page widths"""
+    mask = ink_mask(gray)
+    lines = 0
+    full_lines = 0.0
+    for start, end in inked_row_runs(mask):
+        if end - start < LINE_MIN_HEIGHT:
+            continue
+        columns = np.flatnonzero(mask[start:end].any(axis=0))
+        lines += 1
+        full_lines += (columns[-1] - columns[0] + 1) / mask.shape[1]
+    return {
+        "lines": lines,
+        "full_lines": round(full_lines, 2),
+        "ink_ratio": round(float(mask.mean()), 5),
+    }
+
+
+def page_features(img: Image.Image) -> Dict[str, float]:
+    return line_profile(gray_thumbnail(img, PROFILE_SIZE))
+
+
+def file_features(path: str) -> Dict[str, float]:
+    """page_features for an image on disk; JPEGs are decoded at reduced size"""
+    with Image.open(path) as img:
+        img.draft("L", (PROFILE_SIZE, PROFILE_SIZE))
+        return page_features(img)
+
+
+def image_budget(image: Union[str, Image.Image], prompt_type: str, tiles: int = 0) -> int:
+    """predict_budget for an image (or its path); the statistics are only
+    computed when the prompt type needs them"""
+    features = None
+    if TOKEN_BUDGET and prompt_type in TEXT_PROMPT_TYPES:
+        features = file_features(image) if isinstance(image, str) else page_features(image)
+    return predict_budget(prompt_type, features, tiles)
+
+
+def round_budget(tokens: float) -> int:
+    budget = int(math.ceil(tokens / BUDGET_BLOCK)) * BUDGET_BLOCK
+    return max(TOKEN_BUDGET_MIN, min(TOKEN_BUDGET_MAX, budget))
+
+
+def predict_budget(prompt_type: str, features: Optional[Dict[str, float]], tiles: int = 0) -> int:
+    """max_new_tokens for a request (TOKEN_BUDGET_MAX when it cannot be predicted)"""
+    if not TOKEN_BUDGET:
+        return TOKEN_BUDGET_MAX
+    if prompt_type in FIXED_BUDGETS:
+        return FIXED_BUDGETS[prompt_type]
+    if prompt_type not in TEXT_PROMPT_TYPES or not features:
+        return TOKEN_BUDGET_MAX
+
+    tokens = max(features["full_lines"] * TOKENS_PER_LINE, features["ink_ratio"] * INK_TOKENS)
+    if prompt_type == "ocr":
+        tokens += features["lines"] * TOKENS_PER_BOX
+    elif prompt_type == "document":
+        tokens += math.ceil(features["lines"] / LINES_PER_BLOCK) * TOKENS_PER_BOX
+    tokens += tiles * TOKENS_PER_TILE
+    return round_budget(tokens * TOKEN_BUDGET_MARGIN)
+
+
+def next_budget(budget: int) -> Optional[int]:
+    """Budget for a retry, None if budget already was the cap"""
+    if budget >= TOKEN_BUDGET_MAX:
+        return None
+    return round_budget(budget * TOKEN_BUDGET_RETRY_FACTOR)
+
+
+def hit_budget(text: Any) -> bool:
+    return bool(getattr(text, "hit_token_limit", False))
+
+
+def run_with_budget(run: Callable[[int], Any], budget: int) -> Any:
+    """run(max_new_tokens) -> result text, retried with larger budgets while it
+    stops on the budget before EOS"""
+    result = run(budget)
+    while hit_budget(result) and (larger := next_budget(budget)) is not None:
+        print(f"🔁 Token budget {budget} exhausted before EOS, retrying with {larger}")
+        budget = larger
+        result = run(budget)
+    return result
+
+
+def retry_exhausted(results: List[Any], budget: int, run_one: Callable[[int, int], Any]) -> List[Any]:
+    """Re-run the results of a batch decoded with `budget` that stopped on it;
+    run_one(index, max_new_tokens) -> result text"""
+    larger = next_budget(budget)
+    if larger is None:
+        return results
+    return [
+        run_with_budget(functools.partial(run_one, i), larger) if hit_budget(result) else result
+        for i, result in enumerate(results)
+    ]
@@ -9,8 +9,9 @@ import tempfile
 import io
 import base64
 import platform
+from functools import partial
 from typing import Optional, List, Dict, Any
-from contextlib import asynccontextmanager
+from contextlib import ExitStack, asynccontextmanager, contextmanager
 from pathlib import Path
 
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
@@ -20,11 +21,39 @@ from PIL import Image, ImageOps
 import uvicorn
 import fitz
 
-from gpu_manager import GPUResourceManager
+from gpu_manager import GPUResourceManager, DEFAULT_MODEL
+from backends.registry import get_model_registry, model_key
+from backends.vision_cache import get_vision_cache
+from backends.prefix_cache import get_prefix_cache
+from backends.kv_cache import get_kv_pool
+from backends.ocr_engine import count_tiles
+from pdf_utils import DEFAULT_TEXT_LAYER_POLICY, TEXT_LAYER_POLICIES, text_layer_for_page, page_pixel_size
+from image_stats import BLANK_SCREEN_PROMPT_TYPES, is_blank_page, is_blank_image_file
+from token_budget import image_budget, run_with_budget
 
 # 全局 GPU 管理器
 gpu_manager = None
 backend_type = None
+backend_keys = {}  # 模型名 -> 模型注册表键，启动时确定
+
+def parse_model_variants(spec: str) -> Dict[str, tuple]:
+    """
+    解析 MODEL_VARIANTS："name=path[@revision],..."（如 invoice=org/ocr-invoice,books=/models/books）
+    default 始终存在，指向官方模型和固定的 revision；其他变体未写 revision 时使用最新版本
+    """
+    variants = {DEFAULT_MODEL: ("deepseek-ai/DeepSeek-OCR", None)}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, target = item.partition("=")
+        path, _, revision = target.strip().partition("@")
+        if not name.strip() or not path:
+            raise ValueError(f"Invalid MODEL_VARIANTS entry: {item!r}")
+        variants[name.strip()] = (path, revision or None)
+    return variants
+
+# 可用的模型变体：名称 -> (模型路径, revision)
+MODEL_VARIANTS = parse_model_variants(os.environ.get("MODEL_VARIANTS", ""))
 
 def detect_platform() -> str:
     """检测平台"""
@@ -41,10 +70,22 @@ def detect_platform() -> str:
     
     return "cpu"
 
-def load_model_func():
-    """模型加载函数 - 供 GPU 管理器调用"""
-    from backends.cuda_backend import CUDABackend
-    backend = CUDABackend()
+def _make_backend(name: str):
+    """按变体名构造（未加载的）后端实例"""
+    path, revision = MODEL_VARIANTS[name]
+    if backend_type == "cuda":
+        from backends.cuda_backend import CUDABackend
+        backend = CUDABackend(path)
+    else:
+        from backends.cpu_backend import CPUBackend
+        backend = CPUBackend(path)
+    if name != DEFAULT_MODEL:
+        backend.revision = revision
+    return backend
+
+def _load_cuda_backend(name: str = DEFAULT_MODEL):
+    """加载 CUDA 后端（HuggingFace 失败时切换 ModelScope）"""
+    backend = _make_backend(name)
     
     try:
         backend.load_model(source="huggingface", timeout=300)
@@ -52,8 +93,48 @@ def load_model_func():
         print("🔄 Switching to ModelScope...")
         backend.load_model(source="modelscope")
     
+    return backend
+
+def _load_cpu_backend(name: str = DEFAULT_MODEL):
+    """加载 CPU 后端"""
+    backend = _make_backend(name)
+    backend.load_model()
+    return backend
+
+def platform_model_key(name: str = DEFAULT_MODEL):
+    """模型变体在当前平台的模型注册表键 (路径, revision, 设备, dtype)"""
+    backend = _make_backend(name)
+    if backend_type == "cuda":
+        return model_key(backend, backend.get_optimal_dtype())
+    return model_key(backend, backend.precision)
+
+def load_model_func(name: str = DEFAULT_MODEL):
+    """模型加载函数 - 供 GPU 管理器调用（经模型注册表，进程内只加载一次）"""
+    backend = get_model_registry().get(backend_keys[name], partial(_load_cuda_backend, name))
     return backend.model, backend.processor
 
+@contextmanager
+def acquire_model(name: str = DEFAULT_MODEL):
+    """
+    借用共享的后端实例 - 模型由注册表持有，所有请求和端点共用；
+    GPU 模式下持有租约，推理期间不会被卸载，请求结束后由 GPU 管理器在空闲超时或显存预算不足时卸载
+    """
+    registry = get_model_registry()
+    if gpu_manager:
+        with gpu_manager.lease(name=name) as (model, processor):
+            backend = registry.get(backend_keys[name], partial(_load_cuda_backend, name))
+            # 卸载 / 重新加载只搬运权重，模型对象不变；保险起见仍以租约返回的为准
+            backend.model, backend.processor = model, processor
+            yield backend
+    else:
+        # CPU 模式：首个请求加载，之后直接复用
+        yield registry.get(backend_keys[name], partial(_load_cpu_backend, name))
+
+def check_model_name(name: str):
+    """校验请求指定的模型变体"""
+    if name not in MODEL_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"model must be one of {', '.join(MODEL_VARIANTS)}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """启动时初始化 GPU 管理器"""
@@ -64,13 +145,21 @@ async def lifespan(app: FastAPI):
     print("="*50)
     
     backend_type = detect_platform()
+    for name in MODEL_VARIANTS:
+        backend_keys[name] = platform_model_key(name)
     
     if backend_type == "cuda":
-        # 初始化 GPU 管理器
+        # 初始化 GPU 管理器，登记所有模型变体（首次请求时才加载）
         idle_timeout = int(os.environ.get("GPU_IDLE_TIMEOUT", "60"))
         gpu_manager = GPUResourceManager(idle_timeout=idle_timeout)
+        registry = get_model_registry()
+        for name in MODEL_VARIANTS:
+            # 被丢回磁盘时注册表同时放手，下次请求重新从磁盘加载
+            gpu_manager.register(name, partial(load_model_func, name),
+                                 release_func=partial(registry.remove, backend_keys[name]),
+                                 cache_key=_make_backend(name).cache_key)
         gpu_manager.start_monitor()
-        print(f"✅ GPU Manager initialized (timeout={idle_timeout}s)")
+        print(f"✅ GPU Manager initialized (timeout={idle_timeout}s, models={', '.join(MODEL_VARIANTS)})")
     else:
         print("⚠️ CPU mode - GPU manager disabled")
     
@@ -84,7 +173,7 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(
     title="DeepSeek-OCR with GPU Management",
-    description="OCR service with lazy loading and instant offload",
+    description="OCR service with lazy loading and idle offload",
     version="4.1.0",
     lifespan=lifespan
 )
@@ -168,12 +257,21 @@ async def health_check():
         "status": "healthy",
         "backend": backend_type,
         "platform": platform.system(),
-        "gpu_manager": gpu_manager is not None
+        "gpu_manager": gpu_manager is not None,
+        # 可选的模型变体（请求的 model 字段）
+        "model_variants": {name: {"model_path": key[0], "revision": key[1] or None} for name, key in backend_keys.items()}
     }
     
     if gpu_manager:
         status.update(gpu_manager.get_status())
     
+    # 视觉特征缓存 / 图像前缀 KV 缓存命中情况
+    status["vision_cache"] = get_vision_cache().stats()
+    status["prefix_cache"] = get_prefix_cache().stats()
+    status["kv_pool"] = get_kv_pool().stats()
+    # 已加载的模型及其内存占用
+    status["model_registry"] = get_model_registry().stats()
+    
     return status
 
 @app.get("/gpu/status")
@@ -185,21 +283,27 @@ async def gpu_status():
     return gpu_manager.get_status()
 
 @app.post("/gpu/offload")
-async def gpu_offload():
-    """手动卸载 GPU"""
+async def gpu_offload(model: Optional[str] = None):
+    """手动卸载 GPU（model 为空时卸载所有模型）"""
     if not gpu_manager:
         raise HTTPException(status_code=400, detail="GPU manager not available")
+    if model is not None:
+        check_model_name(model)
     
-    gpu_manager.force_offload()
+    if not gpu_manager.force_offload(model):
+        return {"status": "skipped", "message": "Model in use or not on GPU", "active_leases": gpu_manager.active_leases}
     return {"status": "offloaded", "message": "Model moved to CPU"}
 
 @app.post("/gpu/release")
-async def gpu_release():
-    """完全释放资源"""
+async def gpu_release(model: Optional[str] = None):
+    """完全释放资源（model 为空时释放所有模型，注册表同时放手）"""
     if not gpu_manager:
         raise HTTPException(status_code=400, detail="GPU manager not available")
+    if model is not None:
+        check_model_name(model)
     
-    gpu_manager.force_release()
+    if not gpu_manager.force_release(model):
+        return {"status": "skipped", "message": "Model in use", "active_leases": gpu_manager.active_leases}
     return {"status": "released", "message": "All resources freed"}
 
 @app.post("/ocr")
@@ -208,9 +312,11 @@ async def ocr_endpoint(
     prompt_type: str = Form("document"),
     find_term: str = Form(""),
     custom_prompt: str = Form(""),
-    grounding: bool = Form(False)
+    grounding: bool = Form(False),
+    model: str = Form(DEFAULT_MODEL)
 ):
-    """OCR 端点 - 使用 GPU 管理器"""
+    """OCR 端点 - 使用 GPU 管理器（model 选择模型变体，见 MODEL_VARIANTS）"""
+    check_model_name(model)
     tmp_file = None
     
     try:
@@ -225,29 +331,42 @@ async def ocr_endpoint(
             img = ImageOps.exif_transpose(img).convert('RGB')
             orig_w, orig_h = img.size
         
+        # 空白页直接返回空结果，不加载模型
+        if prompt_type in BLANK_SCREEN_PROMPT_TYPES:
+            blank, stats = is_blank_image_file(tmp_file)
+            if blank:
+                return JSONResponse({
+                    "success": True,
+                    "text": "",
+                    "raw_text": "",
+                    "boxes": [],
+                    "image_dims": {"w": orig_w, "h": orig_h},
+                    "prompt_type": prompt_type,
+                    "metadata": {
+                        "mode": prompt_type,
+                        "backend": backend_type,
+                        "model": model,
+                        "has_boxes": False,
+                        "gpu_managed": gpu_manager is not None,
+                        "source": "blank_screen",
+                        "blank_page": True,
+                        "blank_stats": stats
+                    }
+                })
+        
         # 构建提示词
         prompt = build_prompt(prompt_type, custom_prompt, find_term)
         
-        # 步骤1: 懒加载模型
-        if gpu_manager:
-            model, processor = gpu_manager.get_model(load_func=load_model_func)
-        else:
-            # CPU 模式
-            from backends.cpu_backend import CPUBackend
-            backend = CPUBackend()
-            backend.load_model()
-            model, processor = backend.model, backend.processor
+        # 按图片预估生成长度上限，未到 EOS 就用完时自动放大重试
+        budget = image_budget(tmp_file, prompt_type, count_tiles(orig_w, orig_h))
         
-        # 步骤2: 推理
-        from backends.cuda_backend import CUDABackend
-        backend = CUDABackend()
-        backend.model = model
-        backend.processor = processor
-        text = backend.infer(prompt=prompt, image_path=tmp_file)
-        
-        # 步骤3: 立即卸载（关键！）
-        if gpu_manager:
-            gpu_manager.force_offload()
+        # 步骤1: 懒加载模型并持有租约（不再每次请求后卸载，空闲超时后由监控线程卸载）
+        with acquire_model(model) as backend:
+            # 步骤2: 推理
+            text = run_with_budget(
+                lambda max_new_tokens: backend.infer(prompt=prompt, image_path=tmp_file, max_new_tokens=max_new_tokens),
+                budget
+            )
         
         # 解析结果
         boxes = parse_detections(text, orig_w, orig_h) if "<|det|>" in text else []
@@ -265,16 +384,15 @@ async def ocr_endpoint(
             "metadata": {
                 "mode": prompt_type,
                 "backend": backend_type,
+                "model": model,
                 "has_boxes": len(boxes) > 0,
-                "gpu_managed": gpu_manager is not None
+                "gpu_managed": gpu_manager is not None,
+                # 生成陷入重复循环时提前停止，结果只保留循环的第一轮
+                "truncated_repetition": bool(getattr(text, "truncated_repetition", False))
             }
         })
         
     except Exception as e:
-        # 异常时也要卸载
-        if gpu_manager:
-            gpu_manager.force_offload()
-        
         import traceback
         print(f"❌ Error:\n{traceback.format_exc()}")
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
@@ -343,15 +461,27 @@ async def ocr_pdf_endpoint(
     file: UploadFile = File(...),
     prompt_type: str = Form("document"),
     find_term: str = Form(""),
-    custom_prompt: str = Form("")
+    custom_prompt: str = Form(""),
+    text_layer: str = Form(DEFAULT_TEXT_LAYER_POLICY),
+    model: str = Form(DEFAULT_MODEL)
 ):
-    """PDF OCR - 处理所有页面并返回合并结果"""
+    """PDF OCR - 处理所有页面并返回合并结果
+    
+    text_layer: auto（文本层可信时直接提取）/ ocr（始终推理）/ text（从不推理）
+    model: 模型变体名称（见 MODEL_VARIANTS）
+    """
+    check_model_name(model)
     tmp_file = None
+    # 模型租约在第一次需要推理时获取，整个 PDF 处理完才归还
+    model_lease = ExitStack()
     
     try:
         if not file.filename.lower().endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Must be PDF file")
         
+        if text_layer not in TEXT_LAYER_POLICIES:
+            raise HTTPException(status_code=400, detail=f"text_layer must be one of {', '.join(TEXT_LAYER_POLICIES)}")
+        
         # 保存 PDF
         pdf_data = await file.read()
         with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf', mode='wb') as tmp:
@@ -365,20 +495,7 @@ async def ocr_pdf_endpoint(
         
         results = []
         all_text = []
-        
-        # 获取模型（只加载一次）
-        if gpu_manager:
-            model, processor = gpu_manager.get_model(load_func=load_model_func)
-        else:
-            from backends.cpu_backend import CPUBackend
-            backend = CPUBackend()
-            backend.load_model()
-            model, processor = backend.model, backend.processor
-        
-        from backends.cuda_backend import CUDABackend
-        backend = CUDABackend()
-        backend.model = model
-        backend.processor = processor
+        backend = None
         
         # 构建提示词
         prompt = build_prompt(prompt_type, custom_prompt, find_term)
@@ -386,7 +503,42 @@ async def ocr_pdf_endpoint(
         # 处理每一页
         for page_num in range(pdf_doc.page_count):
             page = pdf_doc[page_num]
+            
+            # 快速路径：可信文本层直接提取，不经过模型
+            layer = text_layer_for_page(page, text_layer, prompt_type)
+            if layer is not None:
+                text = layer["raw_text"]
+                page_w, page_h = page_pixel_size(page, 144)
+                display_text = clean_grounding_text(text)
+                results.append({
+                    "page": page_num + 1,
+                    "text": display_text,
+                    "raw_text": text,
+                    "boxes": parse_detections(text, page_w, page_h),
+                    "source": "text_layer"
+                })
+                all_text.append(f"--- Page {page_num + 1} ---\n{display_text}\n")
+                continue
+            
             pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+            
+            # 空白页跳过推理
+            if prompt_type in BLANK_SCREEN_PROMPT_TYPES:
+                blank, _ = is_blank_page(Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples))
+                if blank:
+                    results.append({
+                        "page": page_num + 1,
+                        "text": "",
+                        "raw_text": "",
+                        "source": "blank_screen"
+                    })
+                    all_text.append(f"--- Page {page_num + 1} ---\n\n")
+                    continue
+            
+            # 获取模型（只在需要推理时加载一次）
+            if backend is None:
+                backend = model_lease.enter_context(acquire_model(model))
+            
             img_data = pixmap.tobytes("png")
             
             # 保存临时图片
@@ -395,14 +547,21 @@ async def ocr_pdf_endpoint(
                 img_path = img_tmp.name
             
             try:
-                # OCR 识别
-                text = backend.infer(prompt=prompt, image_path=img_path)
+                # OCR 识别（按页预估生成长度上限）
+                budget = image_budget(img_path, prompt_type, count_tiles(pixmap.width, pixmap.height))
+                text = run_with_budget(
+                    lambda max_new_tokens: backend.infer(prompt=prompt, image_path=img_path,
+                                                         max_new_tokens=max_new_tokens),
+                    budget
+                )
                 display_text = clean_grounding_text(text)
                 
                 results.append({
                     "page": page_num + 1,
                     "text": display_text,
-                    "raw_text": text
+                    "raw_text": text,
+                    "source": "model",
+                    "truncated_repetition": bool(getattr(text, "truncated_repetition", False))
                 })
                 
                 all_text.append(f"--- Page {page_num + 1} ---\n{display_text}\n")
@@ -413,10 +572,6 @@ async def ocr_pdf_endpoint(
         
         pdf_doc.close()
         
-        # 卸载模型
-        if gpu_manager:
-            gpu_manager.force_offload()
-        
         return JSONResponse({
             "success": True,
             "filename": file.filename,
@@ -426,19 +581,20 @@ async def ocr_pdf_endpoint(
             "metadata": {
                 "mode": prompt_type,
                 "backend": backend_type,
-                "gpu_managed": gpu_manager is not None
+                "model": model,
+                "gpu_managed": gpu_manager is not None,
+                "text_layer_pages": sum(1 for r in results if r["source"] == "text_layer"),
+                "blank_pages": sum(1 for r in results if r["source"] == "blank_screen")
             }
         })
         
     except Exception as e:
-        if gpu_manager:
-            gpu_manager.force_offload()
-        
         import traceback
         print(f"❌ PDF OCR Error:\n{traceback.format_exc()}")
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
         
     finally:
+        model_lease.close()
         if tmp_file and os.path.exists(tmp_file):
             os.remove(tmp_file)
 
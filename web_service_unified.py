@@ -11,25 +11,46 @@ import tempfile
 import shutil
 import io
 import base64
+import json
 import platform
 from typing import Optional, List, Dict, Any
 from contextlib import asynccontextmanager
 from pathlib import Path
 import asyncio
+import functools
 from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from PIL import Image, ImageOps
 import uvicorn
 import fitz
 import threading
 
+from pdf_utils import (
+    DEFAULT_TEXT_LAYER_POLICY, TEXT_LAYER_POLICIES, text_layer_for_page, page_pixel_size, extract_page_image
+)
+from image_stats import BLANK_SCREEN_PROMPT_TYPES, is_blank_page, is_blank_image_file
+from regions import (
+    REGION_PADDING, RESOLUTION_MODES, parse_regions, resolution_mode_for, resolution_kwargs, remap_grounding
+)
+from token_budget import (
+    TEXT_PROMPT_TYPES, file_features, image_budget, predict_budget, next_budget, hit_budget,
+    run_with_budget, retry_exhausted
+)
+from memory_admission import (
+    ADMISSION_WAIT_S, MEMORY_ADMISSION, MEMORY_CALIBRATE, InsufficientMemory, MemoryAdmission, MemoryEstimator, calibrate, shape_key
+)
+from backends.base import GenerationCancelled, GenerationOptions, OCRText
+from backends.ocr_engine import count_tiles
+
 # Global backend
 backend = None
 backend_type = None
+admission = None  # MemoryAdmission, set up with the backend in lifespan
 
 # ============ Concurrency Control ============
 MAX_OCR_QUEUE_SIZE = 8
@@ -42,6 +63,12 @@ MAX_CONCURRENT_PER_IP = 4
 ocr_semaphore = None  # Will be initialized in lifespan
 pdf_semaphore = None
 
+# PDF OCR pipeline: pages buffered between render -> preprocess -> inference stages,
+# and max pages handed to the backend in one call (capped by the backend's max_batch)
+PDF_PIPELINE_DEPTH = 4
+PDF_INFER_BATCH_SIZE = int(os.environ.get("PDF_INFER_BATCH_SIZE", "4"))
+PDF_RENDER_DPI = 144
+
 ocr_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr-")
 pdf_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf-")
 
@@ -62,6 +89,9 @@ import uuid
 
 _request_queue: OrderedDict[str, dict] = OrderedDict()  # request_id -> {client_id, ip, timestamp}
 
+# Open WebSocket OCR sessions (session_id -> {client_id, ip, connected_at})
+_ws_sessions: dict[str, dict] = {}
+
 
 def get_client_identifier(request: Request) -> tuple[str | None, str]:
     """Extract client ID from header and client IP."""
@@ -150,6 +180,20 @@ def get_queue_position(client_id: str) -> tuple[int | None, int]:
     return None, total
 
 
+def get_request_position(request_id: str) -> tuple[int | None, int]:
+    """Get the queue position of a single request.
+
+    Must be called while holding _queue_lock.
+
+    Returns: (position (1-indexed, or None if not in queue), total_queued)
+    """
+    total = len(_request_queue)
+    for i, key in enumerate(_request_queue):
+        if key == request_id:
+            return i + 1, total
+    return None, total
+
+
 def detect_platform() -> str:
     """Detect platform and return backend type"""
     import os
@@ -158,7 +202,7 @@ def detect_platform() -> str:
     
     # Force backend via env var
     force_backend = os.environ.get("FORCE_BACKEND", "").lower()
-    if force_backend in ["mps", "cuda", "cpu"]:
+    if force_backend in ["mps", "cuda", "cpu", "stub", "vllm"]:
         print(f"🔧 Forced backend: {force_backend.upper()}")
         return force_backend
     
@@ -189,7 +233,7 @@ def detect_platform() -> str:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load model based on platform"""
-    global backend, backend_type, ocr_semaphore, pdf_semaphore
+    global backend, backend_type, ocr_semaphore, pdf_semaphore, admission, ocr_executor
     
     print("="*50)
     print("🚀 DeepSeek-OCR Unified Service Starting...")
@@ -222,15 +266,51 @@ async def lifespan(app: FastAPI):
         from backends.cpu_backend import CPUBackend
         backend = CPUBackend(model_path=model_path)
         backend.load_model()
+    elif backend_type == "stub":
+        # Deterministic fake model for tests and frontend work
+        from backends.stub_backend import StubBackend
+        backend = StubBackend()
+        backend.load_model()
+    elif backend_type == "vllm":
+        # One AsyncLLMEngine, requests batched continuously (OCR_VLLM_ENGINE=stub: no GPU needed)
+        from backends.vllm_backend import VLLMBackend
+        backend = VLLMBackend(model_path=model_path)
+        backend.load_model()
     else:
         raise RuntimeError("No supported backend available")
     
     print(f"✅ Backend loaded: {backend_type.upper()}")
     
+    capabilities = backend.capabilities()
+    
+    # Backends that batch concurrent calls themselves get that many inference
+    # slots (and executor threads) instead of one
+    concurrency = max(1, capabilities["max_concurrency"])
+    
+    # Memory admission control: estimator calibrated by measuring peak allocation on CUDA
+    # (off for backends that budget their own memory, like vLLM's KV block manager).
+    # Calibration needs the native engine: model.infer ignores max_new_tokens.
+    estimator = MemoryEstimator()
+    if (MEMORY_ADMISSION and MEMORY_CALIBRATE and str(backend.device).startswith("cuda")
+            and not capabilities["memory_managed"]):
+        if capabilities.get("engine") != "native":
+            print("⚠️ Memory calibration skipped (no native engine), using default estimates")
+        else:
+            try:
+                estimator = calibrate(backend.infer, backend.model, backend.device)
+            except Exception as e:
+                print(f"⚠️ Memory calibration failed, using default estimates: {e}")
+    # With one inference slot, admission runs while the request holds it: no wait, downgrade at once
+    admission = MemoryAdmission(estimator, backend.device, active=not capabilities["memory_managed"],
+                                wait_s=ADMISSION_WAIT_S if concurrency > 1 else 0.0)
+    
     # Initialize semaphores
-    ocr_semaphore = asyncio.Semaphore(1)
+    ocr_semaphore = asyncio.Semaphore(concurrency)
+    if concurrency > 1:
+        ocr_executor.shutdown(wait=False)
+        ocr_executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ocr-")
     pdf_semaphore = asyncio.Semaphore(2)
-    print("✅ Concurrency control initialized")
+    print(f"✅ Concurrency control initialized ({concurrency} inference slot(s))")
     print("="*50)
     
     yield
@@ -239,6 +319,8 @@ async def lifespan(app: FastAPI):
     ocr_executor.shutdown(wait=True)
     pdf_executor.shutdown(wait=True)
     print("✅ Thread pools closed")
+    if hasattr(backend, "close"):
+        backend.close()
 
 app = FastAPI(
     title="DeepSeek-OCR Unified API",
@@ -349,6 +431,7 @@ async def health_check(request: Request):
         pdf_depth = pdf_queue_depth
         active_clients_count = len(_active_clients)
         active_ips_count = len(_active_ips)
+        ws_sessions_count = len(_ws_sessions)
         
         # Get queue position for this client if client_id provided
         if client_id:
@@ -388,8 +471,25 @@ async def health_check(request: Request):
             "active_clients": active_clients_count,
             "active_ips": active_ips_count,
         },
+        "websocket_sessions": ws_sessions_count,
+        "capabilities": backend.capabilities() if backend is not None else None,
     }
     
+    # Vision-embedding and image-prefix KV caches and the KV buffer pool of the native engine
+    engine = backend.get_engine() if hasattr(backend, "get_engine") and backend.model is not None else None
+    if engine is not None:
+        response["vision_cache"] = engine.cache.stats()
+        response["prefix_cache"] = engine.prefix_cache.stats()
+        response["kv_pool"] = engine.kv_pool.stats()
+    
+    # vLLM engine: in-flight requests, aborts, repetition stops
+    if hasattr(backend, "stats"):
+        response["engine"] = backend.stats()
+    
+    # Memory admission control: calibrated estimates, available memory, waits / downgrades
+    if admission is not None:
+        response["memory"] = admission.stats()
+    
     # Add client-specific queue info if client_id was provided
     if client_id:
         response["your_queue_status"] = {
@@ -400,6 +500,178 @@ async def health_check(request: Request):
     
     return response
 
+def save_image_to_temp(image_data: bytes) -> tuple[str, int, int]:
+    """Write image bytes to a temp file. Returns (path, width, height)"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.png', mode='wb') as tmp:
+        tmp.write(image_data)
+        tmp_file = tmp.name
+    
+    try:
+        with Image.open(tmp_file) as img:
+            img = ImageOps.exif_transpose(img).convert('RGB')
+            orig_w, orig_h = img.size
+    except Exception:
+        os.remove(tmp_file)
+        raise
+    
+    return tmp_file, orig_w, orig_h
+
+
+def predicted_budget(image, prompt_type: str, width: int, height: int, infer_kwargs: Optional[Dict[str, Any]] = None) -> int:
+    """max_new_tokens for one image (path or PIL image) at the resolution mode it runs with"""
+    return image_budget(image, prompt_type, count_tiles(width, height, **(infer_kwargs or {})))
+
+
+def mark_downgraded(text: str, mode: Optional[str]) -> str:
+    """Record on a result that admission control ran it at a smaller resolution mode"""
+    if mode is None:
+        return text
+    if not isinstance(text, OCRText):
+        text = OCRText(text)
+    text.resolution_downgraded = mode
+    return text
+
+
+def _infer_with_budget(prompt: str, image_path: str, size: tuple, budget: int,
+                       options: Optional[GenerationOptions] = None, **infer_kwargs) -> str:
+    """backend.infer at the resolution mode memory admission allows for the image
+    size, retried with a larger budget if the predicted one runs out before EOS"""
+    downgraded = None
+    
+    def run(max_new_tokens: int) -> str:
+        nonlocal downgraded
+        kwargs, mode = admission.admit(size[0], size[1], max_new_tokens, infer_kwargs)
+        downgraded = mode or downgraded
+        return backend.infer(prompt, image_path, options, max_new_tokens=max_new_tokens, **kwargs)
+    
+    return mark_downgraded(run_with_budget(run, budget), downgraded)
+
+
+async def run_ocr_inference(prompt: str, image_path: str, size: tuple, budget: int, **infer_kwargs) -> str:
+    """Acquire the OCR semaphore and run backend inference in the thread pool"""
+    await ocr_semaphore.acquire()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            ocr_executor,
+            functools.partial(_infer_with_budget, prompt, image_path, size, budget, **infer_kwargs)
+        )
+    finally:
+        ocr_semaphore.release()
+
+
+def build_ocr_result(text: str, orig_w: int, orig_h: int, prompt_type: str) -> Dict[str, Any]:
+    """Build the /ocr response payload from raw model output"""
+    # Parse boxes
+    boxes = parse_detections(text, orig_w, orig_h) if "<|det|>" in text else []
+    
+    # Clean text
+    display_text = clean_grounding_text(text)
+    if not display_text and boxes:
+        display_text = ", ".join([b["label"] for b in boxes])
+    
+    return {
+        "success": True,
+        "text": display_text,
+        "raw_text": text,
+        "boxes": boxes,
+        "image_dims": {"w": orig_w, "h": orig_h},
+        "prompt_type": prompt_type,
+        "metadata": {
+            "mode": prompt_type,
+            "backend": backend_type,
+            "has_boxes": len(boxes) > 0,
+            # Generation stopped in a repetition loop; the loop was cut to its first cycle
+            "truncated_repetition": bool(getattr(text, "truncated_repetition", False)),
+            # Resolution mode used instead of the requested one when memory was short
+            "resolution_downgraded": getattr(text, "resolution_downgraded", None)
+        }
+    }
+
+def build_text_layer_result(layer: Dict[str, Any], width: int, height: int, prompt_type: str) -> Dict[str, Any]:
+    """Build an /ocr-shaped result from a PDF text layer (no inference)"""
+    result = build_ocr_result(layer["raw_text"], width, height, prompt_type)
+    result["metadata"]["source"] = "text_layer"
+    result["metadata"]["text_layer"] = layer["analysis"]
+    return result
+
+def build_blank_result(width: int, height: int, prompt_type: str, stats: Dict[str, Any]) -> Dict[str, Any]:
+    """Build an empty /ocr-shaped result for a page the blank screen rejected (no inference)"""
+    result = build_ocr_result("", width, height, prompt_type)
+    result["metadata"]["source"] = "blank_screen"
+    result["metadata"]["blank_page"] = True
+    result["metadata"]["blank_stats"] = stats
+    return result
+
+def screen_blank_file(image_path: str, prompt_type: str) -> Optional[Dict[str, Any]]:
+    """Returns the image stats if the image is blank and the prompt has a known empty answer"""
+    if prompt_type not in BLANK_SCREEN_PROMPT_TYPES:
+        return None
+    blank, stats = is_blank_image_file(image_path)
+    return stats if blank else None
+
+def _save_region_crops(image_path: str, regions: List[tuple]) -> List[str]:
+    """Crop each region out of the (EXIF-transposed) image into its own temp PNG"""
+    paths = []
+    with Image.open(image_path) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        try:
+            for region in regions:
+                with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp:
+                    paths.append(tmp.name)
+                    img.crop(region).save(tmp, format='PNG', compress_level=1)
+        except Exception:
+            for path in paths:
+                os.remove(path)
+            raise
+    return paths
+
+async def run_region_ocr(image_path: str, regions: List[tuple], prompt: str, prompt_type: str,
+                         orig_w: int, orig_h: int) -> Dict[str, Any]:
+    """OCR only the given regions, each at the resolution mode its size needs.
+
+    Grounding coordinates are rewritten into the full-image frame, so text,
+    raw_text and boxes of the combined result read like a full-image result.
+    """
+    loop = asyncio.get_running_loop()
+    crop_paths = await loop.run_in_executor(pdf_executor, _save_region_crops, image_path, regions)
+    region_results = []
+    try:
+        for region, path in zip(regions, crop_paths):
+            crop_w, crop_h = region[2] - region[0], region[3] - region[1]
+            mode = resolution_mode_for(crop_w, crop_h)
+            
+            blank_stats = screen_blank_file(path, prompt_type)
+            if blank_stats is not None:
+                text = ""
+            else:
+                infer_kwargs = resolution_kwargs(mode)
+                budget = await loop.run_in_executor(
+                    pdf_executor, predicted_budget, path, prompt_type, crop_w, crop_h, infer_kwargs
+                )
+                text = await run_ocr_inference(prompt, path, (crop_w, crop_h), budget, **infer_kwargs)
+            
+            raw_text = remap_grounding(text, region, orig_w, orig_h)
+            region_result = build_ocr_result(raw_text, orig_w, orig_h, prompt_type)
+            region_results.append({
+                "region": list(region),
+                "resolution_mode": mode,
+                "blank_page": blank_stats is not None,
+                "truncated_repetition": bool(getattr(text, "truncated_repetition", False)),
+                "text": region_result["text"],
+                "raw_text": raw_text,
+                "boxes": region_result["boxes"],
+            })
+    finally:
+        for path in crop_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    result = build_ocr_result("\n\n".join(r["raw_text"] for r in region_results), orig_w, orig_h, prompt_type)
+    result["metadata"]["truncated_repetition"] = any(r["truncated_repetition"] for r in region_results)
+    result["regions"] = region_results
+    return result
+
 @app.post("/ocr")
 async def ocr_endpoint(
     request: Request,
@@ -407,15 +679,29 @@ async def ocr_endpoint(
     prompt_type: str = Form("document"),
     find_term: str = Form(""),
     custom_prompt: str = Form(""),
-    grounding: bool = Form(False)
+    grounding: bool = Form(False),
+    regions: str = Form(""),
+    region_padding: int = Form(REGION_PADDING),
+    resolution: str = Form("")
 ):
-    """OCR endpoint with per-client rate limiting"""
+    """OCR endpoint with per-client rate limiting.
+    
+    resolution: optional tiny | small | base | gundam (default gundam).
+    
+    regions: optional JSON list of regions to OCR instead of the whole image,
+    each [x1, y1, x2, y2] in pixels or normalized 0-1 (or {"box": [...], "units": "px"|"norm"}).
+    Each region is padded by region_padding pixels and run at the smallest
+    resolution mode that covers it; boxes are returned in the original image frame.
+    """
     if backend is None:
         raise HTTPException(status_code=503, detail="Backend not loaded")
     
     if ocr_semaphore is None:
         raise HTTPException(status_code=503, detail="Service initializing")
     
+    if resolution and resolution not in RESOLUTION_MODES:
+        raise HTTPException(status_code=400, detail=f"resolution must be one of {', '.join(RESOLUTION_MODES)}")
+    
     # Extract client identifier
     client_id, client_ip = get_client_identifier(request)
     
@@ -429,55 +715,176 @@ async def ocr_endpoint(
     tmp_file = None
     
     try:
-        # Save uploaded image
+        # Save uploaded image and get dimensions
         image_data = await file.read()
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png', mode='wb') as tmp:
-            tmp.write(image_data)
-            tmp_file = tmp.name
-        
-        # Get image dimensions
-        with Image.open(tmp_file) as img:
-            img = ImageOps.exif_transpose(img).convert('RGB')
-            orig_w, orig_h = img.size
+        tmp_file, orig_w, orig_h = save_image_to_temp(image_data)
         
         # Build prompt
         prompt = build_prompt(prompt_type, custom_prompt, find_term)
         
-        # Acquire semaphore and run inference in thread pool
-        await ocr_semaphore.acquire()
-        try:
-            loop = asyncio.get_running_loop()
-            text = await loop.run_in_executor(
-                ocr_executor,
-                backend.infer,
-                prompt,
-                tmp_file
-            )
-        finally:
-            ocr_semaphore.release()
+        # Region-of-interest OCR: only the requested crops go through the model
+        if regions.strip():
+            try:
+                region_boxes = parse_regions(regions, orig_w, orig_h, max(0, region_padding))
+            except ValueError as e:
+                return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+            return JSONResponse(await run_region_ocr(tmp_file, region_boxes, prompt, prompt_type, orig_w, orig_h))
+        
+        # Blank pages get an empty result without touching the model
+        blank_stats = screen_blank_file(tmp_file, prompt_type)
+        if blank_stats is not None:
+            return JSONResponse(build_blank_result(orig_w, orig_h, prompt_type, blank_stats))
+        
+        infer_kwargs = resolution_kwargs(resolution) if resolution else {}
+        budget = await asyncio.get_running_loop().run_in_executor(
+            pdf_executor, predicted_budget, tmp_file, prompt_type, orig_w, orig_h, infer_kwargs
+        )
+        text = await run_ocr_inference(prompt, tmp_file, (orig_w, orig_h), budget, **infer_kwargs)
+        
+        return JSONResponse(build_ocr_result(text, orig_w, orig_h, prompt_type))
+        
+    except InsufficientMemory as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=503)
+    except Exception as e:
+        import traceback
+        print(f"❌ Error:\n{traceback.format_exc()}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+        
+    finally:
+        with _queue_lock:
+            unregister_active_request(request_id, client_id, client_ip)
+        if tmp_file and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+MAX_MULTI_PROMPTS = 16
+
+def parse_prompt_specs(spec: str) -> List[Dict[str, str]]:
+    """JSON list of {"prompt_type"|"mode", "find_term", "custom_prompt"} -> normalized specs"""
+    try:
+        parsed = json.loads(spec)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"prompts must be JSON: {e}")
+    if not isinstance(parsed, list) or not parsed:
+        raise ValueError("prompts must be a non-empty list")
+    if len(parsed) > MAX_MULTI_PROMPTS:
+        raise ValueError(f"at most {MAX_MULTI_PROMPTS} prompts per request")
+    specs = []
+    for item in parsed:
+        if isinstance(item, str):
+            item = {"prompt_type": item}
+        if not isinstance(item, dict):
+            raise ValueError("each prompt must be an object or a prompt type string")
+        specs.append({
+            "prompt_type": str(item.get("prompt_type", item.get("mode", "document"))),
+            "find_term": str(item.get("find_term", "")),
+            "custom_prompt": str(item.get("custom_prompt", "")),
+        })
+    return specs
+
+def _infer_multi(prompts: List[str], image_path: str, size: tuple, budgets: List[int]) -> List[str]:
+    """All prompts for one image in a single backend call (sequential on backends
+    without multi_prompt), decoded with the largest of their token budgets.
+    Prompts are split over several calls when the batch does not fit in memory."""
+    if len(prompts) == 1:
+        return [_infer_with_budget(prompts[0], image_path, size, budgets[0])]
+    budget = max(budgets)
+    n = admission.batch_size([shape_key(*size)] * len(prompts), budget)
+    if n < len(prompts):
+        return (_infer_multi(prompts[:n], image_path, size, budgets[:n]) +
+                _infer_multi(prompts[n:], image_path, size, budgets[n:]))
+    texts = backend.infer_multi(prompts, image_path, max_new_tokens=budget)
+    return retry_exhausted(
+        texts, budget, lambda i, max_new_tokens: _infer_with_budget(prompts[i], image_path, size, max_new_tokens)
+    )
+
+@app.post("/ocr-multi")
+async def ocr_multi_endpoint(
+    request: Request,
+    file: UploadFile = File(...),
+    prompts: str = Form(...)
+):
+    """Several prompts on one image in one call.
+    
+    prompts: JSON list of {"prompt_type": ..., "find_term": ..., "custom_prompt": ...}
+    (a bare string is taken as a prompt_type). The image is encoded and
+    prefilled once and the prompts are decoded as one batch; the response
+    holds one /ocr-shaped result per prompt, in order.
+    """
+    if backend is None:
+        raise HTTPException(status_code=503, detail="Backend not loaded")
+    
+    if ocr_semaphore is None:
+        raise HTTPException(status_code=503, detail="Service initializing")
+    
+    try:
+        specs = parse_prompt_specs(prompts)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    client_id, client_ip = get_client_identifier(request)
+    
+    with _queue_lock:
+        allowed, reason = check_rate_limit(client_id, client_ip)
+        if not allowed:
+            raise HTTPException(status_code=429, detail=reason)
+        request_id = register_active_request(client_id, client_ip)
+    
+    tmp_file = None
+    
+    try:
+        image_data = await file.read()
+        tmp_file, orig_w, orig_h = save_image_to_temp(image_data)
+        
+        results: List[Optional[Dict[str, Any]]] = [None] * len(specs)
         
-        # Parse boxes
-        boxes = parse_detections(text, orig_w, orig_h) if "<|det|>" in text else []
+        # Blank image: screenable prompt types get an empty result without inference
+        if any(spec["prompt_type"] in BLANK_SCREEN_PROMPT_TYPES for spec in specs):
+            blank, blank_stats = is_blank_image_file(tmp_file)
+            if blank:
+                for i, spec in enumerate(specs):
+                    if spec["prompt_type"] in BLANK_SCREEN_PROMPT_TYPES:
+                        results[i] = build_blank_result(orig_w, orig_h, spec["prompt_type"], blank_stats)
         
-        # Clean text
-        display_text = clean_grounding_text(text)
-        if not display_text and boxes:
-            display_text = ", ".join([b["label"] for b in boxes])
+        pending = [i for i, result in enumerate(results) if result is None]
+        inference_time = 0.0
+        if pending:
+            prompt_texts = [
+                build_prompt(specs[i]["prompt_type"], specs[i]["custom_prompt"], specs[i]["find_term"])
+                for i in pending
+            ]
+            loop = asyncio.get_running_loop()
+            # One set of image statistics for all prompts
+            features = None
+            if any(specs[i]["prompt_type"] in TEXT_PROMPT_TYPES for i in pending):
+                features = await loop.run_in_executor(pdf_executor, file_features, tmp_file)
+            tiles = count_tiles(orig_w, orig_h)
+            budgets = [predict_budget(specs[i]["prompt_type"], features, tiles) for i in pending]
+            await ocr_semaphore.acquire()
+            try:
+                start = time_module.time()
+                texts = await loop.run_in_executor(
+                    ocr_executor, _infer_multi, prompt_texts, tmp_file, (orig_w, orig_h), budgets
+                )
+                inference_time = time_module.time() - start
+            finally:
+                ocr_semaphore.release()
+            for i, text in zip(pending, texts):
+                results[i] = build_ocr_result(text, orig_w, orig_h, specs[i]["prompt_type"])
         
         return JSONResponse({
             "success": True,
-            "text": display_text,
-            "raw_text": text,
-            "boxes": boxes,
+            "results": results,
             "image_dims": {"w": orig_w, "h": orig_h},
-            "prompt_type": prompt_type,
             "metadata": {
-                "mode": prompt_type,
                 "backend": backend_type,
-                "has_boxes": len(boxes) > 0
+                "prompt_count": len(specs),
+                "inference_time": round(inference_time, 3),
             }
         })
         
+    except InsufficientMemory as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=503)
     except Exception as e:
         import traceback
         print(f"❌ Error:\n{traceback.format_exc()}")
@@ -489,8 +896,285 @@ async def ocr_endpoint(
         if tmp_file and os.path.exists(tmp_file):
             os.remove(tmp_file)
 
-def _render_pdf_pages(pdf_path: str) -> list:
-    """Synchronous function: Render all PDF pages to images"""
+
+# ============ WebSocket OCR Session ============
+# Protocol (one connection, many images):
+#   client -> {"type": "options", "prompt_type": ..., "find_term": ..., "custom_prompt": ...,
+#              "resolution": "tiny"|"small"|"base"|"gundam", "stream": bool}
+#             sets session defaults
+#   client -> {"type": "ocr", "id": "...", ...per-image options} followed by ONE binary frame
+#             (a binary frame without a header uses the session defaults)
+#   client -> {"type": "cancel", "id": "..."} drops an image that has not started yet, and
+#             stops a running one if the backend reports the "cancel" capability
+#   client -> {"type": "ping"}
+#   server -> ready (with backend capabilities) / accepted / queued (position updates) /
+#             started / delta (streamed text, if requested and supported) / result (the
+#             final text, authoritative over the deltas) / cancelled / error / pong
+WS_POSITION_INTERVAL = 0.5  # seconds between queue-position checks while waiting
+WS_MAX_PENDING_IMAGES = MAX_OCR_QUEUE_SIZE  # per-session backlog of received images
+
+_WS_OPTION_KEYS = ("prompt_type", "find_term", "custom_prompt", "resolution", "stream")
+
+
+async def _acquire_with_position_updates(websocket: WebSocket, job_id: str, request_id: str) -> None:
+    """Wait for the OCR semaphore, pushing queue-position changes to the client"""
+    last_position = None
+    while True:
+        with _queue_lock:
+            position, total = get_request_position(request_id)
+        if position != last_position:
+            await websocket.send_json({"type": "queued", "id": job_id, "position": position, "total_queued": total})
+            last_position = position
+        try:
+            await asyncio.wait_for(ocr_semaphore.acquire(), timeout=WS_POSITION_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+async def _stream_ws_inference(websocket: WebSocket, job_id: str, prompt: str, image_path: str,
+                               options: GenerationOptions) -> str:
+    """Run backend.infer_stream in the OCR thread, forwarding each text delta to the client"""
+    loop = asyncio.get_running_loop()
+    deltas: asyncio.Queue = asyncio.Queue()
+    
+    def run() -> str:
+        chunks = []
+        stream = backend.infer_stream(prompt, image_path, options)
+        try:
+            while True:
+                try:
+                    delta = next(stream)
+                except StopIteration as done:
+                    # The stream returns the final result (e.g. with a repetition loop cut off)
+                    return done.value if done.value is not None else "".join(chunks).strip()
+                chunks.append(delta)
+                loop.call_soon_threadsafe(deltas.put_nowait, delta)
+        finally:
+            loop.call_soon_threadsafe(deltas.put_nowait, None)
+    
+    future = loop.run_in_executor(ocr_executor, run)
+    try:
+        while (delta := await deltas.get()) is not None:
+            await websocket.send_json({"type": "delta", "id": job_id, "text": delta})
+    except BaseException:
+        # Client gone or session closing: stop generating instead of finishing unseen
+        if options.cancel_event is not None:
+            options.cancel_event.set()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        raise
+    return await future
+
+
+async def _process_ws_job(websocket: WebSocket, job: dict, client_id: str | None, client_ip: str) -> None:
+    """Run one image of a WebSocket session through the shared OCR queue"""
+    job_id = job["id"]
+    
+    # Never await while holding _queue_lock: it is a threading.Lock shared with every coroutine on this loop
+    with _queue_lock:
+        allowed, reason = check_rate_limit(client_id, client_ip)
+        request_id = register_active_request(client_id, client_ip) if allowed else None
+    if not allowed:
+        await websocket.send_json({"type": "error", "id": job_id, "status": 429, "error": reason})
+        return
+    
+    tmp_file = None
+    
+    try:
+        tmp_file, orig_w, orig_h = save_image_to_temp(job["data"])
+        options = job["options"]
+        prompt_type = options.get("prompt_type", "document")
+        prompt = build_prompt(prompt_type, options.get("custom_prompt", ""), options.get("find_term", ""))
+        
+        blank_stats = screen_blank_file(tmp_file, prompt_type)
+        if blank_stats is not None:
+            result = build_blank_result(orig_w, orig_h, prompt_type, blank_stats)
+            await websocket.send_json({"type": "result", "id": job_id, **result})
+            return
+        
+        resolution = options.get("resolution")
+        infer_kwargs = resolution_kwargs(resolution) if resolution in RESOLUTION_MODES else {}
+        loop = asyncio.get_running_loop()
+        budget = await loop.run_in_executor(
+            pdf_executor, predicted_budget, tmp_file, prompt_type, orig_w, orig_h, infer_kwargs
+        )
+        gen_options = GenerationOptions.from_kwargs(
+            cancel_event=job["cancel_event"], max_new_tokens=budget, **infer_kwargs
+        )
+        capabilities = backend.capabilities()
+        infer_with_budget = functools.partial(
+            _infer_with_budget, prompt, tmp_file, (orig_w, orig_h), options=gen_options, **infer_kwargs
+        )
+        
+        await _acquire_with_position_updates(websocket, job_id, request_id)
+        try:
+            gen_options.check_cancelled()
+            await websocket.send_json({"type": "started", "id": job_id})
+            if options.get("stream") and capabilities["streaming"]:
+                admitted, downgraded = await loop.run_in_executor(
+                    ocr_executor, admission.admit, orig_w, orig_h, budget, infer_kwargs
+                )
+                stream_options = GenerationOptions.from_kwargs(gen_options, **admitted)
+                text = await _stream_ws_inference(websocket, job_id, prompt, tmp_file, stream_options)
+                text = mark_downgraded(text, downgraded)
+                if hit_budget(text) and (larger := next_budget(budget)) is not None:
+                    # Budget ran out mid-stream: rerun unstreamed, the result message supersedes the deltas
+                    text = await loop.run_in_executor(ocr_executor, infer_with_budget, larger)
+            else:
+                text = await loop.run_in_executor(ocr_executor, infer_with_budget, budget)
+        finally:
+            ocr_semaphore.release()
+        
+        result = build_ocr_result(text, orig_w, orig_h, prompt_type)
+        await websocket.send_json({"type": "result", "id": job_id, **result})
+        
+    except GenerationCancelled:
+        await websocket.send_json({"type": "cancelled", "id": job_id})
+        
+    except InsufficientMemory as e:
+        await websocket.send_json({"type": "error", "id": job_id, "status": 503, "error": str(e)})
+        
+    except WebSocketDisconnect:
+        raise
+    except Exception as e:
+        import traceback
+        print(f"❌ WebSocket OCR Error:\n{traceback.format_exc()}")
+        await websocket.send_json({"type": "error", "id": job_id, "status": 500, "error": str(e)})
+        
+    finally:
+        with _queue_lock:
+            unregister_active_request(request_id, client_id, client_ip)
+        if tmp_file and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+@app.websocket("/ws/ocr")
+async def ocr_websocket(websocket: WebSocket):
+    """Persistent OCR session: push many images over one connection"""
+    await websocket.accept()
+    
+    if backend is None or ocr_semaphore is None:
+        await websocket.send_json({"type": "error", "status": 503, "error": "Service initializing"})
+        await websocket.close(code=1013)
+        return
+    
+    # Client ID may come from the header (same as HTTP) or the query string (browsers
+    # cannot set headers on WebSocket connections)
+    client_id = websocket.headers.get("X-Client-ID") or websocket.query_params.get("client_id")
+    forwarded = websocket.headers.get("X-Forwarded-For")
+    if forwarded:
+        client_ip = forwarded.split(",")[0].strip()
+    else:
+        client_ip = websocket.client.host if websocket.client else "unknown"
+    
+    session_id = str(uuid.uuid4())
+    with _queue_lock:
+        _ws_sessions[session_id] = {"client_id": client_id, "ip": client_ip, "connected_at": time_module.time()}
+    
+    defaults = {"prompt_type": "document", "find_term": "", "custom_prompt": ""}
+    jobs: asyncio.Queue = asyncio.Queue(maxsize=WS_MAX_PENDING_IMAGES)
+    cancelled: set[str] = set()
+    cancel_events: dict[str, threading.Event] = {}  # job_id -> event, for accepted jobs
+    
+    async def worker():
+        while True:
+            job = await jobs.get()
+            try:
+                if job["id"] in cancelled:
+                    cancelled.discard(job["id"])
+                    await websocket.send_json({"type": "cancelled", "id": job["id"]})
+                    continue
+                await _process_ws_job(websocket, job, client_id, client_ip)
+            finally:
+                if cancel_events.get(job["id"]) is job["cancel_event"]:
+                    del cancel_events[job["id"]]
+                cancelled.discard(job["id"])
+    
+    worker_task = asyncio.create_task(worker())
+    pending_header = None
+    image_count = 0
+    
+    try:
+        await websocket.send_json({
+            "type": "ready",
+            "session_id": session_id,
+            "backend": backend_type,
+            "max_pending": WS_MAX_PENDING_IMAGES,
+            "capabilities": backend.capabilities(),
+        })
+        
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            
+            if message.get("bytes") is not None:
+                image_count += 1
+                header = pending_header or {}
+                pending_header = None
+                job_id = str(header.get("id") or f"{session_id}-{image_count}")
+                options = {**defaults, **{k: header[k] for k in _WS_OPTION_KEYS if k in header}}
+                
+                if jobs.full():
+                    await websocket.send_json({"type": "error", "id": job_id, "status": 429, "error": "Session backlog full, wait for results"})
+                    continue
+                if job_id in cancel_events:
+                    # Would share the cancel state of the job still in flight under this id
+                    await websocket.send_json({"type": "error", "id": job_id, "status": 409, "error": "A job with this id is still in progress"})
+                    continue
+                
+                cancel_events[job_id] = threading.Event()
+                jobs.put_nowait({"id": job_id, "data": message["bytes"], "options": options,
+                                 "cancel_event": cancel_events[job_id]})
+                await websocket.send_json({"type": "accepted", "id": job_id, "pending": jobs.qsize()})
+                continue
+            
+            try:
+                payload = json.loads(message.get("text") or "")
+            except ValueError:
+                await websocket.send_json({"type": "error", "status": 400, "error": "Invalid JSON message"})
+                continue
+            if not isinstance(payload, dict):
+                await websocket.send_json({"type": "error", "status": 400, "error": "JSON message must be an object"})
+                continue
+            
+            msg_type = payload.get("type")
+            if msg_type == "options":
+                defaults.update({k: payload[k] for k in _WS_OPTION_KEYS if k in payload})
+            elif msg_type == "ocr":
+                pending_header = payload
+            elif msg_type == "cancel" and payload.get("id"):
+                job_id = str(payload["id"])
+                if job_id not in cancel_events:
+                    # Unknown or already finished: remembering it would drop a later job reusing the id
+                    await websocket.send_json({"type": "error", "id": job_id, "status": 404, "error": "No pending or running job with this id"})
+                    continue
+                cancelled.add(job_id)
+                # Running job: the backend checks the event between decode steps
+                cancel_events[job_id].set()
+            elif msg_type == "ping":
+                await websocket.send_json({"type": "pong"})
+            else:
+                await websocket.send_json({"type": "error", "status": 400, "error": f"Unknown message type: {msg_type}"})
+    
+    except WebSocketDisconnect:
+        pass
+    
+    finally:
+        worker_task.cancel()
+        try:
+            await worker_task
+        except (asyncio.CancelledError, WebSocketDisconnect, RuntimeError):
+            pass
+        with _queue_lock:
+            _ws_sessions.pop(session_id, None)
+
+def _render_pdf_pages(pdf_path: str, text_layer: str = DEFAULT_TEXT_LAYER_POLICY) -> list:
+    """Synchronous function: Render all PDF pages to images.
+    
+    Pages with a usable text layer (per the text_layer policy) also carry an
+    "ocr_result" in the /ocr response shape, so the client can skip /ocr for them.
+    """
     images = []
     pdf_doc = fitz.open(pdf_path)
     zoom = 144 / 72.0
@@ -498,34 +1182,60 @@ def _render_pdf_pages(pdf_path: str) -> list:
     
     for page_num in range(pdf_doc.page_count):
         page = pdf_doc[page_num]
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        img_data = pixmap.tobytes("png")
-        img = Image.open(io.BytesIO(img_data)).convert('RGB')
         
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='PNG', optimize=True)
-        img_base64 = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
+        # Scanned page: forward the embedded image (native resolution, original encoding)
+        extracted = extract_page_image(pdf_doc, page)
+        if extracted is not None and extracted["data"] is not None:
+            img = extracted["image"]
+            mime = extracted["mime"]
+            img_bytes = extracted["data"]
+        else:
+            if extracted is not None:
+                img = extracted["image"]
+            else:
+                pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+                img = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+            mime = "image/png"
+            img_buffer = io.BytesIO()
+            img.save(img_buffer, format='PNG', optimize=True)
+            img_bytes = img_buffer.getvalue()
         
-        images.append({
-            "data": f"data:image/png;base64,{img_base64}",
-            "name": f"page_{page_num + 1}.png",
+        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+        ext = "jpg" if mime == "image/jpeg" else "png"
+        
+        entry = {
+            "data": f"data:{mime};base64,{img_base64}",
+            "name": f"page_{page_num + 1}.{ext}",
             "width": img.size[0],
             "height": img.size[1],
-            "page_number": page_num + 1
-        })
+            "page_number": page_num + 1,
+            "source": "embedded_image" if extracted is not None else "rendered"
+        }
+        
+        layer = text_layer_for_page(page, text_layer)
+        if layer is not None:
+            entry["ocr_result"] = build_text_layer_result(layer, img.size[0], img.size[1], "document")
+        
+        images.append(entry)
     
     pdf_doc.close()
     return images
 
 
 @app.post("/pdf-to-images")
-async def pdf_to_images_endpoint(file: UploadFile = File(...)):
+async def pdf_to_images_endpoint(
+    file: UploadFile = File(...),
+    text_layer: str = Form(DEFAULT_TEXT_LAYER_POLICY)
+):
     """Convert PDF to images"""
     global pdf_queue_depth
     
     if pdf_semaphore is None:
         raise HTTPException(status_code=503, detail="Service initializing")
     
+    if text_layer not in TEXT_LAYER_POLICIES:
+        raise HTTPException(status_code=400, detail=f"text_layer must be one of {', '.join(TEXT_LAYER_POLICIES)}")
+    
     # Queue capacity check with lock
     with _queue_lock:
         if pdf_queue_depth >= MAX_PDF_QUEUE_SIZE:
@@ -549,7 +1259,8 @@ async def pdf_to_images_endpoint(file: UploadFile = File(...)):
             images = await loop.run_in_executor(
                 pdf_executor,
                 _render_pdf_pages,
-                tmp_file
+                tmp_file,
+                text_layer
             )
         
         return JSONResponse({
@@ -570,6 +1281,305 @@ async def pdf_to_images_endpoint(file: UploadFile = File(...)):
         if tmp_file and os.path.exists(tmp_file):
             os.remove(tmp_file)
 
+def render_pdf_page(pdf_doc, page_num: int, dpi: int = PDF_RENDER_DPI) -> Image.Image:
+    """Rasterize one PDF page straight into a PIL image (no PNG round trip)"""
+    zoom = dpi / 72.0
+    pixmap = pdf_doc[page_num].get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+
+
+def _save_page_image(img: Image.Image, encoded: Optional[bytes] = None, mime: Optional[str] = None) -> str:
+    """Write a page to a temp file for the backend.
+    
+    Original embedded image bytes are written as-is; rendered pages are saved
+    as PNG with low compression (fast).
+    """
+    if encoded is not None:
+        suffix = '.jpg' if mime == "image/jpeg" else '.png'
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, mode='wb') as tmp:
+            tmp.write(encoded)
+            return tmp.name
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp:
+        img.save(tmp, format='PNG', compress_level=1)
+        return tmp.name
+
+
+def _infer_pages(prompt: str, image_paths: List[str], sizes: List[tuple], budgets: List[int]) -> List[str]:
+    """Run one batch of pages through the backend with the largest of their token
+    budgets; pages that still run out are retried one by one. The batch is
+    split when memory admission says it does not fit as a whole."""
+    if len(image_paths) == 1:
+        return [_infer_with_budget(prompt, image_paths[0], sizes[0], budgets[0])]
+    budget = max(budgets)
+    n = admission.batch_size([shape_key(*size) for size in sizes], budget)
+    if n < len(image_paths):
+        return (_infer_pages(prompt, image_paths[:n], sizes[:n], budgets[:n]) +
+                _infer_pages(prompt, image_paths[n:], sizes[n:], budgets[n:]))
+    texts = backend.infer_batch([prompt] * len(image_paths), image_paths, max_new_tokens=budget)
+    return retry_exhausted(
+        texts, budget,
+        lambda i, max_new_tokens: _infer_with_budget(prompt, image_paths[i], sizes[i], max_new_tokens)
+    )
+
+
+async def _pdf_ocr_pipeline(pdf_path: str, prompt: str, prompt_type: str,
+                            text_layer: str = DEFAULT_TEXT_LAYER_POLICY):
+    """Async generator: OCR a PDF with overlapping render / preprocess / inference stages.
+
+    Stages are connected by bounded queues so rendering runs at most
+    PDF_PIPELINE_DEPTH pages ahead of inference. Pages answered from their text
+    layer or rejected by the blank screen skip inference but keep their place
+    in the page order.
+    Yields a {"type": "start"} event, then one {"type": "page"} event per page.
+    """
+    loop = asyncio.get_running_loop()
+    pdf_doc = fitz.open(pdf_path)
+    doc_lock = threading.Lock()  # fitz documents are not thread-safe
+    page_count = pdf_doc.page_count
+    batch_size = max(1, min(PDF_INFER_BATCH_SIZE, backend.capabilities()["max_batch"]))
+    
+    rendered: asyncio.Queue = asyncio.Queue(maxsize=PDF_PIPELINE_DEPTH)
+    prepared: asyncio.Queue = asyncio.Queue(maxsize=PDF_PIPELINE_DEPTH)
+    results: asyncio.Queue = asyncio.Queue()
+    temp_files: List[str] = []
+    screen_blank = prompt_type in BLANK_SCREEN_PROMPT_TYPES
+    
+    def render(page_num: int):
+        """Returns ("layer", result) for text-layer pages, ("image", extracted dict) otherwise"""
+        with doc_lock:
+            page = pdf_doc[page_num]
+            layer = text_layer_for_page(page, text_layer, prompt_type)
+            if layer is not None:
+                w, h = page_pixel_size(page, PDF_RENDER_DPI)
+                return "layer", build_text_layer_result(layer, w, h, prompt_type)
+            extracted = extract_page_image(pdf_doc, page)
+            if extracted is None:
+                extracted = {"image": render_pdf_page(pdf_doc, page_num), "data": None, "mime": None}
+            return "image", extracted
+    
+    async def render_stage():
+        for page_num in range(page_count):
+            kind, payload = await loop.run_in_executor(pdf_executor, render, page_num)
+            await rendered.put((page_num + 1, kind, payload))
+        await rendered.put(None)
+    
+    async def preprocess_stage():
+        while (item := await rendered.get()) is not None:
+            page_no, kind, payload = item
+            if kind == "layer":
+                await prepared.put((page_no, None, payload))
+                continue
+            if screen_blank:
+                blank, stats = await loop.run_in_executor(pdf_executor, is_blank_page, payload["image"])
+                if blank:
+                    w, h = payload["image"].size
+                    await prepared.put((page_no, None, build_blank_result(w, h, prompt_type, stats)))
+                    continue
+            path = await loop.run_in_executor(
+                pdf_executor, _save_page_image, payload["image"], payload["data"], payload["mime"]
+            )
+            temp_files.append(path)
+            w, h = payload["image"].size
+            budget = await loop.run_in_executor(pdf_executor, predicted_budget, payload["image"], prompt_type, w, h)
+            await prepared.put((page_no, path, (w, h), budget))
+        await prepared.put(None)
+    
+    async def inference_stage():
+        finished = False
+        while not finished:
+            item = await prepared.get()
+            if item is None:
+                break
+            if item[1] is None:
+                page_no, _, result = item
+                await results.put({"type": "page", "page": page_no, **result})
+                continue
+            batch = [item]
+            carry = None  # pre-resolved (text-layer / blank) page that ends this batch
+            while len(batch) < batch_size:
+                try:
+                    nxt = prepared.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if nxt is None:
+                    finished = True
+                    break
+                if nxt[1] is None:
+                    carry = nxt
+                    break
+                batch.append(nxt)
+            
+            # Take the OCR semaphore per batch so single-image requests interleave
+            await ocr_semaphore.acquire()
+            try:
+                start = time_module.time()
+                texts = await loop.run_in_executor(
+                    ocr_executor, _infer_pages, prompt, [item[1] for item in batch],
+                    [item[2] for item in batch], [item[3] for item in batch]
+                )
+                infer_time = time_module.time() - start
+            finally:
+                ocr_semaphore.release()
+            
+            for (page_no, path, (w, h), _), text in zip(batch, texts):
+                result = build_ocr_result(text, w, h, prompt_type)
+                result["metadata"]["source"] = "model"
+                result["metadata"]["inference_time"] = round(infer_time / len(batch), 3)
+                await results.put({"type": "page", "page": page_no, **result})
+                if os.path.exists(path):
+                    os.remove(path)
+            if carry is not None:
+                page_no, _, result = carry
+                await results.put({"type": "page", "page": page_no, **result})
+        await results.put(None)
+    
+    async def guarded(stage):
+        try:
+            await stage()
+        except Exception as e:
+            await results.put(e)
+    
+    tasks = [asyncio.create_task(guarded(stage)) for stage in (render_stage, preprocess_stage, inference_stage)]
+    
+    try:
+        yield {"type": "start", "page_count": page_count}
+        while (item := await results.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        with doc_lock:
+            pdf_doc.close()
+        for path in temp_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+@app.post("/ocr-pdf")
+async def ocr_pdf_endpoint(
+    request: Request,
+    file: UploadFile = File(...),
+    prompt_type: str = Form("document"),
+    find_term: str = Form(""),
+    custom_prompt: str = Form(""),
+    stream: bool = Form(True),
+    text_layer: str = Form(DEFAULT_TEXT_LAYER_POLICY)
+):
+    """PDF OCR on the server: pages are rendered, preprocessed and recognized as
+    overlapping pipeline stages.
+
+    stream=True returns NDJSON (one JSON object per line: start, page..., done);
+    stream=False returns a single JSON document with all pages.
+    text_layer: auto (use trustworthy embedded text), ocr (always run the model)
+    or text (never run the model).
+    """
+    global pdf_queue_depth
+    
+    if backend is None:
+        raise HTTPException(status_code=503, detail="Backend not loaded")
+    
+    if ocr_semaphore is None:
+        raise HTTPException(status_code=503, detail="Service initializing")
+    
+    if not file.filename.lower().endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Must be PDF")
+    
+    if text_layer not in TEXT_LAYER_POLICIES:
+        raise HTTPException(status_code=400, detail=f"text_layer must be one of {', '.join(TEXT_LAYER_POLICIES)}")
+    
+    client_id, client_ip = get_client_identifier(request)
+    
+    with _queue_lock:
+        if pdf_queue_depth >= MAX_PDF_QUEUE_SIZE:
+            raise HTTPException(status_code=503, detail="PDF queue full, please retry later")
+        allowed, reason = check_rate_limit(client_id, client_ip)
+        if not allowed:
+            raise HTTPException(status_code=429, detail=reason)
+        pdf_queue_depth += 1
+        request_id = register_active_request(client_id, client_ip)
+    
+    tmp_file = None
+    released = threading.Event()
+    
+    def release():
+        # Idempotent: the stream's finally and the response's background task both call it
+        global pdf_queue_depth
+        with _queue_lock:
+            if released.is_set():
+                return
+            released.set()
+            pdf_queue_depth -= 1
+            unregister_active_request(request_id, client_id, client_ip)
+        if tmp_file and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    
+    try:
+        pdf_data = await file.read()
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf', mode='wb') as tmp:
+            tmp.write(pdf_data)
+            tmp_file = tmp.name
+    except Exception:
+        release()
+        raise
+    
+    prompt = build_prompt(prompt_type, custom_prompt, find_term)
+    started_at = time_module.time()
+    
+    def done_event(pages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {
+            "type": "done",
+            "success": True,
+            "filename": file.filename,
+            "page_count": len(pages),
+            "merged_text": "\n".join(f"--- Page {p['page']} ---\n{p['text']}\n" for p in pages),
+            "metadata": {
+                "mode": prompt_type,
+                "backend": backend_type,
+                "elapsed": round(time_module.time() - started_at, 3),
+                "inference_time": round(sum(p["metadata"].get("inference_time", 0) for p in pages), 3),
+                "text_layer_pages": sum(1 for p in pages if p["metadata"].get("source") == "text_layer"),
+                "blank_pages": sum(1 for p in pages if p["metadata"].get("blank_page")),
+            }
+        }
+    
+    if stream:
+        async def event_stream():
+            pages = []
+            try:
+                async for event in _pdf_ocr_pipeline(tmp_file, prompt, prompt_type, text_layer):
+                    if event["type"] == "page":
+                        pages.append(event)
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+                yield json.dumps(done_event(pages), ensure_ascii=False) + "\n"
+            except Exception as e:
+                import traceback
+                print(f"❌ PDF OCR Error:\n{traceback.format_exc()}")
+                yield json.dumps({"type": "error", "success": False, "error": str(e)}) + "\n"
+            finally:
+                release()
+        
+        # The generator's finally never runs if the client disconnects before the body is
+        # iterated; the background task runs after the response either way
+        return StreamingResponse(event_stream(), media_type="application/x-ndjson", background=BackgroundTask(release))
+    
+    try:
+        pages = [event async for event in _pdf_ocr_pipeline(tmp_file, prompt, prompt_type, text_layer) if event["type"] == "page"]
+        result = done_event(pages)
+        result.pop("type")
+        result["pages"] = pages
+        return JSONResponse(result)
+        
+    except Exception as e:
+        import traceback
+        print(f"❌ PDF OCR Error:\n{traceback.format_exc()}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+        
+    finally:
+        release()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8001))
     print(f"\n{'='*50}")
@@ -54,13 +54,13 @@ CROP_MODE = True
 AsyncLLMEngine = None
 SamplingParams = None
 AsyncEngineArgs = None
-DeepseekOCRProcessor = None
+get_processor = None
 NoRepeatNGramLogitsProcessor = None
 
 def load_vllm_engine():
     """延迟加载vLLM引擎"""
     global engine, vllm_loaded, AsyncLLMEngine, SamplingParams, AsyncEngineArgs
-    global DeepseekOCRProcessor, NoRepeatNGramLogitsProcessor
+    global get_processor, NoRepeatNGramLogitsProcessor
     
     if vllm_loaded:
         return
@@ -73,14 +73,14 @@ def load_vllm_engine():
         import sys
         sys.path.insert(0, str(Path(__file__).parent / "DeepSeek-OCR-master/DeepSeek-OCR-vllm"))
         from deepseek_ocr import DeepseekOCRForCausalLM
-        from process.image_process import DeepseekOCRProcessor as _DeepseekOCRProcessor
+        from process.image_process import get_processor as _get_processor
         from process.ngram_norepeat import NoRepeatNGramLogitsProcessor as _NoRepeatNGramLogitsProcessor
         
         # 赋值给全局变量
         AsyncLLMEngine = _AsyncLLMEngine
         SamplingParams = _SamplingParams
         AsyncEngineArgs = _AsyncEngineArgs
-        DeepseekOCRProcessor = _DeepseekOCRProcessor
+        get_processor = _get_processor
         NoRepeatNGramLogitsProcessor = _NoRepeatNGramLogitsProcessor
         
         # 注册模型
@@ -126,7 +126,7 @@ async def process_ocr(image: Image.Image, prompt: str) -> str:
     
     # 处理图像
     if '<image>' in prompt:
-        image_features = DeepseekOCRProcessor().tokenize_with_images(
+        image_features = get_processor().tokenize_with_images(
             images=[image], 
             bos=True, 
             eos=True, 